@@ -152,29 +152,33 @@ class Grubby(Bootloader):
         1
         """
 
-        blsid = None
-        args = None
-        root = None
-        index = None
-        title = None
-        kernel = None
-        initrd = None
+        __slots__ = ("index", "kernel", "args", "root", "initrd", "title",
+                     "blsid")
+
+        _re_entry = re.compile(r"""(?:index=)(\d+)\n?
+                                   (?:(?:kernel=)?(.*?)\n)?
+                                   (?:(?:args=)?(.*?)\n)?
+                                   (?:(?:root=)?(.*?)\n)?
+                                   (?:(?:initrd=)?(.*?)\n)?
+                                   (?:(?:title=)?(.*)\n?)?
+                                   (?:(?:id=)?(.*))?
+                                """, re.VERBOSE)
+
+        def __init__(self, index=None, kernel=None, args=None, root=None,
+                     initrd=None, title=None, blsid=None):
+            self.index = index
+            self.kernel = kernel
+            self.args = args
+            self.root = root
+            self.initrd = initrd
+            self.title = title
+            self.blsid = blsid
 
         @staticmethod
         def parse(entry):
-            g = Grubby.GrubbyEntry()
-
-            r = re.compile(r"""(?:index=)(\d+)\n?
-                               (?:(?:kernel=)?(.*?)\n)?
-                               (?:(?:args=)?(.*?)\n)?
-                               (?:(?:root=)?(.*?)\n)?
-                               (?:(?:initrd=)?(.*?)\n)?
-                               (?:(?:title=)?(.*)\n?)?
-                               (?:(?:id=)?(.*))?
-                            """, re.VERBOSE)
-            matches = r.match(entry)
-            g.index, g.kernel, g.args, g.root, g.initrd, g.title, g.blsid = \
-                [x.strip('"') if x else x for x in matches.groups()]
+            matches = Grubby.GrubbyEntry._re_entry.match(entry)
+            g = Grubby.GrubbyEntry(*[x.strip('"') if x else x
+                                     for x in matches.groups()])
 
             if not all([g.kernel, g.args, g.initrd]):
                 raise InvalidBootEntryError()
@@ -193,6 +197,7 @@ class Grubby(Bootloader):
                                       os.X_OK)
         else:
             self._use_bls = use_bls
+        self._info = None
 
     def _parse_key_from_args(self, args):
         """
@@ -209,13 +214,19 @@ class Grubby(Bootloader):
             raise NoKeyFoundError()
         return matches[0]
 
+    def _get_info(self):
+        """The entries as reported by grubby, queried once until the
+        entries are changed
+        """
+        if self._info is None:
+            self._info = grubby("--info=ALL", stderr=self._DEVNULL)
+        return self._info
+
     def _get_valid_entries(self):
-        return self._parse_entries(grubby("--info=ALL",
-                                          stderr=self._DEVNULL))[0]
+        return self._parse_entries(self._get_info())[0]
 
     def _get_other_entries(self):
-        return self._parse_entries(grubby("--info=ALL",
-                                          stderr=self._DEVNULL))[1]
+        return self._parse_entries(self._get_info())[1]
 
     def _parse_entries(self, data):
         """Returns (valid_entries_map, other_entires_list)
@@ -247,6 +258,7 @@ class Grubby(Bootloader):
         return (entrymap, other_entries)
 
     def _remove_entry(self, entry):
+        self._info = None
         if self._use_bls:
             os.unlink(entry.bls_conf_path())
         else:
@@ -292,6 +304,7 @@ class Grubby(Bootloader):
             args += ["--bls-directory", tmpdir]
 
         grubby(*args)
+        self._info = None
 
         # Modify bls entry as grubby removes all the leading paths for the
         # kernel and initrd.  This is a workaround until
@@ -308,15 +321,20 @@ class Grubby(Bootloader):
         return key
 
     def remove_entry(self, key):
+        self.remove_entries([key])
+
+    def remove_entries(self, keys):
+        """Remove the entries of all keys, as long as entries of other
+        keys are left
+        """
         entries = self._get_valid_entries()
-        key_entries = entries.pop(key, None)
+        key_entries = [e for key in keys for e in entries.pop(key, [])]
         if not entries:
-            log.debug("Not removing %s, no other entries found!", key)
+            log.debug("Not removing %s, no other entries found!", keys)
             return
-        if key_entries:
-            for ke in key_entries:
-                log.info("Removing boot entry: %s" % ke.title)
-                self._remove_entry(ke)
+        for ke in key_entries:
+            log.info("Removing boot entry: %s" % ke.title)
+            self._remove_entry(ke)
 
     def set_default(self, key, update_grubenv=True):
         boot_entries = self._get_valid_entries()[key]
@@ -330,13 +348,13 @@ class Grubby(Bootloader):
     def get_default(self):
         log.debug("Getting default")
         kernel = grubby("--default-kernel")
-        entries = self._get_valid_entries()
+        entries, other_entries = self._parse_entries(self._get_info())
         try:
             entry = [b for e in entries for b in entries[e]
                      if b.kernel == kernel][0].title
         except IndexError:
             # Installing new kernels means we miss this. Check the others
-            entry = [e for e in self._get_other_entries()
+            entry = [e for e in other_entries
                      if e.kernel == kernel][0].title
         log.debug("Default: %s" % entry)
         return entry
@@ -0,0 +1,312 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+from contextlib import contextmanager
+
+from . import command
+from .utils import BuildMetadata, Tar, mounted
+
+log = logging.getLogger(__package__)
+
+
+@contextmanager
+def mounted_liveimg(liveimgfile):
+    """Mount the root filesystem of a liveimg, yields the mount point
+    """
+    with mounted(liveimgfile, options="ro") as squashfs:
+        liveimg = glob.glob(squashfs.target + "/*/*.img").pop()
+        with mounted(liveimg, options="ro") as rootfs:
+            yield rootfs.target
+
+
+def _digest(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as src:
+        for chunk in iter(lambda: src.read(1024 ** 2), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _xattrs_digest(path):
+    """A digest of all xattrs (SELinux label, ACLs, ...), None if they
+    can not be read
+    """
+    if not hasattr(os, "listxattr"):
+        return None
+    try:
+        sha = hashlib.sha256()
+        for name in sorted(os.listxattr(path, follow_symlinks=False)):
+            sha.update(name.encode("utf-8") + b"\0")
+            sha.update(os.getxattr(path, name, follow_symlinks=False) +
+                       b"\0")
+        return sha.hexdigest()
+    except OSError:
+        return None
+
+
+def tree_manifest(root):
+    """Describe every path below root by its mode, owner, content and
+    xattrs, the content is the digest of a file or the target of a link
+
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> os.symlink("etc", os.path.join(tmpdir, "link"))
+    >>> os.mkdir(os.path.join(tmpdir, "etc"))
+    >>> with open(os.path.join(tmpdir, "etc", "f"), "w") as dst:
+    ...     _ = dst.write("data")
+    >>> manifest = tree_manifest(tmpdir)
+    >>> sorted(manifest)
+    ['./etc', './etc/f', './link']
+    >>> manifest["./etc/f"][3][:8], manifest["./link"][3]
+    ('3a6eb079', 'etc')
+    >>> shutil.rmtree(tmpdir)
+    """
+    manifest = {}
+    for dirpath, dirs, files in os.walk(root):
+        for name in dirs + files:
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode):
+                content = _digest(path)
+            elif stat.S_ISLNK(st.st_mode):
+                content = os.readlink(path)
+            else:
+                content = None
+            rel = "./" + os.path.relpath(path, root)
+            manifest[rel] = [st.st_mode, st.st_uid, st.st_gid, content,
+                             _xattrs_digest(path)]
+    return manifest
+
+
+class Delta(object):
+    """A delta between the trees of two bases
+
+    The artifact is a tar file with:
+    - manifest.json: the NVRs, the removed paths, the binary deltas and
+      the manifest of the new tree, which is used to verify the result
+    - tree.tar.gz: all added and changed paths which have no binary
+      delta, with their SELinux labels, xattrs and ACLs
+    - deltas/N: xdelta3 deltas of changed files, against the file of the
+      old tree, which is keeping its metadata
+    """
+    version = 1
+    # Smaller files are always included in full
+    min_delta_size = 64 * 1024
+    # A delta is only used if it is smaller than this share of the file
+    max_delta_ratio = 0.5
+
+    def __init__(self, workdir):
+        self.workdir = workdir
+        with open(os.path.join(workdir, "manifest.json")) as src:
+            self.manifest = json.load(src)
+        if self.manifest.get("version") != self.version:
+            raise RuntimeError("Unsupported delta version: %s" %
+                               self.manifest.get("version"))
+
+    @classmethod
+    @contextmanager
+    def open(cls, path):
+        """Unpack the delta artifact at path into a temporary directory
+        """
+        workdir = tempfile.mkdtemp(prefix="imgbased-delta.")
+        try:
+            with tarfile.open(path) as artifact:
+                names = artifact.getnames()
+                members = ["manifest.json", "tree.tar.gz"]
+                members += [n for n in names if n.startswith("deltas/")]
+                os.mkdir(os.path.join(workdir, "deltas"))
+                for name in members:
+                    if name not in names:
+                        continue
+                    dst = os.path.join(workdir, "deltas",
+                                       os.path.basename(name)) \
+                        if name.startswith("deltas/") \
+                        else os.path.join(workdir, name)
+                    with open(dst, "wb") as dstf:
+                        shutil.copyfileobj(artifact.extractfile(name), dstf)
+            yield cls(workdir)
+        finally:
+            shutil.rmtree(workdir)
+
+    @staticmethod
+    def _encode(old, new, delta):
+        command.call(["xdelta3", "-e", "-9", "-f", "-s", old, new, delta])
+
+    @staticmethod
+    def _decode(old, delta, new):
+        command.call(["xdelta3", "-d", "-f", "-s", old, delta, new])
+
+    @classmethod
+    def _delta_candidate(cls, oldroot, newroot, path, old, new):
+        """A changed file can be patched, if only its content changed
+        """
+        if path not in old or not stat.S_ISREG(new[path][0]) or \
+                stat.S_IFMT(old[path][0]) != stat.S_IFMT(new[path][0]):
+            return False
+        if old[path][:3] + old[path][4:] != new[path][:3] + new[path][4:]:
+            return False
+        # Writing one of several hard links would change all of them
+        oldst = os.lstat(os.path.join(oldroot, path))
+        newst = os.lstat(os.path.join(newroot, path))
+        return oldst.st_nlink == 1 and newst.st_nlink == 1 and \
+            newst.st_size >= cls.min_delta_size
+
+    @classmethod
+    def make(cls, oldroot, newroot, output, from_nvr=None, to_nvr=None):
+        """Create a delta artifact to turn the tree oldroot into newroot
+        """
+        from_nvr = from_nvr or BuildMetadata(oldroot).get("nvr")
+        to_nvr = to_nvr or BuildMetadata(newroot).get("nvr")
+        log.info("Creating a delta from %s to %s" % (from_nvr, to_nvr))
+
+        old = tree_manifest(oldroot)
+        new = tree_manifest(newroot)
+
+        # Paths which changed their type are removed first
+        removed = sorted(p for p in old
+                         if p not in new or
+                         stat.S_IFMT(old[p][0]) != stat.S_IFMT(new[p][0]))
+        changed = sorted(p for p in new if old.get(p) != new[p])
+
+        workdir = tempfile.mkdtemp(prefix="imgbased-delta.")
+        try:
+            os.mkdir(os.path.join(workdir, "deltas"))
+            deltas = {}
+            full = []
+            can_encode = True
+            for path in changed:
+                newpath = os.path.join(newroot, path)
+                oldpath = os.path.join(oldroot, path)
+                name = "deltas/%d" % len(deltas)
+                candidate = can_encode and cls._delta_candidate(
+                    oldroot, newroot, path, old, new)
+                if candidate:
+                    dst = os.path.join(workdir, name)
+                    try:
+                        cls._encode(oldpath, newpath, dst)
+                    except OSError:
+                        log.warn("xdelta3 is not available, only full "
+                                 "files are used")
+                        can_encode = False
+                        candidate = False
+                if candidate and os.path.getsize(dst) < \
+                        cls.max_delta_ratio * os.path.getsize(newpath):
+                    deltas[path] = {"delta": name,
+                                    "source": old[path][3],
+                                    "mtime": os.lstat(newpath).st_mtime}
+                else:
+                    if candidate:
+                        os.unlink(dst)
+                    full.append(path)
+            log.info("%d paths removed, %d changed, %d binary deltas" %
+                     (len(removed), len(changed), len(deltas)))
+
+            if full:
+                listfile = os.path.join(workdir, "full.list")
+                with open(listfile, "wb") as listf:
+                    listf.write(b"".join(p.encode("utf-8") + b"\0"
+                                         for p in full))
+                command.call(["tar", "czf",
+                              os.path.join(workdir, "tree.tar.gz")] +
+                             Tar.default_args +
+                             ["-C", newroot, "--no-recursion", "--null",
+                              "-T", listfile])
+                os.unlink(listfile)
+
+            with open(os.path.join(workdir, "manifest.json"), "w") as dst:
+                json.dump({"version": cls.version,
+                           "from": from_nvr,
+                           "to": to_nvr,
+                           "removed": removed,
+                           "deltas": deltas,
+                           "tree": new}, dst)
+
+            with tarfile.open(output, "w") as artifact:
+                for name in sorted(os.listdir(workdir)):
+                    artifact.add(os.path.join(workdir, name), arcname=name)
+        finally:
+            shutil.rmtree(workdir)
+        log.info("Delta written to %s" % output)
+
+    def apply(self, root):
+        """Apply the delta to a copy of the old tree at root
+        """
+        deltas = self.manifest["deltas"]
+        for path, delta in sorted(deltas.items()):
+            if _digest(os.path.join(root, path)) != delta["source"]:
+                raise RuntimeError("%s does not match the delta source" %
+                                   path)
+
+        for path in reversed(self.manifest["removed"]):
+            path = os.path.join(root, path)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.unlink(path)
+
+        tree = os.path.join(self.workdir, "tree.tar.gz")
+        if os.path.exists(tree):
+            command.call(["tar", "xzBf", tree] + Tar.default_args +
+                         ["-C", root])
+
+        for path, delta in sorted(deltas.items()):
+            path = os.path.join(root, path)
+            patched = os.path.join(self.workdir, "patched")
+            self._decode(path, os.path.join(self.workdir, delta["delta"]),
+                         patched)
+            # Rewrite the inode, to keep its owner, mode and xattrs
+            with open(patched, "rb") as src, open(path, "r+b") as dst:
+                dst.truncate()
+                shutil.copyfileobj(src, dst, 1024 ** 2)
+            os.unlink(patched)
+            os.utime(path, (delta["mtime"], delta["mtime"]))
+
+    def verify(self, root):
+        """Compare the tree at root with the manifest of the new tree
+        """
+        expected = self.manifest["tree"]
+        actual = tree_manifest(root)
+        mismatches = sorted(p for p in set(expected) | set(actual)
+                            if p not in expected or p not in actual or
+                            self._differs(expected[p], actual[p]))
+        if mismatches:
+            log.debug("Mismatching paths: %s" % mismatches)
+            raise RuntimeError("The result does not match the delta "
+                               "manifest in %d paths, i.e. %s" %
+                               (len(mismatches), mismatches[0]))
+        log.info("Verified %d paths" % len(actual))
+
+    @staticmethod
+    def _differs(expected, actual):
+        if actual[4] is None:
+            # The xattrs can not be read here
+            return expected[:4] != actual[:4]
+        return expected != actual
+
+# vim: sw=4 et sts=4:
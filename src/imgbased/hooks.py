@@ -127,10 +127,13 @@ class Hooks(object):
             """
             if not os.path.exists(path):
                 return
+            # List arguments are passed as separate arguments
+            flat_args = [a for arg in args
+                         for a in (arg if isinstance(arg, list) else [arg])]
             for handler in os.listdir(path):
                 script = os.path.join(path, handler)
                 # log.debug("Triggering: %s (%s %s)" % (script, name, args))
-                subprocess.check_call([script, name] + list(args))
+                subprocess.check_call([script, name] + flat_args)
         self.create(None, _trigger_fs)
 
 # vim: sw=4 et sts=4:
@@ -21,12 +21,12 @@
 # Author(s): Fabian Deutsch <fabiand@redhat.com>
 #
 import logging
-import re
 
 from . import constants, local, naming, utils
 from .hooks import Hooks
 from .lvm import LVM, MissingLvmThinPool
 from .naming import Image
+from .poolstats import PoolStats
 from .volume import Volumes
 
 log = logging.getLogger(__package__)
@@ -89,6 +89,10 @@ class ImageLayers(object):
                           ("lv_fullname",))
         self.hooks.create("layer-removed",
                           ("lv_fullname",))
+        self.hooks.create("pre-images-removed",
+                          ("lv_fullnames",))
+        self.hooks.create("images-removed",
+                          ("lv_fullnames",))
         self.hooks.create("post-init-layout",
                           ("existing_lv", "new_base", "new_layer"))
 
@@ -100,17 +104,14 @@ class ImageLayers(object):
         self.mode = mode
 
     def list_our_lv_names(self):
-        filtr = "lv_tags = {} || lv_tags = {}".format(self.lv_base_tag,
-                                                      self.lv_layer_tag)
-        lvs = LVM.list_lvs(filtr=filtr)
+        our_tags = [self.lv_base_tag, self.lv_layer_tag]
+        lvs = LVM.list_lvs_with_tags(any_tag=our_tags)
 
-        def has_our_tag(lv):
-            our_tags = [self.lv_base_tag, self.lv_layer_tag]
-            return any(tag in lv.tags()
-                       for tag in our_tags)
+        def has_our_tag(tags):
+            return any(tag in tags for tag in our_tags)
 
-        our_lvs = [lv for lv in lvs if has_our_tag(lv)]
-        log.debug("Our LVS: %s" % lvs)
+        our_lvs = [lv for lv, tags in lvs if has_our_tag(tags)]
+        log.debug("Our LVS: %s" % our_lvs)
         return [lv.lv_name for lv in our_lvs]
 
     def _vg(self):
@@ -124,6 +125,14 @@ class ImageLayers(object):
     def _thinpool(self):
         return LVM.Thinpool.from_tag(self.thinpool_tag)
 
+    def record_pool_usage(self, operation):
+        """Take a sample of the pool usage, see PoolStats
+        """
+        try:
+            PoolStats().record(self._thinpool(), operation)
+        except Exception:
+            log.debug("Failed to record the pool usage", exc_info=True)
+
     def _lvm_from_layer(self, layer):
         return self.lv(layer.lv_name)
 
@@ -154,10 +163,10 @@ class ImageLayers(object):
             pass
         lv_tags = (self.lv_init_tag, self.lv_base_tag, self.lv_layer_tag,
                    Volumes.tag_volume)
-        filtr = " || ".join(["lv_tags = %s" % x for x in lv_tags])
-        for lv in LVM.list_lvs(filtr=filtr):
-            for tag in lv.tags():
+        for lv, tags in LVM.list_lvs_with_tags(any_tag=lv_tags):
+            for tag in tags:
                 lv.deltag(tag)
+        self.naming.invalidate()
 
     def lv_from_layer(self, layer):
         return self._lvm_from_layer(layer)
@@ -211,19 +220,35 @@ class ImageLayers(object):
             raise
 
         self.hooks.emit("new-layer-added", prev_lv, new_lv)
+        self.record_pool_usage("add_layer")
 
         return new_lv
 
     def _add_lvm_snapshot(self, prev_lv, new_lv_name):
+        # Bases are skipped on activation, layers are not
+        prev_changes = LVM.Changes().activate(True, True)
+        try:
+            # It can happen (i.e. on init) that the prev_lv name
+            # is not nvr based.
+            skip_if_is_base = Image.from_lv_name(prev_lv.lv_name).is_base()
+            prev_changes.setactivationskip(skip_if_is_base)
+        except RuntimeError:
+            log.debug("Failed to get activationskip for prev_lv",
+                      exc_info=True)
+
+        skip_if_is_base = Image.from_lv_name(new_lv_name).is_base()
+        new_changes = LVM.Changes().addtag(self.lv_layer_tag) \
+            .setactivationskip(skip_if_is_base) \
+            .activate(True, True)
+
         try:
             # If an error is raised here, then:
             # https://bugzilla.redhat.com/show_bug.cgi?id=1227046
             # is not fixed yet.
-            prev_lv.activate(True, True)
+            prev_lv.change(prev_changes)
 
-            new_lv = prev_lv.create_snapshot(new_lv_name)
-            new_lv.activate(True, True)
-            new_lv.addtag(self.lv_layer_tag)
+            new_lv = prev_lv.create_snapshot(new_lv_name, new_changes)
+            self.naming.invalidate()
         except Exception:
             log.error("Failed to create a new layer")
             log.debug("Snapshot creation failed", exc_info=True)
@@ -238,21 +263,13 @@ class ImageLayers(object):
                     ' '.join(utils.Filesystem.supported_filesystem())))
             raise
 
-        # Handle the previous layer
-        skip_if_is_base = Image.from_lv_name(new_lv.lv_name).is_base()
-        new_lv.setactivationskip(skip_if_is_base)
-
-        try:
-            # It can happen (i.e. on init) that the prev_lv name
-            # is not nvr based.
-            skip_if_is_base = Image.from_lv_name(prev_lv.lv_name).is_base()
-            prev_lv.setactivationskip(skip_if_is_base)
-        except RuntimeError:
-            log.debug("Failed to set activationskip on prev_lv", exc_info=True)
-
         return new_lv
 
     def init_tags_on(self, lv):
+        with LVM.transaction():
+            self._init_tags_on(lv)
+
+    def _init_tags_on(self, lv):
         lv = lv if type(lv) in [LVM.LV] else LVM.LV.try_find(lv)
         self._assert_tags(lv)
         # No tags are found on `lv`, but we may have imgbased tags laying
@@ -328,17 +345,51 @@ class ImageLayers(object):
         pool = self._thinpool()
         log.debug("Pool: %s" % pool)
 
-        new_base_lv = pool.create_thinvol(new_base.lv_name, size)
-        new_base_lv.addtag(self.lv_base_tag)
+        # Create the base protected right away
+        changes = LVM.Changes().addtag(self.lv_base_tag) \
+            .permission("r") \
+            .setactivationskip(True) \
+            .activate(False)
+        new_base_lv = pool.create_thinvol(new_base.lv_name, size, changes)
+        self.naming.invalidate()
         log.info("New LV is: %s" % new_base_lv)
 
-        new_base_lv.protect()
-
         if with_layer:
             self.add_layer(new_base)
 
         return new_base
 
+    def add_base_from_snapshot(self, origin, size, nvr, tagged=True):
+        """Add a new base LV as a thin snapshot of the base origin
+
+        The new base is sharing all blocks with origin until they are
+        changed, it is grown to size if origin is smaller.
+        An untagged base is not part of the layout, until it is tagged
+        with lv_base_tag.
+        """
+        new_base = Image.from_nvr(nvr)
+        log.info("New base will be: %s, a snapshot of %s" %
+                 (new_base, origin))
+
+        origin_lv = self._lvm_from_layer(origin)
+        changes = LVM.Changes().permission("r") \
+            .setactivationskip(True) \
+            .activate(False)
+        if tagged:
+            changes.addtag(self.lv_base_tag)
+        new_base_lv = origin_lv.create_snapshot(new_base.lv_name, changes)
+        self.naming.invalidate()
+        log.info("New LV is: %s" % new_base_lv)
+
+        def to_bytes(size):
+            return int(str(size).strip().rstrip("B"))
+
+        if to_bytes(new_base_lv.size_bytes) < to_bytes(size):
+            log.debug("Growing %s to %s" % (new_base_lv, size))
+            new_base_lv.resize(size)
+
+        return new_base
+
     def protect_init_lv(self):
         try:
             LVM.LV.from_tag(self.lv_init_tag).protect()
@@ -346,53 +397,121 @@ class ImageLayers(object):
             log.warn("Could not protect init LV: %s", str(e))
 
     def remove_base(self, name, with_children=True, force=False):
-        base = Image.from_nvr(name)
-        log.debug("Removal candidate base: %r" % base)
-
-        base_lv = self._lvm_from_layer(base)
-        self.hooks.emit("pre-base-removed", base_lv)
-
-        assert base.is_base()
-
-        if with_children:
-            for layer in self.naming.layers(for_base=base):
-                self.remove_layer(layer.nvr, force)
-
-        base_lv.activate(False)
-        base_lv.remove(force)
+        self.remove_bases([name], with_children, force)
 
-        self.hooks.emit("base-removed", base_lv)
+    def remove_bases(self, names, with_children=True, force=False):
+        """Remove several bases, layers are rejected, see remove_images
+        """
+        layers = [str(name) for name in names
+                  if not Image.from_nvr(name).is_base()]
+        if layers:
+            raise RuntimeError("Not a base: %s" % ", ".join(layers))
+        self.remove_images(names, with_children, force)
 
     def remove_layer(self, name, force=False):
         layer = Image.from_nvr(name)
-        lv = self._lvm_from_layer(layer)
-        log.debug("Removal candidate layer: %r" % layer)
-
         assert layer.is_layer()
-        assert layer != self.current_layer()
-
-        self.hooks.emit("pre-layer-removed", lv.lvm_name)
+        self.remove_images([layer.nvr], force=force)
 
-        log.debug("Removing %s" % layer)
-        lv.activate(False)
-        lv.remove(force)
-
-        self.hooks.emit("layer-removed", lv)
+    def _removal_candidates(self, names, with_children=True):
+        """The images to remove, layers before their bases, all of them
+        are checked before anything is removed
+        """
+        images = []
+        for name in names:
+            img = Image.from_nvr(name)
+            if img.is_base() and with_children:
+                images.extend(self.naming.layers(for_base=img))
+            images.append(img)
+        candidates = []
+        for img in images:
+            if str(img) not in [str(c) for c in candidates]:
+                candidates.append(img)
+
+        known = set(str(img) for img in self.naming.images())
+        unknown = [str(img) for img in candidates if str(img) not in known]
+        if unknown:
+            raise RuntimeError("Unknown images: %s" % ", ".join(unknown))
+
+        layers = [img for img in candidates if img.is_layer()]
+        if layers:
+            current = str(self.current_layer())
+            if current in [str(layer) for layer in layers]:
+                raise RuntimeError("The current layer %s can not be "
+                                   "removed" % current)
+        return candidates
+
+    def remove_images(self, names, with_children=True, force=False):
+        """Remove several bases (with their layers) and layers at once
+
+        The LVs are removed in one LVM transaction, with one lvchange and
+        one lvremove. The pre-images-removed and images-removed hooks are
+        emitted once, with the names of all LVs, the hooks of the
+        single bases and layers are emitted for every image.
+        """
+        images = self._removal_candidates(names, with_children)
+        log.debug("Removal candidates: %s" % images)
+        lvs = [self._lvm_from_layer(img) for img in images]
+        lv_names = [lv.lvm_name for lv in lvs]
+
+        self.hooks.emit("pre-images-removed", lv_names)
+        for img, lv in zip(images, lvs):
+            if img.is_base():
+                self.hooks.emit("pre-base-removed", lv)
+            else:
+                self.hooks.emit("pre-layer-removed", lv.lvm_name)
+
+        log.info("Removing %s" % ", ".join(str(img) for img in images))
+        with LVM.transaction():
+            LVM.remove_lvs(lvs, force)
+            self.naming.invalidate()
+
+        for img, lv in zip(images, lvs):
+            self.hooks.emit("base-removed" if img.is_base()
+                            else "layer-removed", lv)
+        self.hooks.emit("images-removed", lv_names)
 
     def free_space(self, units="m"):
         """Free space in the thinpool for bases and layers
         """
         log.debug("Calculating free space in thinpool %s" % self._thinpool())
-        lvm_name = self._thinpool().lvm_name
-        args = ["--noheadings", "--nosuffix", "--units", units,
-                "--options", "data_percent,lv_size",
-                lvm_name]
-        stdout = LVM._lvs(args).replace(",", ".").strip()
-        used_percent, size = re.split("\\s+", stdout)
+        usage = self._thinpool().usage()
+        size = utils.size_in_units(usage["lv_size"], units)
+        used_percent = usage["data_percent"]
         log.debug("Used: %s%% from %s" % (used_percent, size))
-        free = float(size)
-        free -= float(size) * float(used_percent) / 100.00
-        return free
+        free = size - size * used_percent / 100.00
+        return round(free, 2)
+
+    def image_usage(self):
+        """Returns the mapped, exclusive and shared bytes of all images,
+        by their LV name
+        """
+        usage = self._thinpool().thin_usage()
+        return dict((img.lv_name, usage[img.lv_name])
+                    for img in self.naming.images()
+                    if img.lv_name in usage)
+
+    def reclaimable_space(self, bases=None, usage=None):
+        """Returns (base, bytes) tuples, the base freeing the most space
+        first
+
+        The bytes are freed at least when removing the base and it's
+        layers: the blocks exclusive to one of them. The blocks shared
+        only between them are freed as well, but can not be told apart
+        from the blocks shared with other images.
+        """
+        if usage is None:
+            usage = self.image_usage()
+        if bases is None:
+            bases = self.naming.bases()
+
+        def exclusive(img):
+            return usage.get(img.lv_name, {}).get("exclusive", 0)
+
+        space = [(base, exclusive(base) + sum(exclusive(layer)
+                                              for layer in base.layers))
+                 for base in bases]
+        return sorted(space, key=lambda base_space: -base_space[1])
 
     def latest_base(self):
         return self.naming.last_base()
@@ -403,10 +522,8 @@ class ImageLayers(object):
     def current_layer(self):
         path = "/"
         log.debug("Fetching image for '%s'" % path)
-        lv = utils.find_mount_source(path)
-        log.debug("Found '%s'" % lv)
         try:
-            return self.image_from_path(lv)
+            return self.image_from_path(path)
         except Exception:
             log.error("The root volume does not look like an image")
             raise
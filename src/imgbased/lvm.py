@@ -20,13 +20,19 @@
 #
 # Author(s): Fabian Deutsch <fabiand@redhat.com>
 #
+import json
 import logging
 import os
 import re
 import shlex
+import stat
+import subprocess
+import threading
+import time
 from operator import itemgetter
 
-from .utils import ExternalBinary, LvmCLI, find_mount_source
+from . import constants
+from .utils import ExternalBinary, LvmCLI, ThreadRunner, find_mount_source
 
 log = logging.getLogger(__package__)
 
@@ -39,16 +45,429 @@ class ThinPoolMetadataError(Exception):
     pass
 
 
+class LvmState(object):
+    """A snapshot of all LV and VG report fields imgbased is using
+
+    Every `lvs` and `vgs` call is rescanning all PVs, which is slow
+    on hosts with many (or multipathed) PVs.
+    The snapshot is fetched with one `lvs` and one `vgs` call, and is
+    then used to answer the getters of LVM.VG, LVM.LV and LVM.Thinpool.
+    It is dropped whenever a command changing the LVM metadata is run.
+
+    The LV fields are also cached across processes in /run/imgbased,
+    keyed by the vg_seqno of all VGs. The seqno is increased by LVM with
+    every metadata change, if it did not change, then a later process
+    can reuse the cached LVs and only needs the (single) `vgs` call.
+    The pool usage is no metadata, it is only reused for a few seconds.
+
+    >>> lvs = '{"report": [{"lv": [{"vg_name": "hostvg", "lv_name": "root",'
+    >>> lvs += ' "lv_tags": "imgbased:layer", "lv_size": "1024"}]}]}'
+    >>> vgs = '{"report": [{"vg": [{"vg_name": "hostvg", "vg_tags": ""}]}]}'
+    >>> state = LvmState.parse(lvs, vgs)
+    >>> state.lv("hostvg/root")["lv_tags"]
+    'imgbased:layer'
+    >>> state.lv("hostvg/swap") is None
+    True
+    >>> state.vg("hostvg")["vg_tags"]
+    ''
+    >>> [lv["lv_name"] for lv in state.lvs_with_tag("imgbased:layer")]
+    ['root']
+    """
+    lv_fields = ["vg_name", "lv_name", "lv_path", "lv_dm_path", "lv_size",
+                 "lv_attr", "lv_tags", "pool_lv", "origin", "lv_profile",
+                 "data_percent", "metadata_percent", "lv_metadata_size",
+                 "thin_id"]
+    vg_fields = ["vg_name", "vg_tags", "vg_free", "vg_seqno"]
+    usage_fields = ["data_percent", "metadata_percent"]
+    usage_ttl = 10
+    cache_file = constants.IMGBASED_LVM_STATE_CACHE
+
+    _current = None
+    _disabled = bool(os.getenv("IMGBASED_DISABLE_LVM_CACHE"))
+    _lock = threading.Lock()
+
+    def __init__(self, lvs, vgs):
+        self._lvs = lvs
+        self._vgs = vgs
+
+    @staticmethod
+    def _report(raw, kind):
+        return json.loads(raw)["report"][0][kind]
+
+    @classmethod
+    def _parse_lvs(cls, raw_lvs):
+        return dict(("%s/%s" % (lv["vg_name"], lv["lv_name"]), lv)
+                    for lv in cls._report(raw_lvs, "lv"))
+
+    @classmethod
+    def _parse_vgs(cls, raw_vgs):
+        return dict((vg["vg_name"], vg) for vg in cls._report(raw_vgs, "vg"))
+
+    @classmethod
+    def parse(cls, raw_lvs, raw_vgs):
+        return cls(cls._parse_lvs(raw_lvs), cls._parse_vgs(raw_vgs))
+
+    @staticmethod
+    def seqnos(vgs):
+        return dict((name, vg["vg_seqno"]) for name, vg in vgs.items())
+
+    @classmethod
+    def load_cache(cls, seqnos, now=None):
+        """Returns the cached LVs if the VGs did not change since then
+
+        >>> import tempfile
+        >>> LvmState.cache_file = tempfile.mktemp()
+        >>> lvs = {"hostvg/pool": {"lv_name": "pool", "data_percent": "1"}}
+        >>> LvmState.store_cache({"hostvg": "7"}, lvs, now=100)
+        >>> LvmState.load_cache({"hostvg": "8"}, now=101) is None
+        True
+        >>> lv = LvmState.load_cache({"hostvg": "7"}, now=101)["hostvg/pool"]
+        >>> sorted(lv.items())
+        [('data_percent', '1'), ('lv_name', 'pool')]
+        >>> LvmState.load_cache({"hostvg": "7"}, now=200)["hostvg/pool"]
+        {'lv_name': 'pool'}
+        >>> os.unlink(LvmState.cache_file)
+        >>> LvmState.cache_file = constants.IMGBASED_LVM_STATE_CACHE
+        """
+        try:
+            with open(cls.cache_file) as src:
+                cache = json.load(src)
+        except (IOError, OSError, ValueError):
+            return None
+        if cache.get("seqnos") != seqnos:
+            log.debug("LVM state cache is outdated")
+            return None
+        lvs = cache["lvs"]
+        now = now or time.time()
+        if now - cache["written"] > cls.usage_ttl:
+            for lv in lvs.values():
+                for field in cls.usage_fields:
+                    lv.pop(field, None)
+        log.debug("Using the LVM state cache")
+        return lvs
+
+    @classmethod
+    def store_cache(cls, seqnos, lvs, now=None):
+        cache = {"seqnos": seqnos,
+                 "written": now or time.time(),
+                 "lvs": lvs}
+        dirname = os.path.dirname(cls.cache_file)
+        tmpfile = cls.cache_file + ".%d" % os.getpid()
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+            with os.fdopen(fd, "w") as dst:
+                json.dump(cache, dst)
+            # Readers see the old or the new cache, never a partial one
+            os.rename(tmpfile, cls.cache_file)
+        except (IOError, OSError):
+            log.debug("Failed to write the LVM state cache", exc_info=True)
+
+    @classmethod
+    def fetch(cls):
+        args = ["--reportformat", "json", "--ignoreskippedcluster",
+                "--units", "b", "--nosuffix"]
+        vgs = cls._parse_vgs(LVM._vgs(args + ["-o",
+                                              ",".join(cls.vg_fields)]))
+        seqnos = cls.seqnos(vgs)
+        lvs = cls.load_cache(seqnos)
+        if lvs is None:
+            lvs = cls._parse_lvs(LVM._lvs(args + ["-o",
+                                                  ",".join(cls.lv_fields)]))
+            cls.store_cache(seqnos, lvs)
+        return cls(lvs, vgs)
+
+    @classmethod
+    def current(cls):
+        """Returns the current snapshot, or None if it can not be used
+        """
+        with cls._lock:
+            if cls._current is None and not cls._disabled:
+                try:
+                    cls._current = cls.fetch()
+                except Exception:
+                    log.debug("Failed to fetch the LVM state, falling back "
+                              "to single queries", exc_info=True)
+                    cls._disabled = True
+            return cls._current
+
+    @classmethod
+    def invalidate(cls):
+        with cls._lock:
+            cls._current = None
+
+    def lv(self, lvm_name):
+        return self._lvs.get(lvm_name)
+
+    def vg(self, vg_name):
+        return self._vgs.get(vg_name)
+
+    def lvs(self):
+        return [self._lvs[k] for k in sorted(self._lvs)]
+
+    def lvs_with_tag(self, tag):
+        return [lv for lv in self.lvs() if tag in lv["lv_tags"].split(",")]
+
+    def vgs_with_tag(self, tag):
+        return [self._vgs[k] for k in sorted(self._vgs)
+                if tag in self._vgs[k]["vg_tags"].split(",")]
+
+
+class DeviceMapper(object):
+    """Resolve LVs from the device-mapper information in sysfs
+
+    The kernel is exposing the dm name and uuid of a block device in
+    /sys/dev/block/<major>:<minor>/dm/, this can be used to find the LV
+    of a device node or mount point without calling lvs.
+    """
+    sysfs = "/sys/dev/block"
+
+    @staticmethod
+    def split_name(dm_name):
+        """Split a dm name into VG, LV and layer, LVM is escaping the
+        dashes in the names by doubling them
+
+        >>> DeviceMapper.split_name("hostvg-Image--1.0--0+1")
+        ['hostvg', 'Image-1.0-0+1', '']
+        >>> DeviceMapper.split_name("host--vg-pool00-tpool")
+        ['host-vg', 'pool00', 'tpool']
+        >>> DeviceMapper.split_name("rhel-root")
+        ['rhel', 'root', '']
+        """
+        parts = [""]
+        i = 0
+        while i < len(dm_name):
+            if dm_name[i:i + 2] == "--":
+                parts[-1] += "-"
+                i += 2
+            elif dm_name[i] == "-":
+                parts.append("")
+                i += 1
+            else:
+                parts[-1] += dm_name[i]
+                i += 1
+        return (parts + ["", ""])[:3]
+
+    @staticmethod
+    def join_name(vg_name, lv_name, layer=None):
+        """The dm name of an LV (or one of it's internal layers)
+
+        >>> DeviceMapper.join_name("host-vg", "pool00", "tpool")
+        'host--vg-pool00-tpool'
+        >>> DeviceMapper.join_name("hostvg", "pool00_tmeta")
+        'hostvg-pool00_tmeta'
+        """
+        parts = [vg_name, lv_name] + ([layer] if layer else [])
+        return "-".join(p.replace("-", "--") for p in parts)
+
+    @classmethod
+    def _read(cls, devnum, name):
+        path = os.path.join(cls.sysfs, "%d:%d" % devnum, "dm", name)
+        try:
+            with open(path) as src:
+                return src.read().strip()
+        except (IOError, OSError):
+            return None
+
+    @classmethod
+    def lv_names_for_devnum(cls, devnum):
+        """Returns (vg_name, lv_name) of a (major, minor) device number,
+        or None if it's not the top-level device of an LV
+        """
+        uuid = cls._read(devnum, "uuid")
+        # LVM-<vg uuid><lv uuid>, internal devices have a -<layer> suffix
+        if not uuid or not uuid.startswith("LVM-") or "-" in uuid[4:]:
+            return None
+        name = cls._read(devnum, "name")
+        if not name:
+            return None
+        vg_name, lv_name, layer = cls.split_name(name)
+        if layer:
+            return None
+        return (vg_name, lv_name)
+
+    @classmethod
+    def lv_names_for_path(cls, path):
+        """Returns (vg_name, lv_name) for a device node or a mount point
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if stat.S_ISBLK(st.st_mode):
+            devnum = st.st_rdev
+        elif os.path.ismount(path):
+            devnum = st.st_dev
+        else:
+            return None
+        return cls.lv_names_for_devnum((os.major(devnum),
+                                        os.minor(devnum)))
+
+
+def _invalidates_state(func, udevsync=True):
+    """Wrap LVM commands which are changing the metadata, to drop the state
+
+    Inside of a LvmTransaction the commands are run without archive,
+    backup and (if supported by the command) udev synchronization.
+    """
+    def wrapper(args, **kwargs):
+        transaction = LvmTransaction.active()
+        if transaction:
+            args = transaction.arguments(args, udevsync)
+        try:
+            return func(args, **kwargs)
+        finally:
+            LvmState.invalidate()
+    return staticmethod(wrapper)
+
+
+class LvmTransaction(object):
+    """Defer the metadata archive, backup and udev sync of LVM commands
+
+    Every metadata change is archiving the old and backing up the new
+    metadata under /etc/lvm, and is waiting for udev to process the
+    device changes.
+    Inside of a transaction the metadata is archived once before the
+    first change, the changes are run without archive, backup and udev
+    sync, and when the transaction ends one vgcfgbackup and one udev
+    settle are done.
+    Device nodes of LVs are settled on demand, when LV.path or
+    LV.dm_path is used inside of the transaction.
+
+    Transactions can be nested, only the outermost one is committed.
+
+    >>> t = LvmTransaction()
+    >>> t.arguments(["--addtag", "foo", "hostvg/root"], True)
+    ['--addtag', 'foo', 'hostvg/root', '--config', \
+'backup {archive=0 backup=0}', '--noudevsync']
+    >>> t.arguments(["hostvg", "/dev/sda"], False)
+    ['hostvg', '/dev/sda', '--config', 'backup {archive=0 backup=0}']
+
+    LVM accepts only one --config, an existing one is extended:
+
+    >>> t.arguments(["--config", "config {profile_dir=/tmp}", "lv"], False)
+    ['--config', 'config {profile_dir=/tmp} backup {archive=0 backup=0}', \
+'lv']
+    >>> t.commits
+    3
+    """
+    config = "backup {archive=0 backup=0}"
+    archive_file = "/etc/lvm/archive/%s_imgbased-{}.vg"
+
+    _current = None
+    _lock = threading.Lock()
+
+    owner = False
+
+    def __init__(self):
+        self.commits = 0
+        self.archived = False
+        self.unsettled = False
+        self.started = None
+        self.elapsed = 0.0
+        self.archive_time = 0.0
+        self.backup_time = 0.0
+        self.settle_time = 0.0
+
+    @classmethod
+    def active(cls):
+        return cls._current
+
+    @classmethod
+    def settle_devices(cls):
+        """Wait for udev if commands without udev sync were run
+        """
+        transaction = cls._current
+        if transaction and transaction.unsettled:
+            transaction.settle()
+
+    def arguments(self, args, udevsync):
+        with self._lock:
+            if self._current is self and not self.archived:
+                self.archive()
+            self.commits += 1
+            self.unsettled = self.unsettled or udevsync
+        args = list(args)
+        if "--config" in args:
+            idx = args.index("--config") + 1
+            args[idx] = "%s %s" % (args[idx], self.config)
+        else:
+            args += ["--config", self.config]
+        if udevsync:
+            args.append("--noudevsync")
+        return args
+
+    def _timed(self, func, args):
+        started = time.time()
+        try:
+            func(args)
+        except Exception:
+            log.warn("Failed to run %s %s" % (func, args), exc_info=True)
+        return time.time() - started
+
+    def archive(self):
+        """Archive the metadata once, before the first change
+        """
+        self.archived = True
+        path = self.archive_file.format(time.strftime("%Y%m%d%H%M%S"))
+        self.archive_time = self._timed(LVM._vgcfgbackup, ["--file", path])
+
+    def settle(self):
+        self.unsettled = False
+        self.settle_time += self._timed(ExternalBinary().udevadm,
+                                        ["settle"])
+
+    def commit(self):
+        if self.commits:
+            self.backup_time = self._timed(LVM._vgcfgbackup, [])
+            self.settle()
+        self.elapsed = time.time() - self.started
+        log.info(self.summary())
+
+    def saved(self):
+        """Estimated time saved, assuming every commit would have cost
+        an archive and a backup, like the ones done by the transaction
+        """
+        per_commit = self.archive_time + self.backup_time
+        return max(0.0, (self.commits - 1) * per_commit)
+
+    def summary(self):
+        return ("LVM transaction: %d metadata commits in %.2fs, "
+                "1 archive/backup instead of %d (%.2fs), "
+                "udev settled in %.2fs, ~%.2fs saved" %
+                (self.commits, self.elapsed, self.commits,
+                 self.archive_time + self.backup_time, self.settle_time,
+                 self.saved()))
+
+    def __enter__(self):
+        with self._lock:
+            if LvmTransaction._current is None:
+                LvmTransaction._current = self
+                self.owner = True
+                self.started = time.time()
+        return LvmTransaction._current
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if not self.owner:
+            return
+        with self._lock:
+            LvmTransaction._current = None
+        self.commit()
+
+
 class LVM(object):
     _lvs = LvmCLI.lvs
     _vgs = LvmCLI.vgs
-    _lvcreate = LvmCLI.lvcreate
-    _lvchange = LvmCLI.lvchange
-    _lvremove = LvmCLI.lvremove
-    _lvrename = LvmCLI.lvrename
-    _lvextend = LvmCLI.lvextend
-    _vgcreate = LvmCLI.vgcreate
-    _vgchange = LvmCLI.vgchange
+    _lvcreate = _invalidates_state(LvmCLI.lvcreate)
+    _lvchange = _invalidates_state(LvmCLI.lvchange)
+    _lvremove = _invalidates_state(LvmCLI.lvremove)
+    _lvrename = _invalidates_state(LvmCLI.lvrename)
+    _lvextend = _invalidates_state(LvmCLI.lvextend)
+    _vgcreate = _invalidates_state(LvmCLI.vgcreate, udevsync=False)
+    _vgchange = _invalidates_state(LvmCLI.vgchange)
+    _vgcfgbackup = LvmCLI.vgcfgbackup
     _lvmconfig = LvmCLI.lvmconfig
     _volume_registry = []
 
@@ -67,12 +486,51 @@ class LVM(object):
         log.debug("All LV names: %s" % names)
         return names
 
+    @staticmethod
+    def transaction():
+        """Group metadata changes, see LvmTransaction
+        """
+        return LvmTransaction()
+
     @classmethod
     def list_lvs(cls, filtr=""):
-        lvs = [cls.LV.from_lvm_name(n) for n in cls._list_lv_full_names(filtr)]
+        state = None if filtr else LvmState.current()
+        if state:
+            names = ["%s/%s" % (lv["vg_name"], lv["lv_name"])
+                     for lv in state.lvs()]
+        else:
+            names = cls._list_lv_full_names(filtr)
+        lvs = [cls.LV.from_lvm_name(n) for n in names]
         log.debug("All LVS: %s" % lvs)
         return lvs
 
+    @classmethod
+    def list_lvs_with_tags(cls, any_tag=None):
+        """Returns (LV, tags) tuples of the LVs with any of the given tags,
+        retrieved from the LVM state or with a single lvs call
+        """
+        state = LvmState.current()
+        if state:
+            lvs = [(cls.LV.from_lv_name(lv["vg_name"], lv["lv_name"]),
+                    lv["lv_tags"].split(","))
+                   for lv in state.lvs()]
+            return [(lv, tags) for lv, tags in lvs
+                    if any_tag is None or set(any_tag) & set(tags)]
+
+        filtr = " || ".join("lv_tags = %s" % tag for tag in any_tag or [])
+        sep = "$"
+        cmd = ["--noheadings", "--ignoreskippedcluster", "--separator", sep,
+               "-o", "vg_name,lv_name,lv_tags"]
+        if filtr:
+            cmd += ["--select", filtr]
+        lvs = []
+        for line in cls._lvs(cmd).splitlines():
+            vg_name, lv_name, tags = line.strip().split(sep)
+            lvs.append((cls.LV.from_lv_name(vg_name, lv_name),
+                        tags.split(",")))
+        log.debug("LVs with tags: %s" % lvs)
+        return sorted(lvs, key=lambda lv_tags: lv_tags[0].lvm_name)
+
     @staticmethod
     def is_name_valid(name):
         """Taken from blivet
@@ -105,27 +563,187 @@ class LVM(object):
         return vol
 
     @staticmethod
-    def reset_registered_volumes():
+    def _removal_waves(names, origins):
+        """Group LVs into waves which can be removed concurrently, an LV
+        is only removed after all the LVs which have it as origin
+
+        >>> names = ["vg/Image-1.0-0", "vg/Image-1.0-0+1", "vg/Foo"]
+        >>> origins = {"vg/Image-1.0-0+1": "vg/Image-1.0-0"}
+        >>> LVM._removal_waves(names, origins)
+        [['vg/Image-1.0-0+1', 'vg/Foo'], ['vg/Image-1.0-0']]
+        """
+        waves = []
+        remaining = list(names)
+        while remaining:
+            blocked = set(origins.get(name) for name in remaining)
+            wave = [name for name in remaining if name not in blocked]
+            # A cycle can not happen, but never loop forever
+            wave = wave or remaining
+            waves.append(wave)
+            remaining = [name for name in remaining if name not in wave]
+        return waves
+
+    @staticmethod
+    def _remove_waves(waves):
+        """Remove the LVs of every wave with one lvremove, the LVs of a VG
+        are serialized on the VG lock anyway
+        """
+        for wave in waves:
+            started = time.time()
+            try:
+                LVM._lvremove(["-ff"] + wave)
+                log.info("Removed LVs %s in %.2fs" %
+                         (wave, time.time() - started))
+            except subprocess.CalledProcessError as e:
+                log.warn("Failed to remove LVs %s (exit status %s)" %
+                         (wave, e.returncode))
+            except Exception:
+                log.warn("Failed to remove LVs %s" % wave, exc_info=True)
+
+    @staticmethod
+    def _remove_in_background(waves):
+        """The removal of big thin LVs can take long, it is run in a thread
+        while the caller continues, a wave after the other
+        """
+        log.info("Removing LVs in the background: %s" % waves)
+        runner = ThreadRunner(LVM._remove_waves, waves)
+        threaded = not os.getenv("IMGBASED_DISABLE_THREADS")
+        getattr(runner, "start" if threaded else "run")()
+        return runner
+
+    @staticmethod
+    def reset_registered_volumes(background=False):
+        """Unmount and remove all volumes created by this process
+
+        The filesystems are synced (syncfs) and unmounted first, then
+        the LVs are removed layers before bases, LVs which do not depend
+        on each other are removed by the same lvremove call.
+        With background the removal runs in a thread.
+        """
         if os.getenv("IMGBASED_KEEP_VOLUMES"):
             return
         run = ExternalBinary()
-        run.sync([])
+        started = time.time()
+        lvs = dict((lv.lvm_name, lv) for lv in LVM._volume_registry)
         mtab = dict([itemgetter(9, 4)(m.split())
                      for m in open("/proc/self/mountinfo")])
-        for lv in LVM._volume_registry:
-            target = mtab.get(lv.dm_path)
-            if target:
+        targets = [mtab.get(lv.dm_path) for lv in lvs.values()]
+        # Nested mounts first
+        for target in sorted(filter(None, targets), reverse=True):
+            try:
+                run.sync(["--file-system", target])
+            except Exception:
+                log.debug("Failed to sync %s", target, exc_info=True)
+            try:
                 run.umount([target])
+            except Exception:
+                log.debug("Failed to unmount %s", target, exc_info=True)
+
+        origins = {}
+        for name, lv in lvs.items():
             try:
-                lv.remove(force=True)
+                origin = lv.options(["origin"]).pop().strip()
+                if origin:
+                    origins[name] = "%s/%s" % (lv.vg_name, origin)
             except Exception:
-                log.debug("Failed removing LV [%s], skipping", lv.dm_path)
+                log.debug("Failed to get the origin of %s", name,
+                          exc_info=True)
+        waves = LVM._removal_waves(sorted(lvs), origins)
+        log.debug("Removing registered LVs in waves: %s" % waves)
+
+        if background:
+            LVM._remove_in_background(waves)
+        else:
+            LVM._remove_waves(waves)
+        LVM._volume_registry = []
+        log.info("Registered LVs were reset in %.2fs" %
+                 (time.time() - started))
+
+    @staticmethod
+    def remove_lvs(lvs, force=False):
+        """Deactivate and remove several LVs with one lvchange and one
+        lvremove
+        """
+        names = [lv.lvm_name for lv in lvs]
+        if not names:
+            return
+        LVM._lvchange(["--activate", "n"] + names)
+        LVM._lvremove((["-ff"] if force else []) + names)
 
     @staticmethod
     def stop_monitoring():
         LVM._vgchange(["--monitor", "n"])
         ExternalBinary().pkill(["dmeventd"])
 
+    class Changes(object):
+        """Collects pending attribute changes of an LV
+
+        Every lvchange is a metadata commit of it's own. The collected
+        changes are applied with a single lvchange, or are passed to the
+        lvcreate call which is creating the LV.
+
+        >>> changes = LVM.Changes().addtag("imgbased:layer")
+        >>> changes = changes.setactivationskip(False).activate(True, True)
+        >>> changes.arguments()
+        ['--setactivationskip', 'n', '--addtag', 'imgbased:layer', \
+'--activate', 'y', '--ignoreactivationskip']
+
+        >>> LVM.Changes().permission("r").activate(False).arguments()
+        ['--permission', 'r', '--activate', 'n']
+
+        >>> LVM.Changes().arguments()
+        []
+        """
+        perm = None
+        activationskip = None
+        active = None
+        ignoreactivationskip = False
+        tags = None
+
+        def __init__(self):
+            self.tags = []
+
+        def __repr__(self):
+            return "<Changes %s />" % self.arguments()
+
+        def permission(self, val):
+            assert val in ["r", "rw"]
+            self.perm = val
+            return self
+
+        def setactivationskip(self, val):
+            assert val in [True, False]
+            self.activationskip = val
+            return self
+
+        def addtag(self, tag):
+            self.tags.append(tag)
+            return self
+
+        def activate(self, val, ignoreactivationskip=False):
+            assert val in [True, False]
+            self.active = val
+            self.ignoreactivationskip = ignoreactivationskip
+            return self
+
+        def arguments(self, with_permission=True):
+            def yn(val):
+                return "y" if val else "n"
+
+            args = []
+            if self.perm is not None and with_permission:
+                args += ["--permission", self.perm]
+            if self.activationskip is not None:
+                args += ["--setactivationskip", yn(self.activationskip)]
+            for tag in self.tags:
+                args += ["--addtag", tag]
+            if self.active is not None:
+                # Activation is always processed last by lvchange
+                args += ["--activate", yn(self.active)]
+                if self.ignoreactivationskip:
+                    args.append("--ignoreactivationskip")
+            return args
+
     class VG(object):
         vg_name = None
 
@@ -142,6 +760,10 @@ class LVM(object):
 
         @staticmethod
         def find_by_tag(tag):
+            state = LvmState.current()
+            if state:
+                return [LVM.VG(vg["vg_name"])
+                        for vg in state.vgs_with_tag(tag)]
             vgs = LVM._vgs(["--noheadings", "--ignoreskippedcluster",
                             "--select", "vg_tags = %s" % tag, "-o", "vg_name"])
             return [LVM.VG(vg_name.strip()) for vg_name in vgs.splitlines()]
@@ -165,9 +787,28 @@ class LVM(object):
             LVM._vgchange(["--addtag", tag, self.vg_name])
 
         def tags(self):
+            report = self.report()
+            if report:
+                return report["vg_tags"].split(",")
             return LVM._vgs(["--noheadings", "--ignoreskippedcluster",
                              "-ovg_tags", self.vg_name]).split(",")
 
+        def report(self):
+            """The report fields of this VG from the LVM state, if available
+            """
+            state = LvmState.current()
+            return state.vg(self.vg_name) if state else None
+
+        def free_bytes(self):
+            report = self.report()
+            if report:
+                free = report["vg_free"]
+            else:
+                free = LVM._vgs(["--noheadings", "--ignoreskippedcluster",
+                                 "--nosuffix", "-o", "vg_free",
+                                 "--units", "b", self.vg_name])
+            return int(float(free.strip().replace(",", ".")))
+
     class LV(object):
         vg_name = None
         lv_name = None
@@ -180,19 +821,36 @@ class LVM(object):
 
         @property
         def path(self):
+            LvmTransaction.settle_devices()
+            report = self.report()
+            if report:
+                return report["lv_path"]
             return LVM._lvs(["--noheadings", "--ignoreskippedcluster",
                              "-olv_path", self.lvm_name])
 
         @property
         def dm_path(self):
+            LvmTransaction.settle_devices()
+            report = self.report()
+            if report:
+                return report["lv_dm_path"]
             return LVM._lvs(["--noheadings", "--ignoreskippedcluster",
                              "-olv_dm_path", self.lvm_name])
 
         @property
         def size_bytes(self):
+            report = self.report()
+            if report:
+                return "%sB" % report["lv_size"]
             return LVM._lvs(["--noheadings", "--ignoreskippedcluster",
                              "-osize", "--units", "B", self.lvm_name])
 
+        def report(self):
+            """The report fields of this LV from the LVM state, if available
+            """
+            state = LvmState.current()
+            return state.lv(self.lvm_name) if state else None
+
         @classmethod
         def from_lv_name(cls, vg_name, lv_name):
             lv = cls()
@@ -210,7 +868,7 @@ class LVM(object):
             if mixed.startswith("/dev"):
                 return cls.from_path(mixed)
             elif os.path.ismount(mixed):
-                return cls.from_path(find_mount_source(mixed))
+                return cls.from_path(mixed)
             elif "/" in mixed:
                 return cls.from_lvm_name(mixed)
             elif "@" in mixed:
@@ -220,6 +878,10 @@ class LVM(object):
 
         @classmethod
         def find_by_tag(cls, tag):
+            state = LvmState.current()
+            if state:
+                return [cls.from_lv_name(lv["vg_name"], lv["lv_name"])
+                        for lv in state.lvs_with_tag(tag)]
             lvs = LVM._vgs(["--noheadings", "--ignoreskippedcluster",
                             "@%s" % tag, "-o", "lv_full_name"])
             return [cls.from_lvm_name(lv.strip())
@@ -245,8 +907,14 @@ class LVM(object):
 
         @classmethod
         def from_path(cls, path):
-            """Get an object for the path
+            """Get an object for the path of a device node or mount point
             """
+            names = DeviceMapper.lv_names_for_path(path)
+            if names:
+                log.debug("Found LV for path %s in sysfs: %s" % (path, names))
+                return cls.from_lv_name(*names)
+            if os.path.ismount(path):
+                path = find_mount_source(path)
             data = LVM._lvs(["--noheadings", "--ignoreskippedcluster",
                              "-ovg_name,lv_name", path])
             data = data.strip()
@@ -255,14 +923,23 @@ class LVM(object):
             assert len(data.splitlines()) == 1
             return cls.from_lv_name(*shlex.split(data))
 
-        def create_snapshot(self, new_name):
+        def create_snapshot(self, new_name, changes=None):
+            """Create a snapshot, changes are applied at creation time
+            """
             assert LVM.is_name_valid(new_name)
+            args = changes.arguments() if changes else []
             LVM._lvcreate(["--snapshot",
-                           "--name", new_name,
-                           self.lvm_name])
+                           "--name", new_name] +
+                          args +
+                          [self.lvm_name])
             vol = LVM.LV.from_lv_name(self.vg_name, new_name)
             return LVM.register_volume(vol)
 
+        def resize(self, size):
+            """Grow the LV to size
+            """
+            LVM._lvextend(["--size", size, self.lvm_name])
+
         def remove(self, force=False):
             cmd = ["-ff"] if force else []
             cmd.append(self.lvm_name)
@@ -286,17 +963,28 @@ class LVM(object):
             LVM._lvchange(["--setactivationskip", val,
                            self.lvm_name])
 
-        def permission(self, val):
+        def has_permission(self, val):
             assert val in ["r", "rw"]
             attr = val if val == "r" else "w"
-            perm = LVM._lvs(["--noheadings", "-oattr", self.lvm_name])[1]
-            if perm == attr:
+            return self.options(["lv_attr"])[0][1] == attr
+
+        def permission(self, val):
+            if self.has_permission(val):
                 return
             LVM._lvchange(["--permission", val, self.lvm_name])
 
+        def change(self, changes):
+            """Apply all collected changes with one lvchange
+            """
+            # lvchange fails if the permission is already set
+            with_permission = changes.perm is not None and \
+                not self.has_permission(changes.perm)
+            args = changes.arguments(with_permission)
+            if args:
+                LVM._lvchange(args + [self.lvm_name])
+
         def thinpool(self):
-            pool_lv = LVM._lvs(["--noheadings", "--ignoreskippedcluster",
-                                "-opool_lv", self.lvm_name])
+            pool_lv = self.options(["pool_lv"]).pop()
             lv = None
             if pool_lv:
                 lv = LVM.LV.from_lv_name(self.vg_name, pool_lv)
@@ -313,8 +1001,7 @@ class LVM(object):
             LVM._lvchange(["--addtag", tag, self.lvm_name])
 
         def tags(self):
-            return LVM._lvs(["--noheadings", "--ignoreskippedcluster",
-                             "-olv_tags", self.lvm_name]).split(",")
+            return self.options(["lv_tags"]).pop().split(",")
 
         def origin(self):
             lv_name = self.options(["origin"]).pop()
@@ -328,6 +1015,9 @@ class LVM(object):
             LVM._lvchange(args + ["--metadataprofile", name, self.lvm_name])
 
         def options(self, options):
+            report = self.report()
+            if report and all(o in report for o in options):
+                return [report[o] for o in options]
             sep = "$"
             cmd = ["--noheadings",
                    "--ignoreskippedcluster",
@@ -337,14 +1027,14 @@ class LVM(object):
             return LVM._lvs(cmd).strip().split(sep)
 
         def protect(self):
-            self.permission("r")
-            self.setactivationskip(True)
-            self.activate(False, True)
+            self.change(LVM.Changes().permission("r")
+                        .setactivationskip(True)
+                        .activate(False, True))
 
         def unprotect(self):
-            self.permission("rw")
-            self.setactivationskip(False)
-            self.activate(True, True)
+            self.change(LVM.Changes().permission("rw")
+                        .setactivationskip(False)
+                        .activate(True, True))
 
         def unprotected(self):
             this = self
@@ -360,25 +1050,152 @@ class LVM(object):
             return UnprotectedBase()
 
     class Thinpool(LV):
-        def create_thinvol(self, vol_name, volsize):
+        def create_thinvol(self, vol_name, volsize, changes=None):
+            """Create a thin volume, changes are applied at creation time
+            """
             assert LVM.is_name_valid(vol_name)
             vol = LVM.LV.from_lv_name(self.vg_name, vol_name)
+            args = changes.arguments() if changes else []
             LVM._lvcreate(["--thin",
                            "--virtualsize", volsize,
-                           "--name", vol.lv_name,
-                           self.lvm_name])
+                           "--name", vol.lv_name] +
+                          args +
+                          [self.lvm_name])
             return LVM.register_volume(vol)
 
+        def usage(self, cached=True):
+            """Returns the data and metadata size (in bytes) and usage
+            (in percent) of the pool
+
+            The usage is changing with every write to the thin LVs, use
+            cached=False to get the usage of this moment instead of the
+            one from the LVM state.
+            """
+            fields = ["lv_size", "data_percent",
+                      "lv_metadata_size", "metadata_percent"]
+            report = self.report() if cached else None
+            if report and all(f in report for f in fields):
+                values = [report[f] for f in fields]
+            else:
+                sep = "$"
+                values = LVM._lvs(["--noheadings", "--ignoreskippedcluster",
+                                   "--nosuffix", "--units", "b",
+                                   "--separator", sep,
+                                   "-o", ",".join(fields),
+                                   self.lvm_name]).strip().split(sep)
+            return dict(zip(fields, [float(v.replace(",", "."))
+                                     for v in values]))
+
+        def provisioning(self):
+            """Returns if new chunks are zeroed, and the chunk size (in
+            bytes), the unit in which the pool is provisioning blocks
+            """
+            sep = "$"
+            zero, chunk_size = LVM._lvs(["--noheadings",
+                                         "--ignoreskippedcluster",
+                                         "--nosuffix", "--units", "b",
+                                         "--separator", sep,
+                                         "-o", "zero,chunk_size",
+                                         self.lvm_name]).strip().split(sep)
+            return (zero.strip() == "zero", int(chunk_size))
+
+        def thin_ids(self):
+            """Returns the thin LVs of the pool by their thin device id
+            """
+            state = LvmState.current()
+            if state:
+                lvs = [(lv["lv_name"], lv.get("thin_id"))
+                       for lv in state.lvs()
+                       if lv["vg_name"] == self.vg_name and
+                       lv["pool_lv"] == self.lv_name]
+            else:
+                sep = "$"
+                raw = LVM._lvs(["--noheadings", "--ignoreskippedcluster",
+                                "--separator", sep,
+                                "-o", "lv_name,thin_id",
+                                "--select", "pool_lv = %s" % self.lv_name,
+                                self.vg_name])
+                lvs = [line.strip().split(sep) for line in raw.splitlines()]
+            return dict((int(thin_id), lv_name) for lv_name, thin_id in lvs
+                        if thin_id)
+
+        def thin_usage(self):
+            """Returns the mapped, exclusive and shared bytes of the thin
+            LVs in the pool
+
+            The pool metadata is read with thin_ls from a metadata snapshot,
+            which is reserved for the time of the reading.
+            """
+            run = ExternalBinary()
+            tpool = DeviceMapper.join_name(self.vg_name, self.lv_name,
+                                           "tpool")
+            if not os.path.exists("/dev/mapper/" + tpool):
+                # Pools without thin LVs have no -tpool layer
+                tpool = DeviceMapper.join_name(self.vg_name, self.lv_name)
+            tmeta = "/dev/mapper/" + DeviceMapper.join_name(
+                self.vg_name, self.lv_name + "_tmeta")
+
+            run.dmsetup(["message", tpool, "0", "reserve_metadata_snap"])
+            try:
+                raw = run.thin_ls(["--metadata-snap", "--no-headers",
+                                   "-o", "DEV,MAPPED_BYTES,EXCLUSIVE_BYTES,"
+                                   "SHARED_BYTES", tmeta])
+            finally:
+                run.dmsetup(["message", tpool, "0", "release_metadata_snap"])
+
+            thin_ids = self.thin_ids()
+            usage = {}
+            for line in raw.splitlines():
+                dev, mapped, exclusive, shared = map(int, line.split())
+                if dev in thin_ids:
+                    usage[thin_ids[dev]] = {"mapped": mapped,
+                                            "exclusive": exclusive,
+                                            "shared": shared}
+            log.debug("Thin usage of %s: %s" % (self.lvm_name, usage))
+            return usage
+
+        def autoextend_threshold(self):
+            """The thin_pool_autoextend_threshold which applies to the pool,
+            100 means that autoextension is disabled
+            """
+            profile = self.profile()
+            args = ["--metadataprofile", profile] if profile else []
+            args += ["--type", "full",
+                     "activation/thin_pool_autoextend_threshold"]
+            return int(LVM._lvmconfig(args).split("=")[1])
+
         def _get_metadata_size(self):
+            report = self.report()
+            if report and "metadata_percent" in report:
+                return [float(report["metadata_percent"]),
+                        float(report["lv_metadata_size"]) / 1024 ** 2]
             args = ["--noheadings", "--ignoreskippedcluster", "--nosuffix",
                     "--units", "m", "-o", "metadata_percent,lv_metadata_size",
                     self.lvm_name]
             return map(float, LVM._lvs(args).split())
 
+        def extend(self, data_bytes=0, metadata_bytes=0):
+            """Grow the data and metadata of the pool, as far as the free
+            space in the VG allows, returns the added bytes
+            """
+            mb = 1024 ** 2
+            free_mb = LVM.VG(self.vg_name).free_bytes() // mb
+            added_mb = 0
+            for option, size in [("--poolmetadatasize", metadata_bytes),
+                                 ("--size", data_bytes)]:
+                size_mb = min(-(-int(size) // mb), free_mb - added_mb)
+                if size_mb <= 0:
+                    continue
+                log.info("Extending %s of pool %s by %sM" %
+                         ("metadata" if option.endswith("metadatasize")
+                          else "data", self.lvm_name, size_mb))
+                LVM._lvextend([option, "+{}m".format(size_mb),
+                               self.lvm_name])
+                added_mb += size_mb
+            return added_mb * mb
+
         def _resize_metadata(self, x_size_mb):
-            free = float(LVM._vgs(["--noheading", "--ignoreskippedcluster",
-                                   "--nosuffix", "-o", "free",
-                                   "--units", "m", self.vg_name]))
+            free = LVM.VG(self.vg_name).free_bytes() / 1024 ** 2
             if x_size_mb <= free:
                 args = ["--poolmetadatasize", "+{}m".format(x_size_mb),
                         self.lvm_name]
@@ -23,58 +23,206 @@
 
 import logging
 import re
-import rpm
 
+from bisect import bisect_left
 from functools import total_ordering
 
 log = logging.getLogger(__package__)
 
 
+_version_token = re.compile("([0-9]+)|([a-zA-Z]+)|(~)|(\\^)")
+_version_keys = {}
+
+
+def version_key(version):
+    """Returns a key which sorts like rpmvercmp compares
+
+    The version is split into tokens, separators are dropped. The tokens
+    are ranked, so that a tuple comparison gives the result of rpmvercmp:
+    tilde < end of version < caret < alpha < numeric
+
+    >>> version_key("1.0a~rc^git")
+    ((3, 1), (3, 0), (2, 'a'), (-1,), (2, 'rc'), (1,), (2, 'git'), (0,))
+    >>> version_key("1.0~rc") < version_key("1.0") < version_key("1.0^")
+    True
+    >>> version_key("1.0") == version_key("1_0")
+    True
+    """
+    try:
+        return _version_keys[version]
+    except KeyError:
+        pass
+    key = []
+    for num, alpha, tilde, caret in _version_token.findall(version):
+        if num:
+            key.append((3, int(num)))
+        elif alpha:
+            key.append((2, alpha))
+        elif tilde:
+            key.append((-1,))
+        else:
+            key.append((1,))
+    key.append((0,))
+    key = tuple(key)
+    if len(_version_keys) > 4096:
+        _version_keys.clear()
+    _version_keys[version] = key
+    return key
+
+
+def rpmvercmp(a, b):
+    """A pure python version of rpm's rpmvercmp
+
+    >>> rpmvercmp("1.0", "1.0")
+    0
+    >>> rpmvercmp("1.0", "2.0")
+    -1
+    >>> rpmvercmp("1.0a", "1.0")
+    1
+    >>> rpmvercmp("1.0~rc1", "1.0")
+    -1
+    """
+    ka, kb = version_key(a), version_key(b)
+    return (ka > kb) - (ka < kb)
+
+
+def label_compare(a, b):
+    """Compare (epoch, version, release) tuples like rpm.labelCompare
+
+    >>> label_compare((None, "1.2.3", "4.el6"), (None, "1.2.3", "5.el6"))
+    -1
+    """
+    for x, y in zip(a, b):
+        x, y = "" if x is None else str(x), "" if y is None else str(y)
+        ret = rpmvercmp(x, y)
+        if ret:
+            return ret
+    return 0
+
+
+def sort_key(img):
+    return (img.nvr.name,) + img.nvr.key
+
+
+class LayoutSnapshot(object):
+    """The layout as it was read once from the datasource, indexed
+
+    The images are kept by NVR, and the layers in one sorted array (with
+    the sort keys in a parallel array for bisecting).
+
+    >>> tree = NvrNaming(["Image-1-0", "Image-1-0+1", "Image-1-0+2",
+    ...                   "Image-2-0", "Image-2-0+1"]).tree()
+    >>> snapshot = LayoutSnapshot(tree, 0)
+    >>> snapshot.by_nvr["Image-1-0+2"]
+    <Layer Image-1-0+2 />
+    >>> snapshot.layer_before(Layer("Image-2-0+1"))
+    <Layer Image-1-0+2 />
+    """
+    def __init__(self, tree, generation):
+        self.tree = tree
+        self.generation = generation
+
+        self.bases = list(tree)
+        self.layers = sorted((layer for base in tree
+                              for layer in base.layers), key=sort_key)
+        self.layer_keys = [sort_key(layer) for layer in self.layers]
+        self.images = sorted(self.bases + self.layers, key=sort_key)
+        self.by_nvr = dict((str(img.nvr), img) for img in self.images)
+
+    def _layer_position(self, layer):
+        idx = bisect_left(self.layer_keys, sort_key(layer))
+        assert idx < len(self.layers) and self.layers[idx] == layer, \
+            "Layer not found: %s" % layer
+        return idx
+
+    def layer_before(self, layer):
+        # Like list.index, the first layer has the last one before it
+        return self.layers[self._layer_position(layer) - 1]
+
+
 class NamingScheme():
+    """The layout is read once from the datasource and kept in a snapshot,
+    all queries are answered from it until it is invalidated
+
+    The queries return copies of the bases and layers, changing them
+    does not change the snapshot.
+
+    >>> names = ["Image-1-0"]
+    >>> naming = NvrNaming(names)
+    >>> naming.bases()
+    [<Base Image-1-0 [] />]
+    >>> names.append("Image-1-0+1")
+    >>> naming.layers()
+    []
+    >>> naming.invalidate()
+    >>> naming.layers()
+    [<Layer Image-1-0+1 />]
+    >>> naming.bases()[0].layers.append(Layer("Image-1-0+2"))
+    >>> naming.bases()
+    [<Base Image-1-0 [<Layer Image-1-0+1 />] />]
+    """
     datasource = None
+    generation = 0
+    _snapshot = None
 
     def __init__(self, datasource):
         self.datasource = datasource
 
-    def tree(self):
-        """Returns an ordered list of bases and children
+    def invalidate(self):
+        """Drop the snapshot, needs to be called when images were added
+        or removed
         """
+        self.generation += 1
+
+    def snapshot(self):
+        if self._snapshot is None or \
+                self._snapshot.generation != self.generation:
+            self._snapshot = LayoutSnapshot(self._build_tree(),
+                                            self.generation)
+        return self._snapshot
+
+    def _build_tree(self, datasource=None):
         raise NotImplementedError
 
+    def tree(self, datasource=None):
+        """Returns an ordered list of bases and children
+
+        An explicit datasource is bypassing the snapshot
+        """
+        if datasource is not None:
+            return self._build_tree(datasource)
+        return [base.copy() for base in self.snapshot().tree]
+
     def images(self):
-        images = []
-        for base in self.bases():
-            images.append(base)
-            images.extend(base.layers)
-        return sorted(images)
+        bases = self.bases()
+        return sorted(bases + [layer for base in bases
+                               for layer in base.layers], key=sort_key)
 
     def bases(self):
-        bases = sorted(self.tree())
+        bases = [base.copy() for base in self.snapshot().bases]
         assert all(b.is_base() for b in bases)
         return bases
 
     def layers(self, for_base=None):
-        layers = []
-        for b in self.tree():
-            if for_base is None or (for_base and b == for_base):
-                layers.extend(b.layers)
-        return sorted(layers)
+        snapshot = self.snapshot()
+        if for_base is None:
+            return sorted((layer for base in self.bases()
+                           for layer in base.layers), key=sort_key)
+        base = snapshot.by_nvr.get(str(for_base.nvr))
+        return base.copy().layers if base else []
 
     def last_base(self):
-        bases = self.bases()
+        bases = self.snapshot().bases
         assert bases
-        return bases.pop()
+        return bases[-1].copy()
 
     def last_layer(self):
-        layers = self.layers()
+        layers = self.snapshot().layers
         assert layers
-        return layers.pop()
+        return layers[-1].copy()
 
     def layer_before(self, other_layer):
-        layers = self.layers()
-        assert other_layer in layers
-        oidx = layers.index(other_layer)
-        return layers[oidx-1]
+        return self.snapshot().layer_before(other_layer).copy()
 
     def suggest_next_layer(self, prev_img):
         """Determine the LV name of the next layer (based on the scheme)
@@ -86,8 +234,8 @@ class NamingScheme():
             log.debug("Suggesting for layer for base %s" % prev_img)
             if prev_img.layers:
                 log.debug("... with layers")
-                last_layer = sorted(prev_img.layers).pop()
-                next_index = int(last_layer.index) + 1
+                next_index = max(int(layer.index)
+                                 for layer in prev_img.layers) + 1
             else:
                 log.debug("... without layers")
                 next_index = 1
@@ -187,7 +335,7 @@ class NvrNaming(NamingScheme):
 Image-3-0\\n +- Image-3-0+1'
     """
 
-    def tree(self, datasource=None):
+    def _build_tree(self, datasource=None):
         """Returns a list of bases and children
         >>> layers = NvrNaming([])
         >>> layers.tree()
@@ -201,6 +349,8 @@ Image-3-0\\n +- Image-3-0+1'
         >>> layers.tree()
         [<Base Image-0-0 [] />, <Base Image-2-0 [<Layer Image-2-0+1 />] />, \
 <Base Image-13-0 [] />]
+        >>> layers.layers()[0].base
+        <Base Image-2-0 [<Layer Image-2-0+1 />] />
         """
         datasource = datasource or self.datasource
         if callable(datasource):
@@ -219,17 +369,19 @@ Image-3-0\\n +- Image-3-0+1'
 
         log.debug("Images: %s" % images)
         bases = {}
-        for img in sorted(images):
+        for img in sorted(images, key=sort_key):
             if img.is_base():
-                bases[img.nvr] = img
+                bases[str(img.nvr)] = img
             else:
-                bases[img.base.nvr].layers.append(img)
+                base = bases[str(img.nvr).rpartition(Image._sep)[0]]
+                base.layers.append(img)
+                img._base = base
         log.debug("Bases: %s" % bases.values())
 
         if len(bases.values()) == 0:
             raise RuntimeError("No bases found: %s" % names)
 
-        return list(sorted(bases.values()))
+        return sorted(bases.values(), key=sort_key)
 
 
 @total_ordering
@@ -260,37 +412,71 @@ class NVR(object):
     >>> sorted(lst)
     [<NVR package-1.2.3-4.el6 />, <NVR package-1.2.3-5.el6 />, \
 <NVR package-2.2.3-4.el6 />]
+
+    NVRs are immutable, so an NVR is reused instead of being copied:
+
+    >>> NVR.parse(nvr) is nvr
+    True
+    >>> nvr.name = "other"
+    Traceback (most recent call last):
+    ...
+    AttributeError: NVRs are immutable
     """
-    name = None
-    version = None
-    release = None
+    __slots__ = ("name", "version", "release", "_str", "_hash", "_key")
+
+    def __init__(self, name, version, release):
+        setattr_ = super(NVR, self).__setattr__
+        setattr_("name", name)
+        setattr_("version", version)
+        setattr_("release", release)
+        setattr_("_str", "%s-%s-%s" % (name, version, release))
+        setattr_("_hash", hash(self._str))
+        setattr_("_key", None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("NVRs are immutable")
+
+    @property
+    def key(self):
+        """The rpmvercmp compatible sort key of version and release,
+        computed once
+        """
+        if self._key is None:
+            super(NVR, self).__setattr__(
+                "_key", (version_key(self.version),
+                         version_key(self.release)))
+        return self._key
 
     @staticmethod
     def parse(nvr):
         if isinstance(nvr, NVR):
-            # If it's an NVR instance, re-parse to copy
-            return NVR.parse(str(nvr))
+            # Immutable, no need to copy
+            return nvr
 
         if not nvr.strip():
             raise RuntimeError("No NVR to parse: %s" % nvr)
-        o = NVR()
         try:
             nvrtuple = re.match("^(^.*)-([^-]*)-([^-]*)$", nvr).groups()
         except Exception:
             raise RuntimeError("Failed to parse NVR: %s" % nvr)
         if not nvrtuple:
             raise RuntimeError("No NVR found: %s" % nvr)
-        o.name, o.version, o.release = nvrtuple
-        return o
+        return NVR(*nvrtuple)
+
+    def with_release(self, release):
+        """The NVR with the same name and version, but another release
+
+        >>> NVR.parse("Image-1.0-0").with_release("0+1")
+        <NVR Image-1.0-0+1 />
+        """
+        return NVR(self.name, self.version, release)
 
     def _do_compare(self, other):
         assert type(self) == type(other), "%r vs %r" % (self, other)
         if not self.name == other.name:
             raise RuntimeError("NVRs for different names: %s %s"
                                % (self.name, other.name))
-        this_version = (None, self.version, self.release)
-        other_version = (None, other.version, other.release)
-        return rpm.labelCompare(this_version, other_version)
+        return (self.key > other.key) - (self.key < other.key)
 
     def __eq__(self, other):
         return (self._do_compare(other) == 0)
@@ -302,13 +488,13 @@ class NVR(object):
         return (self._do_compare(other) < 0)
 
     def __str__(self):
-        return "%s-%s-%s" % (self.name, self.version, self.release)
+        return self._str
 
     def __repr__(self):
-        return "<NVR %s />" % self
+        return "<NVR %s />" % self._str
 
     def __hash__(self):
-        return hash(str(self))
+        return self._hash
 
 
 @total_ordering
@@ -324,9 +510,10 @@ class Image(object):
     >>> Image.from_nvr("Image-1-2")
     <Base Image-1-2 [] />
     """
+    __slots__ = ("nvr",)
+
     _sep = "+"
     _re_is_lv_name = re.compile("^[a-zA-Z0-9_.+-]+$")
-    nvr = None
 
     @classmethod
     def from_nvr(cls, nvr):
@@ -395,7 +582,7 @@ class Base(Image):
     >>> Base("Image-0-0")
     <Base Image-0-0 [] />
     """
-    layers = None
+    __slots__ = ("layers",)
 
     def __init__(self, nvr, layers=None):
         assert self._sep not in str(nvr)
@@ -405,9 +592,18 @@ class Base(Image):
     def __repr__(self):
         return "<Base %s %s />" % (self.nvr, self.layers)
 
+    def copy(self):
+        """A copy of the base and its layers
+        """
+        base = Base(self.nvr)
+        base.layers = [layer._copy_for(base) for layer in self.layers]
+        return base
+
     def derive_layer(self, index):
-        nvr = "%s%s%s" % (self.nvr, self._sep, index)
-        return Layer(nvr)
+        layer = Layer(self.nvr.with_release("%s%s%s" % (self.nvr.release,
+                                                        self._sep, index)))
+        layer._base = self
+        return layer
 
 
 class Layer(Image):
@@ -429,7 +625,11 @@ class Layer(Image):
     >>> l.index = 1
     >>> l
     <Layer Image-0-0+1 />
+    >>> l.base
+    <Base Image-0-0 [] />
     """
+    __slots__ = ("_base",)
+
     @property
     def index(self):
         return str(self.nvr).rpartition(self._sep)[2]
@@ -438,15 +638,38 @@ class Layer(Image):
     def index(self, index):
         index = str(index)
         assert index.isdigit()
-        self.nvr = NVR.parse(str(self.base.nvr) + self._sep + index)
+        self.nvr = self.base.derive_layer(index).nvr
 
     @property
     def base(self):
-        return Base(str(self.nvr).rpartition(self._sep)[0])
+        """The base of this layer, derived once from the NVR
+        """
+        if self._base is None:
+            release, sep, _ = self.nvr.release.rpartition(self._sep)
+            if sep:
+                self._base = Base(self.nvr.with_release(release))
+            else:
+                self._base = Base(str(self.nvr).rpartition(self._sep)[0])
+        return self._base
 
     def __init__(self, nvr):
         assert self._sep in str(nvr)
         self.nvr = NVR.parse(nvr)  # For convenience: Parse if necessary
+        self._base = None
+
+    def copy(self):
+        """A copy of the layer, with a copy of its base
+        """
+        base = self.base.copy()
+        for layer in base.layers:
+            if str(layer) == str(self):
+                return layer
+        return self._copy_for(base)
+
+    def _copy_for(self, base):
+        layer = Layer(self.nvr)
+        layer._base = base
+        return layer
 
     def __repr__(self):
         return "<Layer %s />" % self.nvr
@@ -8,6 +8,7 @@ import subprocess
 
 from configparser import ConfigParser
 
+from ..delta import Delta, mounted_liveimg
 from ..utils import BuildMetadata, File, Rsync, ShellVarFile, systemctl
 
 log = logging.getLogger(__package__)
@@ -25,6 +26,11 @@ def add_argparse(app, parser, subparsers):
                    help="Do some post-processing")
     s.add_argument("--set-nvr",
                    help="Define the nvr of this build")
+    s.add_argument("--make-delta", nargs=2, metavar=("OLD", "NEW"),
+                   help="Create a delta between two liveimgs")
+    s.add_argument("--output",
+                   help="Path of the delta, default NEW with a .delta "
+                   "suffix")
 
     s = subparsers.add_parser("image-introspect",
                               help="Informations around this image")
@@ -39,12 +45,20 @@ def post_argparse(app, args):
             Postprocessor.postprocess(app)
         if args.set_nvr:
             BuildMetadata().set("nvr", args.set_nvr)
+        if args.make_delta:
+            make_delta(*args.make_delta, output=args.output)
     elif args.command == "image-introspect":
         if args.metadata:
             metadata = dict(BuildMetadata().items())
             print(json.dumps(metadata, indent=2))
 
 
+def make_delta(old, new, output=None):
+    output = output or os.path.splitext(new)[0] + ".delta"
+    with mounted_liveimg(old) as oldroot, mounted_liveimg(new) as newroot:
+        Delta.make(oldroot, newroot, output)
+
+
 def factorize(path):
     """Prepare a path for systemd's factory model
 
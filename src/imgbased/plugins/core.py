@@ -21,6 +21,7 @@
 # Author(s): Fabian Deutsch <fabiand@redhat.com>
 #
 import inspect
+import json
 import logging
 import os
 
@@ -29,7 +30,8 @@ from ..constants import volume_paths
 from ..imgbase import LayerNotFoundError
 from ..lvm import LVM
 from ..naming import Image
-from ..utils import BuildMetadata, Motd, bcolors, findmnt
+from ..poolstats import PoolStats
+from ..utils import BuildMetadata, Motd, bcolors, findmnt, human_size
 
 log = logging.getLogger(__package__)
 
@@ -50,8 +52,8 @@ def add_argparse(app, parser, subparsers):
                              help="Add a base layer")
 
     base_parser.add_argument("--remove",
-                             metavar="BASE",
-                             help="Remove a base layer and it's children")
+                             metavar="BASE", nargs="+",
+                             help="Remove base layers and their children")
 
     base_parser.add_argument("--size",
                              help="(Virtual) Size of the thin volume")
@@ -90,6 +92,12 @@ def add_argparse(app, parser, subparsers):
     layout_group.add_argument("--free-space", action="store_true",
                               default=False,
                               help="How much space there is in the thinpool")
+    layout_group.add_argument("--pool-stats", action="store_true",
+                              default=False,
+                              help="Thinpool usage history and forecast")
+    layout_group.add_argument("--usage", action="store_true",
+                              default=False,
+                              help="Space used by every base and layer")
     layout_group.add_argument("--bases", action="store_true",
                               help="List all bases")
     layout_group.add_argument("--layers", action="store_true",
@@ -111,6 +119,20 @@ def add_argparse(app, parser, subparsers):
     space_group.add_argument("--units", default="m",
                              help="Units to be used for free space")
 
+    #
+    # query
+    #
+    query_parser = subparsers.add_parser("query",
+                                         help="Answer several layout "
+                                         "questions at once")
+    query_parser.add_argument("--json", action="store_true",
+                              help="Print the answers as one JSON document")
+    query_parser.add_argument("--units", default="m",
+                              help="Units to be used for free space")
+    query_parser.add_argument("FACT", nargs="*",
+                              help="The facts to query, any of %s "
+                              "(default: all)" % ", ".join(Query.facts))
+
     #
     # check
     #
@@ -134,7 +156,7 @@ def post_argparse(app, args):
                 raise RuntimeError("--size is required")
             app.imgbase.add_base(args.size, args.add)
         if args.remove:
-            app.imgbase.remove_base(args.remove)
+            app.imgbase.remove_bases(args.remove)
         elif args.latest:
             print(app.imgbase.latest_base())
         elif args.of_layer:
@@ -172,6 +194,10 @@ def post_argparse(app, args):
 
         elif args.free_space:
             print(app.imgbase.free_space(args.units))
+        elif args.pool_stats:
+            print(layout.pool_stats())
+        elif args.usage:
+            print(layout.usage())
         elif args.bases:
             print("\n".join(str(b) for b in layout.list_bases()))
         elif args.layers:
@@ -179,6 +205,16 @@ def post_argparse(app, args):
         else:
             print(layout.dumps())
 
+    elif args.command == "query":
+        unknown = set(args.FACT) - set(Query.facts)
+        if unknown:
+            raise RuntimeError("Unknown facts: %s" %
+                               ", ".join(sorted(unknown)))
+        query = Query(app, args.units)
+        answers = query.answer(args.FACT or Query.facts)
+        print(json.dumps(answers, indent=2, sort_keys=True) if args.json
+              else query.dumps(answers))
+
     elif args.command == "check":
         run_check(app)
 
@@ -204,6 +240,31 @@ class Layout():
     def dumps(self):
         return self.app.imgbase.layout()
 
+    def pool_stats(self):
+        return PoolStats().report(self.app.imgbase._thinpool())
+
+    def usage(self):
+        imgbase = self.app.imgbase
+        usage = imgbase.image_usage()
+        reclaimable = dict(imgbase.reclaimable_space(usage=usage))
+
+        fmt = "%-48s %9s %9s %9s"
+
+        def line(img, prefix=""):
+            img_usage = usage.get(img.lv_name, {})
+            return fmt % tuple([prefix + str(img)] +
+                               [human_size(img_usage.get(k, 0))
+                                for k in ["mapped", "exclusive", "shared"]])
+
+        lines = [fmt % ("IMAGE", "MAPPED", "EXCLUSIVE", "SHARED")]
+        for base in imgbase.naming.tree():
+            lines.append(line(base))
+            for layer in base.layers:
+                lines.append(line(layer, " +- "))
+            lines.append("%-48s %9s" % (" Removing the base frees at least",
+                                        human_size(reclaimable[base])))
+        return "\n".join(lines)
+
     def initialize(self, source, init_nvr=None):
         try:
             init_nvr = init_nvr or BuildMetadata().get("nvr")
@@ -216,6 +277,80 @@ class Layout():
         LVM.stop_monitoring()
 
 
+class Query():
+    """Answers several layout questions in one invocation
+
+    All answers are computed from the same LVM and boot snapshot, a
+    question which can not be answered is null and the reason is kept
+    in the errors.
+    """
+    facts = ["current-layer", "latest-layer", "latest-base", "free-space",
+             "bases", "layers", "boot-default", "health"]
+
+    def __init__(self, app, units="m"):
+        self.app = app
+        self.units = units
+        self.bootconfig = BootConfiguration()
+
+    def current_layer(self):
+        return str(self.app.imgbase.current_layer())
+
+    def latest_layer(self):
+        return str(self.app.imgbase.latest_layer())
+
+    def latest_base(self):
+        return str(self.app.imgbase.latest_base())
+
+    def free_space(self):
+        return self.app.imgbase.free_space(self.units)
+
+    def bases(self):
+        return [str(b) for b in self.app.imgbase.naming.bases()]
+
+    def layers(self):
+        return dict((str(b), [str(layer) for layer in b.layers])
+                    for b in self.app.imgbase.naming.tree())
+
+    def boot_default(self):
+        return self.bootconfig.get_default()
+
+    def health(self):
+        status = Health(self.app, self.bootconfig).status()
+        return {"ok": status.is_ok(),
+                "groups": dict((r.checkgroup.description,
+                                dict((c.check.description, c.ok)
+                                     for c in r.results))
+                               for r in status.results)}
+
+    def answer(self, facts):
+        answers = {}
+        errors = {}
+        for fact in facts:
+            try:
+                answers[fact] = getattr(self, fact.replace("-", "_"))()
+            except Exception as e:
+                log.debug("Failed to answer %s" % fact, exc_info=True)
+                answers[fact] = None
+                errors[fact] = str(e) or repr(e)
+        if errors:
+            answers["errors"] = errors
+        return answers
+
+    def dumps(self, answers):
+        lines = []
+        for fact in self.facts + ["errors"]:
+            if fact not in answers:
+                continue
+            value = answers[fact]
+            if isinstance(value, dict):
+                value = ", ".join("%s: %s" % kv
+                                  for kv in sorted(value.items()))
+            elif isinstance(value, list):
+                value = " ".join(value)
+            lines.append("%s: %s" % (fact, value))
+        return "\n".join(lines)
+
+
 def run_check(app):
     status = Health(app).status()
     print(status.details())
@@ -342,8 +477,9 @@ class Health():
                 txts.append(r.details())
             return "\n".join(txts)
 
-    def __init__(self, app):
+    def __init__(self, app, bootconfig=None):
         self.app = app
+        self.bootconfig = bootconfig
 
     def status(self):
         status = Health.Status()
@@ -380,9 +516,8 @@ class Health():
         pool = self.app.imgbase._thinpool()
         datap = None
         try:
-            lvs = LVM._lvs(["--noheadings",
-                            "-odata_percent,metadata_percent", pool.lvm_name])
-            datap, metap = map(float, lvs.replace(",", ".").split())
+            usage = pool.usage()
+            datap, metap = usage["data_percent"], usage["metadata_percent"]
         except Exception:
             log.debug("Failed to get thin data", exc_info=True)
 
@@ -393,13 +528,9 @@ class Health():
             return group
 
         def has_autoextend():
-            profile = pool.profile()
-            args = ["--metadataprofile", profile] if profile else []
-            args += ["--type", "full",
-                     "activation/thin_pool_autoextend_threshold"]
             ret = False
             try:
-                ret = int(LVM._lvmconfig(args).split("=")[1]) < 100
+                ret = pool.autoextend_threshold() < 100
             except Exception:
                 pass
             return ret
@@ -448,7 +579,7 @@ class Health():
 
     def check_bootloader(self):
         group = Health.CheckGroup()
-        b = BootConfiguration()
+        b = self.bootconfig or BootConfiguration()
         group.description = "Bootloader"
         group.reason = ("It looks like there are no valid bootloader "
                         "entries. Please ensure this is fixed before "
@@ -33,8 +33,6 @@ import subprocess
 from filecmp import dircmp
 from tempfile import mkdtemp
 
-import rpm
-
 from .. import bootloader, constants, timeserver, utils
 from ..bootsetup import BootSetupHandler
 from ..command import nsenter
@@ -77,7 +75,7 @@ def pre_init(app):
 
 def init(app):
     app.imgbase.hooks.connect("new-layer-added", on_new_layer)
-    app.imgbase.hooks.connect("pre-layer-removed", on_remove_layer)
+    app.imgbase.hooks.connect("pre-images-removed", on_remove_images)
     app.imgbase.hooks.connect("post-init-layout", on_post_init_layout)
 
 
@@ -570,6 +568,8 @@ def migrate_etc(imgbase, new_lv, previous_lv):
                 changed_and_new(d)
 
     def configure_versionlock():
+        import rpm
+
         log.info("Configuring versionlock for %s" % new_fs.source)
         fmt = "{0.name}-{0.version}-{0.release}.{0.arch}\n"
         data = "# imgbased: versionlock begin for layer %s\n" % new_fs.source
@@ -986,18 +986,31 @@ def adjust_mounts_and_boot(imgbase, new_lv, previous_lv):
             bootloader.BootConfiguration.validate()
 
 
-def on_remove_layer(imgbase, lv_fullname):
-    remove_boot(imgbase, lv_fullname)
+def on_remove_images(imgbase, lv_fullnames):
+    remove_boots(imgbase, lv_fullnames)
 
 
 def remove_boot(imgbase, lv_fullname):
-    lv_name = LVM.LV.from_lvm_name(lv_fullname).lv_name
-    assert lv_name
+    remove_boots(imgbase, [lv_fullname])
 
-    bootdir = "/boot/%s" % lv_name
 
-    loader = bootloader.Grubby()
-    loader.remove_entry(lv_name)
+def remove_boots(imgbase, lv_fullnames):
+    """Remove the boot entries and files of the layers in one pass
+    """
+    lv_names = [LVM.LV.from_lvm_name(n).lv_name for n in lv_fullnames]
+    assert all(lv_names)
+    lv_names = [n for n in lv_names if Image.from_lv_name(n).is_layer()]
+    if not lv_names:
+        return
+
+    bootloader.Grubby().remove_entries(lv_names)
+
+    for lv_name in lv_names:
+        _remove_boot_files(lv_name)
+
+
+def _remove_boot_files(lv_name):
+    bootdir = "/boot/%s" % lv_name
 
     assert bootdir.strip("/") != "boot"
 
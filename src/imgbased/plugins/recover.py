@@ -6,6 +6,7 @@ import six
 from ..bootloader import BootConfiguration
 from ..constants import volume_paths
 from ..naming import NVR
+from ..utils import human_size
 from ..volume import Volumes
 
 log = logging.getLogger(__package__)
@@ -37,6 +38,7 @@ class ImageRecovery:
     def __init__(self, imgbase):
         self._imgbase = imgbase
         self._volumes = Volumes(self._imgbase)
+        self._reclaimable = {}
 
     def process(self, lst=False, force=False):
         log.debug("lst=%s, force=%s", lst, force)
@@ -50,7 +52,19 @@ class ImageRecovery:
     def _get_unused_layers(self):
         boot_entries = [NVR.parse(b) for b in BootConfiguration().list()]
         layers = self._imgbase.naming.layers()
-        return [l for l in layers if l.nvr not in boot_entries]
+        unused = [l for l in layers if l.nvr not in boot_entries]
+        return self._rank_by_reclaimable_space(unused)
+
+    def _rank_by_reclaimable_space(self, layers):
+        """The layers of the bases freeing the most space come first
+        """
+        try:
+            self._reclaimable = dict(self._imgbase.reclaimable_space())
+        except Exception:
+            log.debug("Failed to get the reclaimable space", exc_info=True)
+            return layers
+        return sorted(layers,
+                      key=lambda layer: -self._reclaimable.get(layer.base, 0))
 
     def _get_unused_volumes(self):
         paths = volume_paths()
@@ -68,16 +82,24 @@ class ImageRecovery:
             if self._prompt("volume on", vol, force):
                 print("Removing volume on: [%s]" % vol)
                 self._volumes.remove(vol, force=True)
+        bases = []
         for layer in layers:
             if self._prompt("LV", layer, force):
                 print("Removing LV base: [%s]" % layer.base.nvr)
-                self._imgbase.remove_base(layer.base.nvr, force)
+                bases.append(layer.base.nvr)
+        if bases:
+            self._imgbase.remove_images(bases, force=force)
 
     def _display_unused(self, layers, volumes):
         if layers:
             print("Found the following unused layers:")
             for layer in layers:
-                print(layer.nvr)
+                if layer.base in self._reclaimable:
+                    print("%s (frees at least %s)" %
+                          (layer.nvr,
+                           human_size(self._reclaimable[layer.base])))
+                else:
+                    print(layer.nvr)
         else:
             print("No unused layers")
         if volumes:
@@ -1,16 +1,21 @@
 
 import glob
+import json
 import logging
 import os
 import sys
+import threading
 
 import six
 
-from .. import constants, local
+from .. import command, constants, local
 from ..bootloader import BootConfiguration
+from ..delta import Delta
 from ..lvm import LVM
 from ..naming import Image
-from ..utils import BuildMetadata, File, Filesystem, SELinux, Tar, mounted
+from ..utils import (BuildMetadata, ExternalBinary, File, Filesystem,
+                     SELinux, Tar, TarStream, ThreadRunner, human_size,
+                     mounted, sparse_copy)
 
 log = logging.getLogger(__package__)
 
@@ -18,6 +23,15 @@ log = logging.getLogger(__package__)
 class UpdateConfigurationSection(local.Configuration.Section):
     _type = "update"
     images_to_keep = 2
+    # "count" keeps images_to_keep bases, "space" frees bases until the
+    # pool usage is below the targets (in percent), but keeps at least
+    # images_to_keep bases
+    gc_policy = "count"
+    gc_data_target = 70
+    gc_metadata_target = 70
+    # "inline" removes the bases during the update, "deferred" marks them
+    # to be removed by `imgbase gc --run`
+    gc_mode = "inline"
 
 
 class RollbackFailedError(Exception):
@@ -42,7 +56,22 @@ def add_argparse(app, parser, subparsers):
     u = subparsers.add_parser("update",
                               help="Update handling")
 
-    u.add_argument("--format", default="liveimg")
+    u.add_argument("--format", default="liveimg",
+                   help="liveimg (copy the tree), block (copy the "
+                   "filesystem image), tar-stream (extract a tar "
+                   "stream, - for stdin) or delta (apply a delta to an "
+                   "installed base)")
+    u.add_argument("--nvr",
+                   help="NVR of the new base, if not in the image")
+    u.add_argument("--jobs", type=int, default=1,
+                   help="Number of tar pipelines to copy the tree with "
+                   "(liveimg without --rebase only)")
+    u.add_argument("--background-cleanup", action="store_true",
+                   help="If the update fails, remove its volumes in the "
+                   "background, instead of waiting for the removal")
+    u.add_argument("--rebase", action="store_true",
+                   help="Create the new base as a snapshot of the latest "
+                   "base and only apply the changes (liveimg only)")
     u.add_argument("FILENAME")
 
     r = subparsers.add_parser("rollback",
@@ -50,6 +79,14 @@ def add_argparse(app, parser, subparsers):
     r.add_argument("--to", nargs="?",
                    help="Explicitly define the NVR to roll back to")
 
+    g = subparsers.add_parser("gc",
+                              help="Bases marked for deferred removal")
+    g_group = g.add_mutually_exclusive_group(required=True)
+    g_group.add_argument("--list", action="store_true",
+                         help="List the bases pending removal")
+    g_group.add_argument("--run", action="store_true",
+                         help="Remove the bases pending removal")
+
 
 def post_argparse(app, args):
     """Check if we were asked to do something
@@ -59,11 +96,29 @@ def post_argparse(app, args):
     if args.command == "rollback":
         rollback(app, args.to)
 
+    elif args.command == "gc":
+        removal = DeferredRemoval(app.imgbase)
+        if args.list:
+            print("\n".join(str(b) for b in removal.pending()))
+        elif args.run:
+            removal.run()
+
     elif args.command == "update":
         app.imgbase.set_mode(constants.IMGBASED_MODE_UPDATE)
-        if args.format == "liveimg":
+        extractors = {"liveimg": LiveimgExtractor,
+                      "block": BlockExtractor,
+                      "tar-stream": TarStreamExtractor,
+                      "delta": DeltaExtractor}
+        if args.rebase and args.format != "liveimg":
+            log.error("--rebase is only supported with the liveimg format")
+        elif args.jobs != 1 and (args.rebase or args.format != "liveimg"):
+            log.error("--jobs is only supported with the liveimg format, "
+                      "without --rebase")
+        elif args.format in extractors:
+            extractor = extractors[args.format](app.imgbase, args.jobs,
+                                                args.rebase)
             try:
-                base, _ = LiveimgExtractor(app.imgbase).extract(args.FILENAME)
+                base, _ = extractor.extract(args.FILENAME, nvr=args.nvr)
                 log.info("Update was pulled successfully")
                 GarbageCollector(app.imgbase).run(base)
             except GCFailedError:
@@ -71,18 +126,115 @@ def post_argparse(app, args):
             except Exception:
                 exc_info = sys.exc_info()
                 log.error("Update failed, resetting registered LVs")
-                LVM.reset_registered_volumes()
+                LVM.reset_registered_volumes(args.background_cleanup)
                 six.reraise(*exc_info)
         else:
             log.error("Unknown update format %r" % args.format)
 
 
+class PoolExtender():
+    """Grow the thin pool while a new base is written
+
+    Before writing, the pool is grown once (if the VG has free space)
+    to hold the expected data below the autoextend threshold. While
+    writing, the data and metadata usage is polled, and the pool is
+    grown early, instead of relying on dmeventd, or on a full pool
+    which is blocking the writes.
+    """
+    interval = 5
+    step_percent = 20
+    default_threshold = 90
+
+    def __init__(self, pool):
+        self.pool = pool
+        try:
+            threshold = pool.autoextend_threshold()
+        except Exception:
+            log.debug("Failed to get the autoextend threshold",
+                      exc_info=True)
+            threshold = 100
+        self.threshold = threshold if threshold < 100 \
+            else self.default_threshold
+        self._stop = threading.Event()
+        self._monitor = None
+        self._exhausted = False
+
+    @staticmethod
+    def estimate_tree_size(sourcetree):
+        """The bytes used by the filesystem holding the tree
+        """
+        st = os.statvfs(sourcetree)
+        return (st.f_blocks - st.f_bfree) * st.f_frsize
+
+    def reserve(self, size):
+        """Make room for size bytes below the threshold, fails early if
+        they do not fit into the pool at all
+        """
+        usage = self.pool.usage(cached=False)
+        pool_size = usage["lv_size"]
+        used = pool_size * usage["data_percent"] / 100
+        growth = (used + size) * 100 / self.threshold - pool_size
+        log.debug("Reserving %s in pool %s, %s used of %s" %
+                  (human_size(size), self.pool.lvm_name, human_size(used),
+                   human_size(pool_size)))
+        if growth <= 0:
+            return
+        added = self.pool.extend(data_bytes=growth)
+        if used + size > pool_size + added:
+            raise RuntimeError("Not enough space for %s in pool %s: %s "
+                               "of %s are used" %
+                               (human_size(size), self.pool.lvm_name,
+                                human_size(used),
+                                human_size(pool_size + added)))
+        if added < growth:
+            log.warn("The pool %s can not be extended to stay below %d%%" %
+                     (self.pool.lvm_name, self.threshold))
+
+    def check(self):
+        usage = self.pool.usage(cached=False)
+        grow = {}
+        for kind, size_field, percent_field in [
+                ("data", "lv_size", "data_percent"),
+                ("metadata", "lv_metadata_size", "metadata_percent")]:
+            if usage[percent_field] >= self.threshold:
+                grow[kind + "_bytes"] = (usage[size_field] *
+                                         self.step_percent / 100)
+        if grow and not self._exhausted:
+            log.debug("Pool %s is above %d%%: %s" %
+                      (self.pool.lvm_name, self.threshold, usage))
+            if not self.pool.extend(**grow):
+                log.warn("The pool %s is above %d%% and the VG is full" %
+                         (self.pool.lvm_name, self.threshold))
+                self._exhausted = True
+
+    def _run_monitor(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                log.debug("Failed to check the pool usage", exc_info=True)
+
+    def __enter__(self):
+        if not os.getenv("IMGBASED_DISABLE_THREADS"):
+            self._monitor = ThreadRunner(self._run_monitor)
+            self._monitor.daemon = True
+            self._monitor.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._stop.set()
+        if self._monitor:
+            self._monitor.join_with_exceptions()
+
+
 class LiveimgExtractor():
     imgbase = None
     can_pipe = False
 
-    def __init__(self, imgbase):
+    def __init__(self, imgbase, jobs=1, rebase=False):
         self.imgbase = imgbase
+        self.jobs = jobs
+        self.rebase = rebase
 
     def _recommend_size_for_tree(self):
         # Get the size of the current layer and use that
@@ -108,9 +260,69 @@ class LiveimgExtractor():
         File(constants.IMGBASED_IMAGE_UPDATED).writen(img)
 
     def add_base_with_tree(self, sourcetree, size, nvr, lvs=None):
+        with LVM.transaction():
+            if self.rebase:
+                return self._rebase_with_tree(sourcetree, size, nvr)
+            return self._add_base_with_tree(sourcetree, size, nvr, lvs)
+
+    def _rebase_with_tree(self, sourcetree, size, nvr):
+        """Snapshot the current base and turn it into the new base
+
+        Only the changed, added and removed files are written, unchanged
+        files keep the blocks which are shared with the previous base.
+        The new base is only tagged as a base after the tree was synced.
+        """
         if not os.path.exists(sourcetree):
             raise RuntimeError("Sourcetree does not exist: %s" % sourcetree)
 
+        # The booted base, which is not the latest one after a rollback
+        origin = self.imgbase.current_layer().base
+        extender = PoolExtender(self.imgbase._thinpool())
+        new_base = self.imgbase.add_base_from_snapshot(origin, size, nvr,
+                                                       tagged=False)
+        new_base_lv = self.imgbase._lvm_from_layer(new_base)
+
+        with new_base_lv.unprotected():
+            fs = Filesystem.from_device(new_base_lv.path)
+            fs.randomize_uuid()
+
+            log.info("Applying the changes since %s to base" % origin)
+            with mounted(new_base_lv.path) as mount, extender:
+                fs.grow(mount.target)
+                self._sync_tree(sourcetree, mount.target)
+                try:
+                    # Return the blocks of removed and replaced files
+                    command.call(["fstrim", mount.target])
+                except Exception:
+                    log.debug("Failed to trim the new base", exc_info=True)
+
+        new_base_lv.addtag(self.imgbase.lv_base_tag)
+        self.imgbase.naming.invalidate()
+        new_layer_lv = self.imgbase.add_layer(new_base)
+        # The base is written now, and its blocks are allocated
+        self.imgbase.record_pool_usage("add_base")
+
+        return (new_base_lv, new_layer_lv)
+
+    @staticmethod
+    def _sync_tree(sourcetree, target):
+        """Make target a copy of sourcetree, writing only changed files
+
+        The files are compared by their content: images are often built
+        with fixed modification times, which would make the quick check of
+        size and modification time miss changed files.
+        """
+        command.call(["rsync", "-aHAXx", "-W", "--checksum", "--numeric-ids",
+                      "--delete", "--no-i-r", sourcetree + "/",
+                      target + "/"])
+
+    def _add_base_with_tree(self, sourcetree, size, nvr, lvs=None):
+        if not os.path.exists(sourcetree):
+            raise RuntimeError("Sourcetree does not exist: %s" % sourcetree)
+
+        extender = PoolExtender(self.imgbase._thinpool())
+        extender.reserve(extender.estimate_tree_size(sourcetree))
+
         new_base = self.imgbase.add_base(size, nvr, lvs)
         new_base_lv = self.imgbase._lvm_from_layer(new_base)
 
@@ -119,13 +331,15 @@ class LiveimgExtractor():
             Filesystem.from_mountpoint("/").mkfs(new_base_lv.path)
 
             log.info("Writing tree to base")
-            with mounted(new_base_lv.path) as mount:
+            with mounted(new_base_lv.path) as mount, extender:
                 dst = mount.target + "/"
-                tar = Tar()
+                tar = Tar(self.jobs)
                 tar.sync(sourcetree, dst)
                 log.debug("Trying to copy prev fstab")
 
         new_layer_lv = self.imgbase.add_layer(new_base)
+        # The base is written now, and its blocks are allocated
+        self.imgbase.record_pool_usage("add_base")
 
         return (new_base_lv, new_layer_lv)
 
@@ -152,6 +366,205 @@ class LiveimgExtractor():
         return new_base
 
 
+class BlockExtractor(LiveimgExtractor):
+    """Write the filesystem image of a liveimg onto the new base
+
+    Instead of creating a new filesystem and copying the tree file by
+    file, the image is written in one sequential stream, blocks of zeros
+    are skipped to keep the base sparse. The filesystem is then given a
+    new UUID and grown to the size of the base.
+    """
+    def add_base_with_image(self, fsimage, size, nvr, used, lvs=None):
+        with LVM.transaction():
+            return self._add_base_with_image(fsimage, size, nvr, used, lvs)
+
+    def _add_base_with_image(self, fsimage, size, nvr, used, lvs=None):
+        pool = self.imgbase._thinpool()
+        extender = PoolExtender(pool)
+        extender.reserve(used)
+        blocksize = self._blocksize(pool)
+
+        image_size = os.path.getsize(fsimage)
+        if int(str(size).strip().rstrip("B")) < image_size:
+            size = "%dB" % image_size
+
+        new_base = self.imgbase.add_base(size, nvr, lvs)
+        new_base_lv = self.imgbase._lvm_from_layer(new_base)
+
+        with new_base_lv.unprotected():
+            log.info("Writing image to base")
+            with extender:
+                sparse_copy(fsimage, new_base_lv.path, blocksize)
+
+            fs = Filesystem.from_device(new_base_lv.path)
+            fs.randomize_uuid()
+            with mounted(new_base_lv.path) as mount:
+                log.info("Growing filesystem to the base size")
+                fs.grow(mount.target)
+
+        new_layer_lv = self.imgbase.add_layer(new_base)
+        # The base is written now, and its blocks are allocated
+        self.imgbase.record_pool_usage("add_base")
+
+        return (new_base_lv, new_layer_lv)
+
+    @staticmethod
+    def _blocksize(pool):
+        """The skipped blocks must read as zeros: either the pool is
+        zeroing new chunks, or the blocks cover whole chunks, which are
+        then never provisioned
+        """
+        zero, chunk_size = pool.provisioning()
+        blocksize = 1024 ** 2
+        if not zero:
+            blocksize = chunk_size * -(-blocksize // chunk_size)
+        log.debug("Copying in blocks of %s (zeroing: %s, chunk size: %s)" %
+                  (human_size(blocksize), zero, human_size(chunk_size)))
+        return blocksize
+
+    def extract(self, liveimgfile, nvr=None):
+        self._clear_updated_file()
+        self._check_selinux()
+        new_base = None
+        log.info("Extracting image '%s'" % liveimgfile)
+        with mounted(liveimgfile, options="ro") as squashfs:
+            log.debug("Mounted squashfs")
+            liveimg = glob.glob(squashfs.target + "/*/*.img").pop()
+            log.debug("Found fsimage at '%s'" % liveimg)
+            with mounted(liveimg, options="ro") as rootfs:
+                nvr = nvr or BuildMetadata(rootfs.target).get("nvr")
+                used = PoolExtender.estimate_tree_size(rootfs.target)
+            log.debug("Using nvr: %s" % nvr)
+            size = self._recommend_size_for_tree()
+            log.debug("Recommeneded base size: %s" % size)
+            log.info("Starting base creation")
+            new_base = self.add_base_with_image(liveimg, size, nvr, used)
+            log.info("Image written")
+        log.debug("Extraction done")
+        self._create_updated_file(os.path.basename(liveimgfile))
+        return new_base
+
+
+class TarStreamExtractor(LiveimgExtractor):
+    """Extract a tar stream of the root tree onto the new base
+
+    The stream is read from a file or stdin (-) and extracted while it is
+    read, without staging an image on disk. The NVR is taken from the
+    IMGBASED.nvr keyword of the pax global header of the stream.
+    """
+    can_pipe = True
+    nvr_header = "IMGBASED.nvr"
+
+    def _add_base_with_stream(self, stream, size, nvr, lvs=None):
+        # The size of the tree is unknown, the pool is only grown while
+        # writing
+        extender = PoolExtender(self.imgbase._thinpool())
+
+        new_base = self.imgbase.add_base(size, nvr, lvs)
+        new_base_lv = self.imgbase._lvm_from_layer(new_base)
+
+        with new_base_lv.unprotected():
+            log.info("Creating new filesystem on base")
+            Filesystem.from_mountpoint("/").mkfs(new_base_lv.path)
+
+            log.info("Writing stream to base")
+            with mounted(new_base_lv.path) as mount, extender:
+                Tar().unpack(stream, mount.target + "/")
+
+        new_layer_lv = self.imgbase.add_layer(new_base)
+        # The base is written now, and its blocks are allocated
+        self.imgbase.record_pool_usage("add_base")
+
+        return (new_base_lv, new_layer_lv)
+
+    def extract(self, filename, nvr=None):
+        self._clear_updated_file()
+        self._check_selinux()
+        log.info("Extracting stream '%s'" % filename)
+        if filename == "-":
+            src = getattr(sys.stdin, "buffer", sys.stdin)
+        else:
+            src = open(filename, "rb")
+        try:
+            stream = TarStream(src)
+            nvr = nvr or stream.headers.get(self.nvr_header)
+            if not nvr:
+                raise RuntimeError("The stream has no %s header, the NVR "
+                                   "needs to be passed with --nvr" %
+                                   self.nvr_header)
+            log.debug("Using nvr: %s" % nvr)
+            size = self._recommend_size_for_tree()
+            log.info("Starting base creation")
+            with LVM.transaction():
+                new_base = self._add_base_with_stream(stream, "%s" % size,
+                                                      nvr)
+            log.info("Stream extracted")
+        finally:
+            if src is not getattr(sys.stdin, "buffer", sys.stdin):
+                src.close()
+        self._create_updated_file(nvr if filename == "-"
+                                  else os.path.basename(filename))
+        return new_base
+
+
+class DeltaExtractor(LiveimgExtractor):
+    """Apply a delta (see imgbase image-build --make-delta) to a snapshot
+    of the installed base it was made for
+
+    The new base is only tagged as a base after the result was verified
+    against the manifest of the delta.
+    """
+    def _add_base_with_delta(self, delta, origin, size, nvr):
+        extender = PoolExtender(self.imgbase._thinpool())
+        new_base = self.imgbase.add_base_from_snapshot(origin, size, nvr,
+                                                       tagged=False)
+        new_base_lv = self.imgbase._lvm_from_layer(new_base)
+
+        with new_base_lv.unprotected():
+            fs = Filesystem.from_device(new_base_lv.path)
+            fs.randomize_uuid()
+
+            log.info("Applying the delta to the snapshot of %s" % origin)
+            with mounted(new_base_lv.path) as mount, extender:
+                fs.grow(mount.target)
+                delta.apply(mount.target)
+                log.info("Verifying the new base")
+                delta.verify(mount.target)
+                try:
+                    command.call(["fstrim", mount.target])
+                except Exception:
+                    log.debug("Failed to trim the new base", exc_info=True)
+
+        new_base_lv.addtag(self.imgbase.lv_base_tag)
+        self.imgbase.naming.invalidate()
+        new_layer_lv = self.imgbase.add_layer(new_base)
+        # The base is written now, and its blocks are allocated
+        self.imgbase.record_pool_usage("add_base")
+
+        return (new_base_lv, new_layer_lv)
+
+    def extract(self, deltafile, nvr=None):
+        self._clear_updated_file()
+        self._check_selinux()
+        log.info("Extracting delta '%s'" % deltafile)
+        with Delta.open(deltafile) as delta:
+            origin = Image.from_nvr(delta.manifest["from"])
+            if str(origin) not in [str(b) for b in
+                                   self.imgbase.naming.bases()]:
+                raise RuntimeError("The delta needs the base %s, which is "
+                                   "not installed" % origin)
+            nvr = nvr or delta.manifest["to"]
+            log.debug("Using nvr: %s" % nvr)
+            size = self._recommend_size_for_tree()
+            log.info("Starting base creation")
+            with LVM.transaction():
+                new_base = self._add_base_with_delta(delta, origin,
+                                                     "%s" % size, nvr)
+            log.info("Delta applied")
+        self._create_updated_file(os.path.basename(deltafile))
+        return new_base
+
+
 def rollback(app, specific_nvr):
     """
     The rollback operation will trigger the rollback from the
@@ -195,14 +608,148 @@ def rollback(app, specific_nvr):
     return dst_layer
 
 
+class DeferredRemoval():
+    """Bases which are marked to be removed later
+
+    The bases are tagged, and recorded in a state file in the order they
+    were marked. `imgbase gc --run` (started from imgbased-gc.service,
+    at idle I/O priority) removes them, and drops every base from the
+    state file once it is removed. An interrupted run is resumed by the
+    next one: the layers which are left, and the base, are removed then.
+    """
+    tag = "imgbased:gc"
+    path = constants.IMGBASED_GC_PENDING
+    unit = "imgbased-gc.service"
+
+    def __init__(self, imgbase, path=None):
+        self.imgbase = imgbase
+        self.path = path or self.path
+
+    def _read(self):
+        try:
+            with open(self.path) as src:
+                return json.load(src)
+        except (IOError, OSError, ValueError):
+            return []
+
+    def _write(self, names):
+        if not names:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            return
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmpfile = self.path + ".%d" % os.getpid()
+        with open(tmpfile, "w") as dst:
+            json.dump(names, dst)
+        os.rename(tmpfile, self.path)
+
+    def pending(self):
+        """The marked bases, in the order they were marked
+        """
+        names = self._read()
+        tagged = [lv.lv_name for lv, _ in
+                  LVM.list_lvs_with_tags(any_tag=[self.tag])]
+        names += sorted(n for n in tagged if n not in names)
+        return [Image.from_nvr(n) for n in names
+                if Image.from_nvr(n).is_base()]
+
+    def mark(self, base):
+        log.info("Marking %s for removal" % base)
+        self.imgbase._lvm_from_layer(base).addtag(self.tag)
+        names = self._read()
+        if str(base) not in names:
+            self._write(names + [str(base)])
+
+    def _forget(self, base):
+        self._write([n for n in self._read() if n != str(base)])
+
+    def unmark(self, base):
+        log.info("Unmarking %s" % base)
+        self.imgbase._lvm_from_layer(base).deltag(self.tag)
+        self._forget(base)
+
+    def trigger(self):
+        """Start the removal in the background
+        """
+        try:
+            ExternalBinary().systemctl(["start", "--no-block", self.unit])
+        except Exception:
+            log.warn("Failed to start %s, run `imgbase gc --run` to "
+                     "remove the marked bases" % self.unit)
+            log.debug("Failed to start %s" % self.unit, exc_info=True)
+
+    def run(self):
+        pending = self.pending()
+        if not pending:
+            log.info("No bases pending removal")
+            self._write([])
+            return
+
+        current_base = self.imgbase.current_layer().base
+        pool = self.imgbase._thinpool()
+        before = pool.usage(cached=False)
+        bases = [str(b) for b in self.imgbase.naming.bases()]
+        remove = [b for b in pending
+                  if b != current_base and str(b) in bases]
+        if remove:
+            log.info("Removing %s" % ", ".join(str(b) for b in remove))
+            self.imgbase.remove_images([b.nvr for b in remove], force=True)
+        for base in pending:
+            if base == current_base:
+                log.warn("Not removing %s, it is in use" % base)
+                self.unmark(base)
+                continue
+            if base not in remove:
+                log.debug("%s was already removed" % base)
+            self._forget(base)
+        GarbageCollector.report_reclaimed(before, pool.usage(cached=False))
+        self.imgbase.record_pool_usage("gc")
+
+
 class GarbageCollector():
     """The garbage collector will remove old updates
     The naming order can be used to find the oldest images
+
+    In the deferred gc_mode the bases are only marked for removal, see
+    DeferredRemoval.
     """
     imgbase = None
+    deferred = False
 
     def __init__(self, imgbase):
         self.imgbase = imgbase
+        if imgbase:
+            # gc_mode is checked in run(), a failure is a GCFailedError
+            self.deferred = imgbase.config.section("update").gc_mode == \
+                "deferred"
+            self.removal = DeferredRemoval(imgbase)
+
+    def _free(self, bases):
+        if not bases:
+            return
+        if self.deferred:
+            with LVM.transaction():
+                for base in bases:
+                    self.removal.mark(base)
+        else:
+            self.imgbase.remove_images([b.nvr for b in bases], force=True)
+
+    def _usage_after(self, pool, usage, freed):
+        """The pool usage after a base was freed, in the deferred mode
+        nothing is freed yet, so it is estimated from the exclusive space
+        of the base (and the metadata shrinking by the same share)
+        """
+        if not self.deferred:
+            return pool.usage(cached=False)
+        usage = dict(usage)
+        if usage["data_percent"] > 0:
+            freed_percent = freed * 100.0 / usage["lv_size"]
+            share = min(freed_percent / usage["data_percent"], 1)
+            usage["data_percent"] -= freed_percent
+            usage["metadata_percent"] -= usage["metadata_percent"] * share
+        return usage
 
     def run(self, new_base_lv):
         try:
@@ -213,25 +760,137 @@ class GarbageCollector():
     def _do_run(self, new_base_lv):
         log.info("Starting garbage collection")
 
-        keep = self.imgbase.config.section("update").images_to_keep
-        assert keep > 0
-
+        config = self.imgbase.config.section("update")
+        if config.gc_mode not in ["inline", "deferred"]:
+            raise RuntimeError("Unknown gc_mode: %s" % config.gc_mode)
         bases = sorted(self.imgbase.naming.bases())
 
-        if len(bases) <= keep:
+        if config.gc_policy == "count" and \
+                len(bases) <= config.images_to_keep:
             log.info("No bases to free")
             return
 
         current_layer = self.imgbase.current_layer()
         new_base = Image.from_lv_name(new_base_lv.lv_name)
-        remove_bases = self._filter_candidates(bases, current_layer.base,
+        pool = self.imgbase._thinpool()
+        before = pool.usage(cached=False)
+        if config.gc_policy == "space":
+            self._free_space(pool, before, bases, current_layer.base,
+                             new_base, config)
+        elif config.gc_policy == "count":
+            self._free_count(bases, current_layer.base, new_base,
+                             config.images_to_keep)
+        else:
+            raise RuntimeError("Unknown gc_policy: %s" % config.gc_policy)
+
+        if self.deferred:
+            self.removal.trigger()
+            return
+
+        self.report_reclaimed(before, pool.usage(cached=False))
+        self.imgbase.record_pool_usage("gc")
+
+        log.info("Garbage collection done.")
+
+    def _free_count(self, bases, current_layer_base, new_base, keep):
+        assert keep > 0
+
+        remove_bases = self._filter_candidates(bases, current_layer_base,
                                                new_base, keep)
 
+        # Getting the space is reading the metadata of the live pool
+        space = self._reclaimable_space(bases, remove_bases) \
+            if log.isEnabledFor(logging.DEBUG) else {}
         for base in remove_bases:
-            log.info("Freeing %s" % base)
-            self.imgbase.remove_base(base.nvr, force=True)
+            log.info("Freeing %s%s" % (base, space.get(base, "")))
+        self._free(remove_bases)
 
-        log.info("Garbage collection done.")
+    def _free_space(self, pool, usage, bases, current_layer_base, new_base,
+                    config):
+        """Free the bases reclaiming the most exclusive space first, until
+        the pool usage is below the targets, but keep images_to_keep bases
+        """
+        targets = [("data_percent", config.gc_data_target),
+                   ("metadata_percent", config.gc_metadata_target)]
+
+        def above_targets(usage):
+            return [(field, usage[field], target)
+                    for field, target in targets
+                    if usage[field] >= int(target)]
+
+        candidates = [b for b in bases
+                      if b not in [current_layer_base, new_base]]
+        kept = len(bases)
+        if self.deferred:
+            # Bases which are marked already are going to free space
+            pending = self.removal.pending()
+            for base, size in self._rank_candidates(
+                    [b for b in candidates if b in pending]):
+                usage = self._usage_after(pool, usage, size)
+                kept -= 1
+            candidates = [b for b in candidates if b not in pending]
+
+        if not above_targets(usage) or not candidates or \
+                kept <= int(config.images_to_keep):
+            log.info("No bases to free, pool usage is below the targets "
+                     "or all bases are in use or kept")
+            return
+
+        for base, size in self._rank_candidates(candidates):
+            above = above_targets(usage)
+            if not above:
+                break
+            if kept <= int(config.images_to_keep):
+                log.info("Keeping %d bases (images_to_keep)" % kept)
+                break
+            log.info("Freeing %s (at least %s), pool usage above target: "
+                     "%s" % (base, human_size(size), ", ".join(
+                         "%s %.1f%% >= %s%%" % a for a in above)))
+            self._free([base])
+            usage = self._usage_after(pool, usage, size)
+            kept -= 1
+
+        above = above_targets(usage)
+        if above:
+            log.warn("Pool usage is still above the targets: %s" %
+                     ", ".join("%s %.1f%% >= %s%%" % a for a in above))
+
+    def _rank_candidates(self, candidates):
+        """The bases reclaiming the most exclusive space first, or the
+        oldest first if the space is not known
+        """
+        if not candidates:
+            return []
+        try:
+            return self.imgbase.reclaimable_space(bases=candidates)
+        except Exception:
+            log.debug("Failed to get the reclaimable space", exc_info=True)
+            return [(base, 0) for base in candidates]
+
+    @staticmethod
+    def report_reclaimed(before, after):
+        """Log the bytes which were actually freed in the pool
+        """
+        lines = []
+        for kind, size_field, percent_field in [
+                ("data", "lv_size", "data_percent"),
+                ("metadata", "lv_metadata_size", "metadata_percent")]:
+            used_before = before[size_field] * before[percent_field] / 100
+            used_after = after[size_field] * after[percent_field] / 100
+            lines.append("%s %s (%.1f%% -> %.1f%%)" %
+                         (kind, human_size(used_before - used_after),
+                          before[percent_field], after[percent_field]))
+        log.info("Reclaimed %s" % ", ".join(lines))
+
+    def _reclaimable_space(self, bases, remove_bases):
+        try:
+            space = self.imgbase.reclaimable_space(
+                bases=[b for b in bases if b in remove_bases])
+            return dict((base, " (at least %s)" % human_size(size))
+                        for base, size in space)
+        except Exception:
+            log.debug("Failed to get the reclaimable space", exc_info=True)
+            return {}
 
     def _filter_candidates(self, bases, current_layer_base, new_base, keep):
         """
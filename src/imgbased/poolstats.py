@@ -0,0 +1,179 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import logging
+import os
+import time
+
+from . import constants
+
+log = logging.getLogger(__package__)
+
+
+def human_duration(seconds):
+    """
+    >>> human_duration(90)
+    '1 minute'
+    >>> human_duration(7200)
+    '2 hours'
+    >>> human_duration(3 * 86400 + 7200)
+    '3 days'
+    >>> human_duration(None)
+    'never'
+    """
+    if seconds is None:
+        return "never"
+    for unit, length in [("day", 86400), ("hour", 3600),
+                         ("minute", 60), ("second", 1)]:
+        if seconds >= length or unit == "second":
+            count = int(seconds // length)
+            return "%d %s%s" % (count, unit, "" if count == 1 else "s")
+
+
+class PoolStats(object):
+    """A ring buffer of thin pool usage samples
+
+    A sample is taken after every operation which is allocating or
+    freeing space in the pool (add_base, add_layer, gc, volume-create),
+    the samples are used to forecast when the pool data or metadata
+    will reach the autoextend threshold or run full.
+    """
+    path = constants.IMGBASED_POOL_STATS
+    max_samples = 512
+
+    kinds = {"data": ("lv_size", "data_percent"),
+             "metadata": ("lv_metadata_size", "metadata_percent")}
+
+    def __init__(self, path=None):
+        self.path = path or self.path
+
+    def samples(self, pool_name=None):
+        try:
+            with open(self.path) as src:
+                samples = json.load(src)
+        except (IOError, OSError, ValueError):
+            return []
+        return [s for s in samples
+                if pool_name is None or s["pool"] == pool_name]
+
+    def _write(self, samples):
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmpfile = self.path + ".%d" % os.getpid()
+        with open(tmpfile, "w") as dst:
+            json.dump(samples, dst)
+        os.rename(tmpfile, self.path)
+
+    def record(self, pool, operation, now=None):
+        """Record the current usage of the pool, a failure is not fatal
+        """
+        try:
+            sample = pool.usage(cached=False)
+            sample.update({"time": now or time.time(),
+                           "operation": operation,
+                           "pool": pool.lvm_name})
+            samples = self.samples() + [sample]
+            self._write(samples[-self.max_samples:])
+            log.debug("Recorded pool usage: %s" % sample)
+            return sample
+        except Exception:
+            log.debug("Failed to record the pool usage", exc_info=True)
+
+    @classmethod
+    def forecast(cls, samples, kind, threshold):
+        """Project the usage linearly (least squares over the used bytes)
+
+        Returns the growth in bytes per second and the seconds until the
+        threshold and 100% are reached, None if that is not going to
+        happen.
+
+        >>> day = 86400
+        >>> samples = [{"time": n * day, "lv_size": 1000.0,
+        ...             "data_percent": 10.0 + n * 5}
+        ...            for n in range(5)]
+        >>> rate, to_threshold, to_full = PoolStats.forecast(samples,
+        ...                                                  "data", 70)
+        >>> round(rate * day), to_threshold // day, to_full // day
+        (50, 8.0, 14.0)
+        >>> PoolStats.forecast(samples[:1], "data", 70)
+        (None, None, None)
+        """
+        size_field, percent_field = cls.kinds[kind]
+        if len(samples) < 2:
+            return (None, None, None)
+        t0 = samples[0]["time"]
+        xs = [s["time"] - t0 for s in samples]
+        ys = [s[size_field] * s[percent_field] / 100 for s in samples]
+        n = float(len(samples))
+        mean_x, mean_y = sum(xs) / n, sum(ys) / n
+        var = sum((x - mean_x) ** 2 for x in xs)
+        if not var:
+            return (None, None, None)
+        rate = sum((x - mean_x) * (y - mean_y)
+                   for x, y in zip(xs, ys)) / var
+
+        last = samples[-1]
+        size, used = last[size_field], ys[-1]
+
+        def eta(percent):
+            left = size * percent / 100.0 - used
+            if left <= 0:
+                return 0
+            return left / rate if rate > 0 else None
+
+        return (rate, eta(threshold), eta(100))
+
+    def report(self, pool):
+        samples = self.samples(pool.lvm_name)
+        if not samples:
+            return "No usage samples for pool %s yet" % pool.lvm_name
+        try:
+            threshold = pool.autoextend_threshold()
+        except Exception:
+            log.debug("Failed to get the autoextend threshold",
+                      exc_info=True)
+            threshold = 100
+
+        last = samples[-1]
+        lines = ["Pool %s: %d samples since %s, last after %s" %
+                 (pool.lvm_name, len(samples),
+                  time.strftime("%Y-%m-%d %H:%M",
+                                time.localtime(samples[0]["time"])),
+                  last["operation"])]
+        for kind in sorted(self.kinds):
+            size_field, percent_field = self.kinds[kind]
+            rate, to_threshold, to_full = self.forecast(samples, kind,
+                                                        threshold)
+            line = "%s: %.1f%% of %.1fG" % (kind.capitalize(),
+                                            last[percent_field],
+                                            last[size_field] / 1024 ** 3)
+            if rate is not None:
+                line += ", %+.1fM/day" % (rate * 86400 / 1024 ** 2)
+                if threshold < 100:
+                    line += (", autoextend threshold (%d%%) in %s" %
+                             (threshold, human_duration(to_threshold)))
+                line += ", full in %s" % human_duration(to_full)
+            lines.append(line)
+        return "\n".join(lines)
+
+# vim: sw=4 et sts=4:
@@ -21,19 +21,25 @@
 # Author(s): Fabian Deutsch <fabiand@redhat.com>
 #
 
+import atexit
 import glob
+import json
 import logging
 import os
 import re
+import select
 import shlex
 import shutil
 import subprocess
 import sys
 import tempfile
 import threading
+import time
 import traceback
+from collections import namedtuple
 from contextlib import contextmanager
 
+import six
 from six.moves.queue import Queue
 
 from . import command, constants
@@ -265,8 +271,15 @@ class Filesystem():
     def randomize_uuid(self):
         raise NotImplementedError
 
+    def grow(self, mountpoint):
+        """Grow the mounted filesystem to the size of the device
+        """
+        raise NotImplementedError
+
 
 class Ext4(Filesystem):
+    kernel_features = "/sys/fs/ext4/features"
+
     @staticmethod
     def mkfs(path, debug=False):
         cmd = ["mkfs.ext4", "-E", "discard", path]
@@ -275,7 +288,88 @@ class Ext4(Filesystem):
         log.debug("Running: %s" % cmd)
         command.call(cmd, stderr=subprocess.STDOUT)
 
+    @staticmethod
+    def _parse_superblock(data):
+        """Parse the output of dumpe2fs -h
+
+        >>> sb = Ext4._parse_superblock('''dumpe2fs 1.45.6 (20-Mar-2020)
+        ... Filesystem features:      has_journal extent metadata_csum
+        ... Filesystem state:         clean
+        ... Last mount time:          Tue Mar  3 10:00:00 2020
+        ... Last checked:             n/a
+        ... ''')
+        >>> sb["features"], sb["state"]
+        (['has_journal', 'extent', 'metadata_csum'], 'clean')
+        >>> sb["last_mount"] > 0, sb["last_checked"]
+        (True, None)
+        """
+        fields = {}
+        for line in data.splitlines():
+            key, sep, value = line.partition(":")
+            if sep:
+                fields[key.strip()] = value.strip()
+
+        def timestamp(key):
+            try:
+                return time.mktime(time.strptime(
+                    " ".join(fields[key].split()), "%a %b %d %H:%M:%S %Y"))
+            except (KeyError, ValueError):
+                return None
+
+        return {"features": fields.get("Filesystem features", "").split(),
+                "state": fields.get("Filesystem state"),
+                "last_mount": timestamp("Last mount time"),
+                "last_checked": timestamp("Last checked")}
+
+    def superblock(self):
+        env = dict(os.environ, LC_ALL="C")
+        data = command.call(["dumpe2fs", "-h", self.path], env=env)
+        return self._parse_superblock(data.decode("utf-8"))
+
+    def _uuid_strategy(self, sb):
+        """Find out if tune2fs can change the UUID without a full check
+
+        This is only the case if the filesystem is clean, i.e. the origin
+        was frozen while the snapshot was taken, and no checksum needs to
+        be rewritten, or all of them can be rewritten safely.
+        Returns the tune2fs arguments and a description, None if the fs
+        needs to be checked first.
+        """
+        features = sb["features"]
+        if sb["state"] != "clean" or "needs_recovery" in features:
+            return None
+        if "metadata_csum" not in features or \
+                "metadata_csum_seed" in features:
+            return ["-U", "random"], "no checksums to rewrite"
+        if os.path.exists(os.path.join(self.kernel_features,
+                                       "metadata_csum_seed")):
+            return (["-O", "metadata_csum_seed", "-U", "random"],
+                    "enabled metadata_csum_seed")
+        if sb["last_checked"] and sb["last_mount"] and \
+                sb["last_checked"] >= sb["last_mount"]:
+            return ["-U", "random"], "freshly checked"
+        return None
+
     def randomize_uuid(self):
+        try:
+            strategy = self._uuid_strategy(self.superblock())
+        except subprocess.CalledProcessError:
+            log.debug("Failed to read the superblock", exc_info=True)
+            strategy = None
+
+        if strategy:
+            args, reason = strategy
+            cmd = ["tune2fs"] + args + [self.path]
+            log.debug("Running: %s" % cmd)
+            try:
+                command.call(cmd, stderr=subprocess.STDOUT)
+                log.info("Changed the UUID of %s without a check (%s)" %
+                         (self.path, reason))
+                return
+            except subprocess.CalledProcessError:
+                # tune2fs is refusing the change if a check is needed
+                log.info("Falling back to a full check of %s" % self.path)
+
         cmd = ["e2fsck", "-y", "-f", self.path]
         log.debug("Running: %s" % cmd)
         try:
@@ -286,6 +380,12 @@ class Ext4(Filesystem):
         cmd = ["tune2fs", "-U", "random", self.path]
         log.debug("Running: %s" % cmd)
         command.call(cmd, stderr=subprocess.STDOUT)
+        log.info("Changed the UUID of %s after a full check" % self.path)
+
+    def grow(self, mountpoint):
+        cmd = ["resize2fs", self.path]
+        log.debug("Running: %s" % cmd)
+        command.call(cmd, stderr=subprocess.STDOUT)
 
 
 class XFS(Filesystem):
@@ -297,16 +397,103 @@ class XFS(Filesystem):
         log.debug("Running: %s" % cmd)
         command.call(cmd, stderr=subprocess.STDOUT)
 
+    def _generate_uuid(self):
+        cmd = ["xfs_admin", "-U", "generate", self.path]
+        log.debug("Running: %s" % cmd)
+        output = command.call(cmd, stderr=subprocess.STDOUT)
+        # xfs_db refuses to change the UUID if the log is dirty
+        if b"ERROR" in output:
+            raise subprocess.CalledProcessError(1, cmd, output)
+
     def randomize_uuid(self):
+        try:
+            self._generate_uuid()
+            log.info("Changed the UUID of %s, the log was clean" %
+                     self.path)
+            return
+        except subprocess.CalledProcessError:
+            log.info("The log of %s needs to be replayed" % self.path)
+
         with mounted(self.path, options="nouuid"):
             # The fs needs to be mounted once to replay
             # eventual metadata
             pass
-        cmd = ["xfs_admin", "-U", "generate", self.path]
+        self._generate_uuid()
+        log.info("Changed the UUID of %s after replaying the log" %
+                 self.path)
+
+    def grow(self, mountpoint):
+        cmd = ["xfs_growfs", mountpoint]
         log.debug("Running: %s" % cmd)
         command.call(cmd, stderr=subprocess.STDOUT)
 
 
+def sparse_copy(src, dst, blocksize=1024 ** 2):
+    """Copy the file src onto dst, but skip the blocks which are all zero
+
+    dst is expected to read as zeros already, like a new thin volume, thus
+    the zero blocks are not provisioned in the pool. If the pool is not
+    zeroing new chunks, blocksize must be a multiple of the chunk size.
+    Returns the number of bytes written and skipped.
+    """
+    zeros = b"\0" * blocksize
+    written = skipped = 0
+    with open(src, "rb") as srcf, open(dst, "r+b") as dstf:
+        while True:
+            block = srcf.read(blocksize)
+            if not block:
+                break
+            if block == zeros[:len(block)]:
+                dstf.seek(len(block), os.SEEK_CUR)
+                skipped += len(block)
+            else:
+                dstf.write(block)
+                written += len(block)
+        if os.path.isfile(dst):
+            # A trailing hole does not extend a regular file
+            dstf.truncate(written + skipped)
+        dstf.flush()
+        os.fsync(dstf.fileno())
+    log.debug("Copied %s to %s, %s written, %s skipped" %
+              (src, dst, human_size(written), human_size(skipped)))
+    return written, skipped
+
+
+def human_size(size):
+    """
+    >>> human_size(512)
+    '512B'
+    >>> human_size(3 * 1024 ** 3 + 1)
+    '3.0G'
+    """
+    for unit in ["B", "K", "M", "G"]:
+        if abs(size) < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = "T"
+    return ("%d%s" if unit == "B" else "%.1f%s") % (size, unit)
+
+
+def size_in_units(size, units="m"):
+    """Convert a size in bytes to the given LVM units, lower case units
+    are powers of 1024, upper case ones powers of 1000
+
+    >>> size_in_units(3 * 1024 ** 2)
+    3.0
+    >>> size_in_units(1500, "K")
+    1.5
+    >>> size_in_units(4096, "s")
+    8.0
+    """
+    if units in ["b", "B"]:
+        return float(size)
+    if units in ["s", "S"]:
+        return size / 512.0
+    exponent = "kmgtpe".index(units.lower()) + 1
+    return size / float((1024 if units.islower() else 1000) ** exponent)
+
+
 def findls(path):
     return ExternalBinary().find(["-ls"], cwd=path).splitlines(True)
 
@@ -411,6 +598,18 @@ class ExternalBinary(object):
     def sync(self, args, **kwargs):
         return self.call(["sync"] + args, **kwargs)
 
+    def vgcfgbackup(self, args, **kwargs):
+        return self.call(["vgcfgbackup"] + args, **kwargs)
+
+    def udevadm(self, args, **kwargs):
+        return self.call(["udevadm"] + args, **kwargs)
+
+    def dmsetup(self, args, **kwargs):
+        return self.call(["dmsetup"] + args, **kwargs)
+
+    def thin_ls(self, args, **kwargs):
+        return self.call(["thin_ls"] + args, **kwargs)
+
 
 class LvmBinary(ExternalBinary):
     def call(self, *args, **kwargs):
@@ -418,17 +617,254 @@ class LvmBinary(ExternalBinary):
             return super(LvmBinary, self).call(*args, stderr=DEVNULL, **kwargs)
 
 
+class LvmShellUnavailable(Exception):
+    pass
+
+
+class LvmShell(object):
+    """A long-living `lvm shell` session
+
+    Every one-shot LVM command is loading the configuration, taking locks
+    and scanning the devices again. The shell is doing this once, the
+    commands are then fed over a pipe.
+    Reports and the command log are read in JSON format from a separate
+    report fd (LVM_REPORT_FD), the command log is used to find out if a
+    command succeeded.
+
+    All commands are sent to the shell by a single worker thread, other
+    threads are queueing their requests, thus the session can be shared
+    between the threads of i.e. the osupdater.
+
+    The session is optional, and enabled with IMGBASED_LVM_SHELL=1.
+    A shell which exits or does not respond within timeout seconds is
+    stopped, and the commands are run as one-shot commands again.
+    """
+    command = ["lvm"]
+    prompt = b"lvm> "
+    timeout = 300
+    log_config = 'log {report_command_log=1 command_log_selection="all"}'
+    mutating_commands = ["lvcreate", "lvchange", "lvremove", "lvrename",
+                         "lvextend", "vgcreate", "vgchange"]
+
+    _session = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def session(cls):
+        """Returns the shared session, or None if it is not usable
+        """
+        if not os.getenv("IMGBASED_LVM_SHELL"):
+            return None
+        with cls._lock:
+            if cls._session is None:
+                cls._session = LvmShell()
+                cls._session.start()
+            return cls._session if cls._session.alive else None
+
+    def __init__(self):
+        self.alive = False
+        self._proc = None
+        self._report_fd = None
+        self._requests = Queue()
+        self._started = threading.Event()
+        self._worker = threading.Thread(target=self._serve,
+                                        name="lvm-shell")
+        self._worker.daemon = True
+
+    def start(self):
+        self._worker.start()
+        self._started.wait()
+        if self.alive:
+            atexit.register(self.stop)
+
+    def stop(self):
+        if self.alive:
+            self._requests.put((None, None))
+            self._worker.join()
+
+    def accepts(self, argv):
+        """Only mutating commands and JSON reports can be run in the shell
+
+        The reports of the shell are in JSON format, callers parsing the
+        plain text reports are getting them from a one-shot command.
+        """
+        if not all(self._quote(arg) is not None for arg in argv):
+            return False
+        return (argv[0] in self.mutating_commands or
+                "json" in [v for k, v in zip(argv, argv[1:])
+                           if k == "--reportformat"])
+
+    def call(self, argv):
+        if not self.alive:
+            raise LvmShellUnavailable("The LVM shell is not running")
+        reply = Queue()
+        self._requests.put((argv, reply))
+        exc, result = reply.get()
+        if exc:
+            raise exc
+        return result
+
+    @staticmethod
+    def _quote(arg):
+        """The shell is splitting lines on whitespace, quotes are only
+        recognized at the beginning of an argument
+        """
+        if arg and not re.search("[\\s'\"#]", arg):
+            return arg
+        if "'" not in arg:
+            return "'%s'" % arg
+        if '"' not in arg:
+            return '"%s"' % arg
+        return None
+
+    def _spawn(self):
+        report_r, report_w = os.pipe()
+        env = dict(os.environ)
+        env.update({"LC_ALL": "C", "LVM_REPORT_FD": str(report_w)})
+        kwargs = {"pass_fds": (report_w,)} if six.PY3 else \
+            {"close_fds": False}
+        with open(os.devnull, "w") as DEVNULL:
+            self._proc = subprocess.Popen(self.command,
+                                          stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE,
+                                          stderr=DEVNULL, env=env, **kwargs)
+        os.close(report_w)
+        self._report_fd = report_r
+        self._read_until_prompt()
+
+        # Ensure that this LVM is providing the command log we rely on
+        out, report = self._run(["vgs", "-o", "vg_name"])
+        if "log" not in report:
+            raise LvmShellUnavailable("No command log in the LVM shell")
+
+    def _read_until_prompt(self):
+        stdout_fd = self._proc.stdout.fileno()
+        out, report = bytes(), bytes()
+        deadline = time.time() + self.timeout
+        while not out.endswith(self.prompt):
+            remaining = deadline - time.time()
+            ready = select.select([stdout_fd, self._report_fd], [], [],
+                                  max(remaining, 0))[0]
+            if not ready and remaining <= 0:
+                self._proc.kill()
+                raise LvmShellUnavailable("The LVM shell did not respond "
+                                          "within %ss" % self.timeout)
+            if stdout_fd in ready:
+                data = os.read(stdout_fd, 65536)
+                if not data:
+                    raise LvmShellUnavailable("The LVM shell exited")
+                out += data
+            if self._report_fd in ready:
+                report += os.read(self._report_fd, 65536)
+        # The report was written before the prompt, drain what is left
+        while select.select([self._report_fd], [], [], 0)[0]:
+            data = os.read(self._report_fd, 65536)
+            if not data:
+                break
+            report += data
+        return (out[:-len(self.prompt)].decode(errors="replace").strip(),
+                report.decode(errors="replace").strip())
+
+    def _run(self, argv):
+        if "--reportformat" not in argv:
+            argv = argv + ["--reportformat", "json"]
+        if "--config" in argv:
+            # Only one --config is taken, the log settings are merged in
+            idx = argv.index("--config") + 1
+            argv = argv[:idx] + [argv[idx] + " " + self.log_config] + \
+                argv[idx + 1:]
+        else:
+            argv = argv + ["--config", self.log_config]
+        line = " ".join(self._quote(arg) for arg in argv)
+        log.debug("Calling in LVM shell: %s" % line)
+        self._proc.stdin.write(line.encode("utf-8") + b"\n")
+        self._proc.stdin.flush()
+        out, report = self._read_until_prompt()
+        return (out, json.loads(report) if report else {})
+
+    def _execute(self, argv):
+        out, report = self._run(argv)
+        logs = report.pop("log", [])
+        ret_code = int(logs[-1]["log_ret_code"]) if logs else 0
+        if ret_code != 1:
+            # 1 is ECMD_PROCESSED
+            raise subprocess.CalledProcessError(ret_code, argv,
+                                                out.encode("utf-8"))
+        if "report" in report:
+            return json.dumps(report)
+        return out
+
+    def _serve(self):
+        try:
+            self._spawn()
+            self.alive = True
+        except Exception:
+            log.debug("Failed to start the LVM shell", exc_info=True)
+        finally:
+            self._started.set()
+
+        while self.alive:
+            argv, reply = self._requests.get()
+            if argv is None:
+                break
+            try:
+                reply.put((None, self._execute(argv)))
+            except subprocess.CalledProcessError as e:
+                reply.put((e, None))
+            except Exception as e:
+                log.debug("LVM shell failed", exc_info=True)
+                self.alive = False
+                reply.put((LvmShellUnavailable(str(e)), None))
+
+        self.alive = False
+        # Requests which were queued meanwhile are run one-shot
+        while not self._requests.empty():
+            argv, reply = self._requests.get()
+            if reply:
+                reply.put((LvmShellUnavailable("The LVM shell stopped"),
+                           None))
+        if self._proc and self._proc.poll() is None:
+            try:
+                self._proc.stdin.write(b"exit\n")
+                self._proc.stdin.close()
+            except Exception:
+                pass
+            self._proc.wait()
+
+
+class LvmCommand(object):
+    """An LVM command which is run in the LvmShell session if possible,
+    and as a one-shot command otherwise
+    """
+    def __init__(self, name, binary):
+        self.name = name
+        self.binary = binary
+
+    def __call__(self, args, **kwargs):
+        argv = [self.name] + args
+        shell = LvmShell.session()
+        if shell and not kwargs and shell.accepts(argv):
+            try:
+                stdout = shell.call(argv)
+                log.debug("Returned: %s" % stdout[0:1024])
+                return stdout
+            except LvmShellUnavailable:
+                log.debug("Falling back to one-shot command: %s" % argv)
+        return getattr(self.binary, self.name)(args, **kwargs)
+
+
 class LvmCLI():
-    lvs = LvmBinary().lvs
-    vgs = LvmBinary().vgs
-    lvcreate = ExternalBinary().lvcreate
-    lvchange = LvmBinary().lvchange
-    lvremove = LvmBinary().lvremove
-    lvrename = LvmBinary().lvrename
-    lvextend = LvmBinary().lvextend
-    vgcreate = LvmBinary().vgcreate
-    vgchange = LvmBinary().vgchange
-    lvmconfig = LvmBinary().lvmconfig
+    lvs = LvmCommand("lvs", LvmBinary())
+    vgs = LvmCommand("vgs", LvmBinary())
+    lvcreate = LvmCommand("lvcreate", ExternalBinary())
+    lvchange = LvmCommand("lvchange", LvmBinary())
+    lvremove = LvmCommand("lvremove", LvmBinary())
+    lvrename = LvmCommand("lvrename", LvmBinary())
+    lvextend = LvmCommand("lvextend", LvmBinary())
+    vgcreate = LvmCommand("vgcreate", LvmBinary())
+    vgchange = LvmCommand("vgchange", LvmBinary())
+    vgcfgbackup = LvmCommand("vgcfgbackup", LvmBinary())
+    lvmconfig = LvmCommand("lvmconfig", LvmBinary())
 
 
 class SELinux(object):
@@ -572,12 +1008,22 @@ class Fstab(File):
 <swap> swap swap defaults 0 0
 """
 
-    class Entry():
-        _index = None
-        source = None
-        target = None
-        fs = None
-        options = []
+    class Entry(object):
+        """An fstab line
+
+        >>> a, b = Fstab.Entry(), Fstab.Entry()
+        >>> a.options.append("discard")
+        >>> b.options
+        []
+        """
+        __slots__ = ("_index", "source", "target", "fs", "options")
+
+        def __init__(self, source=None, target=None, fs=None, options=None):
+            self._index = target  # target is unique
+            self.source = source
+            self.target = target
+            self.fs = fs
+            self.options = options if options is not None else []
 
         def __repr__(self):
             return ("<Entry {self._index} {self.source} {self.target} "
@@ -602,13 +1048,8 @@ class Fstab(File):
             if line.startswith("#") or line.strip() == "":
                 continue
             source, target, fs, options = shlex.split(line)[:4]
-            entry = Fstab.Entry()
-            entry._index = target  # target is unique
-            entry.source = source
-            entry.target = target
-            entry.fs = fs
-            entry.options = options.split(",")
-            entries.append(entry)
+            entries.append(Fstab.Entry(source, target, fs,
+                                       options.split(",")))
 
         return sorted(entries, key=lambda e: e._index)
 
@@ -983,22 +1424,240 @@ class systemctl():
 
 
 class Tar():
-    def __init__(self):
-        pass
+    """Copy a tree with tar, keeping the SELinux labels, xattrs and ACLs
 
-    def sync(self, source, dst):
-        default_args = ["--selinux", "--xattrs", "--acls",
-                        "--xattrs-include=*", "--warning=no-timestamp"]
-        srccmd = ["tar", "cf", "-"] + default_args + ["-C", source, "."]
+    With more than one job the tree is split into sets of subtrees with
+    about the same number of bytes, every set is copied by a tar pipeline
+    of its own, which also parallelizes the decompression if the source
+    is i.e. a loop mounted squashfs.
+    """
+    default_args = ["--selinux", "--xattrs", "--acls",
+                    "--xattrs-include=*", "--warning=no-timestamp"]
+    # How deep large directories are split into their children
+    max_depth = 2
+
+    def __init__(self, jobs=1):
+        self.jobs = jobs
+
+    def _pipeline(self, source, dst, paths=None, recursion=True):
+        srccmd = ["tar", "cf", "-"] + self.default_args + ["-C", source]
+        if not recursion:
+            srccmd.append("--no-recursion")
+        srccmd += paths or ["."]
         log.debug("Calling binary: %s" % srccmd)
         src = subprocess.Popen(srccmd, stdout=subprocess.PIPE)
 
-        dstcmd = ["tar", "xBf", "-"] + default_args + ["-C", dst]
+        dstcmd = ["tar", "xBf", "-"] + self.default_args + ["-C", dst]
         log.debug("Calling binary: %s" % dstcmd)
         dstproc = subprocess.Popen(dstcmd, stdin=src.stdout)
-        dstproc.communicate()
+        src.stdout.close()
+        return [(srccmd, src), (dstcmd, dstproc)]
+
+    def sync(self, source, dst):
+        if self.jobs > 1:
+            self._sync_parallel(source, dst)
+        else:
+            self._wait(source, self._pipeline(source, dst))
         log.debug("Done syncing new filesystem")
 
+    @staticmethod
+    def _wait(source, procs):
+        [proc.wait() for _, proc in procs]
+        # tar exits with 1 if files changed while reading them
+        failed = [cmd for cmd, proc in procs if proc.returncode > 1]
+        if failed:
+            raise RuntimeError("Failed to sync %s: %s" % (source, failed))
+
+    def _sync_parallel(self, source, dst):
+        sets, dirs = self.split(source, self.jobs)
+        log.debug("Syncing %s with %d tar pipelines" % (source, len(sets)))
+        procs = []
+        for paths in sets:
+            procs += self._pipeline(source, dst, paths)
+        [proc.wait() for _, proc in procs]
+
+        # The split directories are created on demand by the pipelines,
+        # their permissions, labels and times are restored afterwards
+        procs += self._pipeline(source, dst, dirs, recursion=False)
+        self._wait(source, procs)
+
+    def unpack(self, stream, dst):
+        """Extract a TarStream into dst
+        """
+        cmd = ["tar", "xBf", "-"] + self.default_args + \
+            ["--pax-option=delete=IMGBASED.*", "-C", dst]
+        log.debug("Calling binary: %s" % cmd)
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        try:
+            stream.copy_to(proc.stdin)
+        finally:
+            proc.stdin.close()
+            proc.wait()
+        stream.close()
+        if proc.returncode > 1:
+            raise RuntimeError("Failed to extract the stream: %s" % cmd)
+        log.debug("Done extracting the stream")
+
+    @staticmethod
+    def _measure(path):
+        """The bytes below path, and the inodes which have several links
+        """
+        size = 0
+        inodes = set()
+        paths = [path]
+        if os.path.isdir(path) and not os.path.islink(path):
+            for root, dirs, files in os.walk(path):
+                paths += [os.path.join(root, n) for n in dirs + files]
+        for p in paths:
+            st = os.lstat(p)
+            size += st.st_size
+            if st.st_nlink > 1 and not os.path.isdir(p):
+                inodes.add((st.st_dev, st.st_ino))
+        return size, inodes
+
+    @classmethod
+    def split(cls, source, jobs):
+        """Split a tree into at most jobs sets of paths of a similar size
+
+        Directories which are larger than a share are split into their
+        children, these directories are returned separately. Hard linked
+        files are always in the same set.
+        """
+        def children(path):
+            return [os.path.join(path, n)
+                    for n in sorted(os.listdir(os.path.join(source, path)))]
+
+        def is_dir(path):
+            path = os.path.join(source, path)
+            return os.path.isdir(path) and not os.path.islink(path)
+
+        units = dict((p, cls._measure(os.path.join(source, p)))
+                     for p in children("."))
+        share = sum(size for size, _ in units.values()) / float(jobs)
+        dirs = ["."]
+        for _ in range(cls.max_depth):
+            large = [p for p, (size, _) in units.items()
+                     if size > share and is_dir(p) and children(p)]
+            for path in large:
+                del units[path]
+                dirs.append(path)
+                units.update((p, cls._measure(os.path.join(source, p)))
+                             for p in children(path))
+
+        groups = []
+        for path in sorted(units):
+            size, inodes = units[path]
+            group = [size, [path], inodes]
+            for other in [g for g in groups if g[2] & inodes]:
+                groups.remove(other)
+                group = [group[0] + other[0], other[1] + group[1],
+                         group[2] | other[2]]
+            groups.append(group)
+
+        # Largest first into the smallest set
+        sets = [[0, []] for _ in range(jobs)]
+        for size, paths, _ in sorted(groups, key=lambda g: -g[0]):
+            target = min(sets, key=lambda s: s[0])
+            target[0] += size
+            target[1] += paths
+        return [sorted(paths) for _, paths in sets if paths], sorted(dirs)
+
+
+class TarStream(object):
+    """A tar stream, read from a file object
+
+    A zstd, xz or gzip compressed stream is detected by the magic bytes
+    and decompressed by the respective tool. The keywords of the pax
+    global header (if the stream starts with one) are available as
+    headers, i.e. IMGBASED.nvr.
+    """
+    decompressors = [(b"\x28\xb5\x2f\xfd", ["zstd", "-dc"]),
+                     (b"\xfd7zXZ\x00", ["xz", "-dc"]),
+                     (b"\x1f\x8b", ["gzip", "-dc"])]
+    blocksize = 512
+    chunksize = 1024 ** 2
+
+    def __init__(self, src):
+        self._proc = None
+        self._feeder = None
+        magic = src.read(6)
+        cmd = self.decompressor(magic)
+        if cmd:
+            log.debug("Decompressing the stream with %s" % cmd)
+            self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE)
+            self._feeder = ThreadRunner(self._feed, magic, src)
+            self._feeder.daemon = True
+            self._feeder.start()
+            self.stream = self._proc.stdout
+            self.head = b""
+        else:
+            self.stream = src
+            self.head = magic
+
+        self.head += self._read(self.blocksize - len(self.head))
+        self.headers = {}
+        if self.head[156:157] == b"g":
+            size = int(self.head[124:136].strip(b"\0 ") or b"0", 8)
+            blocks = -(-size // self.blocksize)
+            data = self._read(blocks * self.blocksize)
+            self.head += data
+            self.headers = self.parse_pax(data[:size])
+        log.debug("Stream headers: %s" % self.headers)
+
+    def _read(self, size):
+        data = self.stream.read(size)
+        if len(data) < size:
+            raise RuntimeError("The tar stream is truncated")
+        return data
+
+    def _feed(self, head, src):
+        try:
+            self._proc.stdin.write(head)
+            for chunk in iter(lambda: src.read(self.chunksize), b""):
+                self._proc.stdin.write(chunk)
+        finally:
+            self._proc.stdin.close()
+
+    @classmethod
+    def decompressor(cls, magic):
+        """
+        >>> TarStream.decompressor(b"\\x1f\\x8b\\x08\\x00\\x00\\x00")
+        ['gzip', '-dc']
+        >>> TarStream.decompressor(b"./\\x00\\x00\\x00\\x00") is None
+        True
+        """
+        for prefix, cmd in cls.decompressors:
+            if magic.startswith(prefix):
+                return cmd
+
+    @staticmethod
+    def parse_pax(data):
+        """
+        >>> TarStream.parse_pax(b"28 IMGBASED.nvr=Image-1.0-0\\n")
+        {'IMGBASED.nvr': 'Image-1.0-0'}
+        """
+        headers = {}
+        while data.strip(b"\0"):
+            length = int(data.split(b" ", 1)[0])
+            record, data = data[:length], data[length:]
+            key, _, value = record.split(b" ", 1)[1].rstrip(b"\n") \
+                .partition(b"=")
+            headers[key.decode("utf-8")] = value.decode("utf-8")
+        return headers
+
+    def copy_to(self, dst):
+        dst.write(self.head)
+        for chunk in iter(lambda: self.stream.read(self.chunksize), b""):
+            dst.write(chunk)
+
+    def close(self):
+        if self._proc:
+            self._feeder.join_with_exceptions()
+            self._proc.wait()
+            if self._proc.returncode:
+                raise RuntimeError("Failed to decompress the stream")
+
 
 class Rsync():
     checksum_only = False
@@ -1039,7 +1698,7 @@ class Rsync():
         self._run(cmd)
 
 
-class IDMap():
+class IDMap(object):
     """This class can help to detect uid/gid drift an get it fixed
 
     uid/gid drift appears in server side generated images/trees, because
@@ -1061,16 +1720,24 @@ class IDMap():
     Then there is a function which will finally fix the drift on a path
     in the new fs to change the uid/gid to map to the names how they are
     in the old user/group file.
+
+    The id changes and the owners of the paths are kept in tuples.
     """
-    from_etc = None
-    to_etc = None
-    changed_ids = {}
-    _merge_gids = []
-    _merge_uids = []
+    __slots__ = ("from_etc", "to_etc", "group_content", "passwd_content",
+                 "_merge_gids", "_merge_uids", "_new_ugids")
+
+    # An id which changed from old to new
+    Change = namedtuple("Change", ["old", "new"])
+    # The owner of a path in the new tree
+    Owner = namedtuple("Owner", ["path", "uid", "gid"])
 
     def __init__(self, from_etc, to_etc):
         self.from_etc = from_etc
         self.to_etc = to_etc
+        self.group_content = None
+        self.passwd_content = None
+        self._merge_gids = []
+        self._merge_uids = []
         self._new_ugids = False
 
     def _parse_ids(self, id_data):
@@ -1103,7 +1770,7 @@ class IDMap():
         >>> from_map = {"root": "0", "bin": "1", "adm": "2"}
         >>> to_map = {"root": "0", "bin": "2", "adm": "3"}
         >>> IDMap(None, None)._create_idmap(from_map, to_map)
-        [(1, 2), (2, 3)]
+        [Change(old=1, new=2), Change(old=2, new=3)]
         """
         unknown_names = []
         xmap = []
@@ -1114,7 +1781,7 @@ class IDMap():
             tid = to_idmap[fname]
             if fid != tid:
                 log.debug("%s changed from %s to %s" % (fname, fid, tid))
-                xmap.append((int(fid), int(tid)))
+                xmap.append(IDMap.Change(int(fid), int(tid)))
         return sorted(xmap)
 
     def _create_idmaps(self, from_uids, from_gids, to_uids, to_gids):
@@ -1128,7 +1795,7 @@ class IDMap():
 
         >>> IDMap(None, None)._create_idmaps(from_uids, from_gids,
         ... to_uids, to_gids)
-        ([(1, 2)], [(1, 2), (2, 3)])
+        ([Change(old=1, new=2)], [Change(old=1, new=2), Change(old=2, new=3)])
         """
 
         uidmap = self._create_idmap(from_uids, to_uids)
@@ -1136,7 +1803,7 @@ class IDMap():
 
         return (uidmap, gidmap)
 
-    def _merge_ids(self, old_content, new_content, l, tracker={}):
+    def _merge_ids(self, old_content, new_content, l, tracker=None):
         """
         >>> old_content = '''
         ... root:x:0:0:root:/root:/bin/bash
@@ -1172,6 +1839,7 @@ class IDMap():
 
         ids = {}
         changed_ids = {}
+        tracker = tracker or {}
 
         def check_id_in_use(i, j):
             return any([i == int(k) for k in j.values()])
@@ -1209,7 +1877,7 @@ class IDMap():
                                                           fields[2]))
                     ids[name] = i
                     changed_ids[str(old_id)] = i
-                    l.append((int(i), old_id))
+                    l.append(IDMap.Change(int(i), old_id))
 
             try:
                 fields = n.split(":")
@@ -1329,7 +1997,8 @@ class IDMap():
 
         path is expected to be a path with the new uid/gid.
         """
-        # Go through all paths and find their uid/gid
+        # Go through all paths and find their uid/gid, before anything is
+        # changed: a hard link would show the changed owner otherwise
         changed_new_ids = []
         for (dirpath, dirnames, filenames) in os.walk(new_path):
             for fn in dirnames + filenames:
@@ -1338,9 +2007,8 @@ class IDMap():
                     log.debug("File does not exist: %s" % fn)
                     continue
                 st = os.stat(fullfn)
-                uid = st.st_uid
-                gid = st.st_gid
-                changed_new_ids.append((fullfn, uid, gid))
+                changed_new_ids.append(IDMap.Owner(fullfn, st.st_uid,
+                                                   st.st_gid))
 
         # For each new path, see if the uid/gid changed
         new_ids_xlated_to_old = self._map_new_ids_to_old_ids(changed_new_ids)
@@ -50,6 +50,10 @@ WantedBy=local-fs.target
         return where.rstrip("/") in self.volumes()
 
     def create(self, where, size, attach_now=True):
+        with LVM.transaction():
+            self._create(where, size, attach_now)
+
+    def _create(self, where, size, attach_now):
         assert where.startswith("/"), "An absolute path is required"
         assert os.path.isdir(where), "Is no dir: %s" % where
 
@@ -71,6 +75,7 @@ WantedBy=local-fs.target
             pass
 
         log.info("Volume for '%s' was created successful" % where)
+        self.imgbase.record_pool_usage("volume_create")
         self.attach(where, attach_now)
 
     def remove(self, where, force=False):
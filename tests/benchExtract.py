@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Benchmark of the tree copy with one and several tar pipelines, run by
+# hand, i.e. on the mounted rootfs of a liveimg:
+#   PYTHONPATH=src python tests/benchExtract.py [SOURCE [JOBS...]]
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from imgbased.utils import Tar
+
+
+def synthetic_tree(path, files=20000):
+    rnd = random.Random(42)
+    for idx in range(files):
+        dirname = os.path.join(path, "d%d" % (idx % 7),
+                               "s%d" % (idx % 131))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(os.path.join(dirname, "f%d" % idx), "wb") as dst:
+            dst.write(os.urandom(rnd.randint(0, 64 * 1024)))
+
+
+def timed(label, func, *args):
+    begin = time.time()
+    result = func(*args)
+    print("%-40s %8.3fs" % (label, time.time() - begin))
+    return result
+
+
+def main(source=None, jobs=None):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        if not source:
+            source = os.path.join(tmpdir, "src")
+            timed("Creating a synthetic tree", synthetic_tree, source)
+        for count in jobs or [1, 2, 4, os.sysconf("SC_NPROCESSORS_ONLN")]:
+            dst = tempfile.mkdtemp(dir=tmpdir)
+            timed("Tar with %d jobs" % count, Tar(count).sync, source, dst)
+            shutil.rmtree(dst)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else None,
+         [int(arg) for arg in sys.argv[2:]])
+
+# vim: sw=4 et sts=4:
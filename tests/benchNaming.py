@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+# Benchmark of the layout navigation, run by hand:
+#   PYTHONPATH=src python tests/benchNaming.py [count]
+
+import random
+import sys
+import time
+
+from imgbased.naming import NvrNaming
+
+
+def synthetic_names(count, layers_per_base=99):
+    names = []
+    base = 0
+    while len(names) < count:
+        base_nvr = "Image-%d.%d-0" % (base // 10, base % 10)
+        names.append(base_nvr)
+        names.extend("%s+%d" % (base_nvr, idx)
+                     for idx in range(1, layers_per_base + 1))
+        base += 1
+    return names[:count]
+
+
+def linear_layer_before(naming, layer):
+    # The navigation as it was done before the layout was indexed
+    layers = []
+    for b in naming.tree():
+        layers.extend(b.layers)
+    layers = sorted(layers)
+    return layers[layers.index(layer) - 1]
+
+
+def timed(label, func, *args):
+    begin = time.time()
+    result = func(*args)
+    print("%-40s %8.3fs" % (label, time.time() - begin))
+    return result
+
+
+def main(count=10000, lookups=200):
+    naming = NvrNaming(synthetic_names(count))
+    snapshot = timed("Building the indexed snapshot (%d)" % count,
+                     naming.snapshot)
+    sample = random.Random(0).sample(snapshot.layers[1:], lookups)
+
+    linear = timed("%d linear layer_before" % lookups,
+                   lambda: [linear_layer_before(naming, layer)
+                            for layer in sample])
+    indexed = timed("%d indexed layer_before" % lookups,
+                    lambda: [naming.layer_before(layer)
+                             for layer in sample])
+    timed("%d layers(for_base)" % lookups,
+          lambda: [naming.layers(layer.base) for layer in sample])
+    assert linear == indexed
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
+
+# vim: sw=4 et sts=4:
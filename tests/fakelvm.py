@@ -28,13 +28,27 @@ import imgbased
 
 class FakeLVM(imgbased.lvm.LVM):
     _vgs = []
+    # Number of LVM queries which would hit LVM in reality
+    _queries = 0
 
     @staticmethod
     def _list_lv_full_names(filtr=""):
+        FakeLVM._queries += 1
         lvs = [lv for lv in FakeLVM.lvs()]
         debug("LVS %s" % lvs)
         return [lv.lvm_name for lv in lvs]
 
+    @staticmethod
+    def list_lvs_with_tags(any_tag=None):
+        FakeLVM._queries += 1
+        return [(lv, list(lv._tags)) for lv in FakeLVM.lvs()]
+
+    @staticmethod
+    def remove_lvs(lvs, force=False):
+        for lv in lvs:
+            lv.activate(False)
+            lv.remove(force)
+
     @staticmethod
     def lvs():
         lvs = []
@@ -132,7 +146,7 @@ class FakeLVM(imgbased.lvm.LVM):
         def from_path(path):
             raise NotImplementedError()
 
-        def create_snapshot(self, new_name):
+        def create_snapshot(self, new_name, changes=None):
             assert FakeLVM.is_name_valid(new_name)
             lv = FakeLVM.LV()
             lv.vg_name = self.vg_name
@@ -145,6 +159,8 @@ class FakeLVM(imgbased.lvm.LVM):
             lv._permission = self._permission
             debug("Adding LV %s to VG %s" % (lv, lv.vg_name))
             FakeLVM.VG.from_vg_name(lv.vg_name)._lvs.add(lv)
+            if changes:
+                lv.change(changes)
             return lv
 
         def remove(self, force=False):
@@ -165,6 +181,16 @@ class FakeLVM(imgbased.lvm.LVM):
             assert val in ["r", "rw"]
             self._permission = val
 
+        def change(self, changes):
+            if changes.perm is not None:
+                self.permission(changes.perm)
+            if changes.activationskip is not None:
+                self.setactivationskip(changes.activationskip)
+            for tag in changes.tags:
+                self.addtag(tag)
+            if changes.active is not None:
+                self.activate(changes.active, changes.ignoreactivationskip)
+
         def thinpool(self):
             debug("Thinpool of %s: %s" % (self, self._pool_lv))
             return self._pool_lv
@@ -173,6 +199,7 @@ class FakeLVM(imgbased.lvm.LVM):
             self._tags.add(tag)
 
         def tags(self):
+            FakeLVM._queries += 1
             return self._tags
 
         def origin(self):
@@ -189,7 +216,7 @@ class FakeLVM(imgbased.lvm.LVM):
             self._thin = True
             self._pool = True
 
-        def create_thinvol(self, vol_name, volsize):
+        def create_thinvol(self, vol_name, volsize, changes=None):
             assert FakeLVM.is_name_valid(vol_name)
             lv = FakeLVM.LV()
             lv.vg_name = self.vg_name
@@ -199,6 +226,8 @@ class FakeLVM(imgbased.lvm.LVM):
             lv._pool_lv = self
             FakeLVM.VG.from_vg_name(lv.vg_name)._lvs.add(lv)
             debug("Created thin LV: %s" % lv)
+            if changes:
+                lv.change(changes)
             return lv
 
         def check_metadata_size(self, resize=False):
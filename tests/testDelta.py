@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from imgbased.delta import Delta
+
+
+def fake_encode(old, new, delta):
+    # The "delta" is the new content, but smaller than the file
+    with open(new, "rb") as src, open(delta, "wb") as dst:
+        dst.write(src.read().rstrip(b"x"))
+
+
+def fake_decode(old, delta, new):
+    with open(delta, "rb") as src, open(new, "wb") as dst:
+        data = src.read()
+        dst.write(data + b"x" * (os.path.getsize(old) - len(data)))
+
+
+class DeltaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.old = os.path.join(self.tmpdir, "old")
+        self.new = os.path.join(self.tmpdir, "new")
+        self.target = os.path.join(self.tmpdir, "target")
+        self.artifact = os.path.join(self.tmpdir, "update.delta")
+
+        self.write(self.old, {"usr/lib/big": b"a" + b"x" * 100000,
+                              "usr/lib/same": b"same",
+                              "etc/gone": b"gone",
+                              "etc/conf": b"old"})
+        os.makedirs(os.path.join(self.old, "var/dir"))
+        self.write(self.new, {"usr/lib/big": b"b" + b"x" * 100000,
+                              "usr/lib/same": b"same",
+                              "etc/conf": b"new",
+                              "etc/added": b"added",
+                              "var/dir": b"now a file"})
+        os.chmod(os.path.join(self.new, "etc/conf"), 0o600)
+        shutil.copytree(self.old, self.target, symlinks=True)
+
+        self.patches = [patch.object(Delta, "_encode",
+                                     staticmethod(fake_encode)),
+                        patch.object(Delta, "_decode",
+                                     staticmethod(fake_decode))]
+        [p.start() for p in self.patches]
+
+    def tearDown(self):
+        [p.stop() for p in self.patches]
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, root, files):
+        for path, data in files.items():
+            path = os.path.join(root, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as dst:
+                dst.write(data)
+
+    def test_make_and_apply(self):
+        Delta.make(self.old, self.new, self.artifact, "Image-1.0-0",
+                   "Image-1.1-0")
+        with Delta.open(self.artifact) as delta:
+            self.assertEqual(delta.manifest["from"], "Image-1.0-0")
+            self.assertEqual(delta.manifest["removed"],
+                             ["./etc/gone", "./var/dir"])
+            # Only the large file with the same metadata is patched
+            self.assertEqual(sorted(delta.manifest["deltas"]),
+                             ["./usr/lib/big"])
+            delta.apply(self.target)
+            delta.verify(self.target)
+        with open(os.path.join(self.target, "usr/lib/big"), "rb") as src:
+            self.assertEqual(src.read(1), b"b")
+        self.assertEqual(os.stat(os.path.join(self.target, "etc/conf"))
+                         .st_mode & 0o777, 0o600)
+
+    def test_verify_fails_on_changes(self):
+        Delta.make(self.old, self.new, self.artifact, "Image-1.0-0",
+                   "Image-1.1-0")
+        self.write(self.target, {"usr/lib/same": b"tampered"})
+        with Delta.open(self.artifact) as delta:
+            delta.apply(self.target)
+            self.assertRaises(RuntimeError, delta.verify, self.target)
+
+    def test_apply_checks_the_source(self):
+        Delta.make(self.old, self.new, self.artifact, "Image-1.0-0",
+                   "Image-1.1-0")
+        self.write(self.target, {"usr/lib/big": b"c" + b"x" * 100000})
+        with Delta.open(self.artifact) as delta:
+            self.assertRaises(RuntimeError, delta.apply, self.target)
+        # Nothing was changed
+        self.assertTrue(os.path.exists(os.path.join(self.target,
+                                                    "etc/gone")))
+
+# vim: sw=4 et sts=4:
@@ -0,0 +1,413 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from mock import patch
+
+from imgbased.lvm import (LVM, DeviceMapper, LvmState, LvmTransaction,
+                          _invalidates_state)
+from imgbased.utils import LvmCommand, LvmShell
+
+
+FAKE_LVS = {"report": [{"lv": [
+    {"vg_name": "hostvg", "lv_name": "pool0", "lv_path": "",
+     "lv_dm_path": "/dev/mapper/hostvg-pool0", "lv_size": "10737418240",
+     "lv_attr": "twi-aotz--", "lv_tags": "imgbased:pool", "pool_lv": "",
+     "origin": "", "lv_profile": "imgbased-pool", "data_percent": "12.50",
+     "metadata_percent": "3.00", "lv_metadata_size": "1073741824"},
+    {"vg_name": "hostvg", "lv_name": "Image-1.0-0+1",
+     "lv_path": "/dev/hostvg/Image-1.0-0+1",
+     "lv_dm_path": "/dev/mapper/hostvg-Image--1.0--0+1",
+     "lv_size": "5368709120", "lv_attr": "Vwi-aotz--",
+     "lv_tags": "imgbased:layer", "pool_lv": "pool0",
+     "origin": "Image-1.0-0", "lv_profile": "", "data_percent": "20.00",
+     "metadata_percent": "", "lv_metadata_size": ""}]}]}
+
+FAKE_VGS = {"report": [{"vg": [
+    {"vg_name": "hostvg", "vg_tags": "imgbased:vg", "vg_free": "2147483648",
+     "vg_seqno": "42"}]}]}
+
+# A scripted `lvm shell`: reports go to LVM_REPORT_FD, "missing" LVs fail
+# and "stuck" LVs never return
+FAKE_SHELL = """
+import json, os, shlex, sys, time
+report = os.fdopen(int(os.environ["LVM_REPORT_FD"]), "w")
+lvs = %s
+while True:
+    sys.stdout.write("lvm> ")
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line or line.strip() == "exit":
+        break
+    argv = shlex.split(line)
+    if "stuck" in line:
+        time.sleep(60)
+    data = dict(lvs) if argv[0] in ["lvs", "vgs"] else {}
+    data["log"] = [{"log_ret_code": "5" if "missing" in line else "1"}]
+    sys.stdout.write("%%s done\\n" %% argv[0])
+    report.write(json.dumps(data))
+    report.flush()
+""" % json.dumps(FAKE_LVS)
+
+
+class FakeLvmCommands(object):
+    def __init__(self):
+        self.calls = []
+        self.seqno = 42
+
+    def lvs(self, args):
+        self.calls.append(["lvs"] + args)
+        return json.dumps(FAKE_LVS)
+
+    def vgs(self, args):
+        self.calls.append(["vgs"] + args)
+        FAKE_VGS["report"][0]["vg"][0]["vg_seqno"] = str(self.seqno)
+        return json.dumps(FAKE_VGS)
+
+    def lvchange(self, args):
+        self.calls.append(["lvchange"] + args)
+        self.seqno += 1
+        return ""
+
+    def vgcfgbackup(self, args):
+        self.calls.append(["vgcfgbackup"] + args)
+        return ""
+
+    def udevadm(self, args):
+        self.calls.append(["udevadm"] + args)
+        return ""
+
+
+class LvmStateTestCase(unittest.TestCase):
+    def setUp(self):
+        LvmState.invalidate()
+        self.cmds = FakeLvmCommands()
+        self.cache_file = tempfile.mktemp()
+        self.patches = [patch.object(LVM, "_lvs", self.cmds.lvs),
+                        patch.object(LVM, "_vgs", self.cmds.vgs),
+                        patch.object(LvmState, "_disabled", False),
+                        patch.object(LvmState, "cache_file",
+                                     self.cache_file)]
+        [p.start() for p in self.patches]
+
+    def tearDown(self):
+        [p.stop() for p in self.patches]
+        LvmState.invalidate()
+        if os.path.exists(self.cache_file):
+            os.unlink(self.cache_file)
+
+    def test_getters_use_one_snapshot(self):
+        lv = LVM.LV.from_lvm_name("hostvg/Image-1.0-0+1")
+        self.assertEqual(lv.path, "/dev/hostvg/Image-1.0-0+1")
+        self.assertEqual(lv.dm_path, "/dev/mapper/hostvg-Image--1.0--0+1")
+        self.assertEqual(lv.size_bytes, "5368709120B")
+        self.assertEqual(lv.tags(), ["imgbased:layer"])
+        self.assertEqual(lv.thinpool().lv_name, "pool0")
+        self.assertEqual(lv.origin().lv_name, "Image-1.0-0")
+        self.assertEqual(LVM.VG.from_tag("imgbased:vg").vg_name, "hostvg")
+        self.assertEqual(LVM.LV.from_tag("imgbased:pool").lv_name, "pool0")
+        self.assertEqual(len(self.cmds.calls), 2)
+
+    def test_mutation_invalidates(self):
+        lv = LVM.LV.from_lvm_name("hostvg/Image-1.0-0+1")
+        lv.tags()
+        lvchange = _invalidates_state(self.cmds.lvchange).__func__
+        lvchange(["--addtag", "foo", lv.lvm_name])
+        self.assertIsNone(LvmState._current)
+        lv.tags()
+        self.assertEqual([c[0] for c in self.cmds.calls],
+                         ["vgs", "lvs", "lvchange", "vgs", "lvs"])
+
+    def test_cache_is_reused_by_later_processes(self):
+        LVM.LV.from_lvm_name("hostvg/Image-1.0-0+1").tags()
+        # A new process starts without a state
+        LvmState.invalidate()
+        lv = LVM.LV.from_lvm_name("hostvg/Image-1.0-0+1")
+        self.assertEqual(lv.tags(), ["imgbased:layer"])
+        self.assertEqual([c[0] for c in self.cmds.calls],
+                         ["vgs", "lvs", "vgs"])
+
+    def test_metadata_size(self):
+        pool = LVM.Thinpool.from_lvm_name("hostvg/pool0")
+        self.assertEqual(pool._get_metadata_size(), [3.0, 1024.0])
+
+    def test_extend_is_limited_by_vg_free(self):
+        pool = LVM.Thinpool.from_lvm_name("hostvg/pool0")
+        with patch.object(LVM, "_lvextend",
+                          lambda args: self.cmds.calls.append(args)):
+            added = pool.extend(data_bytes=4 * 1024 ** 3,
+                                metadata_bytes=1)
+        self.assertEqual(added, 2 * 1024 ** 3)
+        self.assertEqual(self.cmds.calls[-2:], [
+            ["--poolmetadatasize", "+1m", "hostvg/pool0"],
+            ["--size", "+2047m", "hostvg/pool0"]])
+
+    def test_protect_is_one_lvchange(self):
+        lv = LVM.LV.from_lvm_name("hostvg/Image-1.0-0+1")
+        with patch.object(LVM, "_lvchange", self.cmds.lvchange):
+            lv.protect()
+            # Permission is already rw, so it's left out
+            lv.unprotect()
+        lvchanges = [c for c in self.cmds.calls if c[0] == "lvchange"]
+        self.assertEqual(lvchanges, [
+            ["lvchange", "--permission", "r", "--setactivationskip", "y",
+             "--activate", "n", "--ignoreactivationskip",
+             "hostvg/Image-1.0-0+1"],
+            ["lvchange", "--setactivationskip", "n",
+             "--activate", "y", "--ignoreactivationskip",
+             "hostvg/Image-1.0-0+1"]])
+
+
+class LvmTransactionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cmds = FakeLvmCommands()
+        self.patches = [patch.object(LVM, "_vgcfgbackup",
+                                     self.cmds.vgcfgbackup),
+                        patch("imgbased.lvm.ExternalBinary.udevadm",
+                              lambda _, args: self.cmds.udevadm(args))]
+        [p.start() for p in self.patches]
+        self.lvchange = _invalidates_state(self.cmds.lvchange).__func__
+
+    def tearDown(self):
+        [p.stop() for p in self.patches]
+
+    def test_deferred_backup_and_settle(self):
+        with LVM.transaction() as transaction:
+            self.lvchange(["--addtag", "a", "hostvg/root"])
+            with LVM.transaction():
+                self.lvchange(["--addtag", "b", "hostvg/root"])
+            self.assertEqual(LvmTransaction.active(), transaction)
+        self.assertIsNone(LvmTransaction.active())
+        self.assertEqual(transaction.commits, 2)
+        self.assertEqual([c[0] for c in self.cmds.calls],
+                         ["vgcfgbackup", "lvchange", "lvchange",
+                          "vgcfgbackup", "udevadm"])
+        self.assertEqual(self.cmds.calls[1][-3:],
+                         ["--config", LvmTransaction.config,
+                          "--noudevsync"])
+
+    def test_single_config_option(self):
+        lv = LVM.LV.from_lvm_name("hostvg/root")
+        with patch.object(LVM, "_lvchange",
+                          _invalidates_state(self.cmds.lvchange)), \
+                LVM.transaction():
+            lv.set_profile("imgbased-pool", "config {profile_dir=/tmp}")
+        args = self.cmds.calls[1]
+        self.assertEqual(args.count("--config"), 1)
+        self.assertEqual(args[args.index("--config") + 1],
+                         "config {profile_dir=/tmp} " +
+                         LvmTransaction.config)
+
+    def test_no_transaction(self):
+        self.lvchange(["--addtag", "a", "hostvg/root"])
+        self.assertEqual(self.cmds.calls,
+                         [["lvchange", "--addtag", "a", "hostvg/root"]])
+
+
+class BackgroundRemovalTestCase(unittest.TestCase):
+    def test_waves_in_background(self):
+        calls = []
+
+        def lvremove(args):
+            calls.append((args, threading.current_thread().name))
+            if "hostvg/Foo" in args:
+                raise subprocess.CalledProcessError(5, ["lvremove"] + args)
+
+        runners = []
+        remove_in_background = LVM._remove_in_background
+
+        def background(waves):
+            runners.append(remove_in_background(waves))
+            return runners[-1]
+
+        names = ["Image-1.0-0", "Image-1.0-0+1", "Foo"]
+        origins = {"hostvg/Image-1.0-0+1": "Image-1.0-0"}
+        with patch.object(LVM, "_lvremove", staticmethod(lvremove)), \
+                patch.object(LVM.LV, "dm_path", "/dev/mapper/none"), \
+                patch.object(LVM.LV, "options",
+                             lambda lv, _: [origins.get(lv.lvm_name, "")]), \
+                patch.object(LVM, "_volume_registry",
+                             [LVM.LV.from_lv_name("hostvg", name)
+                              for name in names]), \
+                patch.object(LVM, "_remove_in_background",
+                             staticmethod(background)):
+            LVM.reset_registered_volumes(background=True)
+            self.assertFalse(LVM._volume_registry)
+            runners[0].join_with_exceptions()
+        # The next wave is removed after a failed one
+        self.assertEqual(calls, [
+            (["-ff", "hostvg/Foo", "hostvg/Image-1.0-0+1"], "_remove_waves"),
+            (["-ff", "hostvg/Image-1.0-0"], "_remove_waves")])
+
+    def test_waves_in_foreground(self):
+        calls = []
+
+        def lvremove(args):
+            calls.append((args, threading.current_thread().name))
+
+        names = ["Image-1.0-0", "Image-1.0-0+1", "Foo"]
+        origins = {"hostvg/Image-1.0-0+1": "Image-1.0-0"}
+        with patch.object(LVM, "_lvremove", staticmethod(lvremove)), \
+                patch.object(LVM.LV, "dm_path", "/dev/mapper/none"), \
+                patch.object(LVM.LV, "options",
+                             lambda lv, _: [origins.get(lv.lvm_name, "")]), \
+                patch.object(LVM, "_volume_registry",
+                             [LVM.LV.from_lv_name("hostvg", name)
+                              for name in names]):
+            LVM.reset_registered_volumes()
+            self.assertFalse(LVM._volume_registry)
+        # One lvremove per wave, before returning
+        main = threading.current_thread().name
+        self.assertEqual(calls, [
+            (["-ff", "hostvg/Foo", "hostvg/Image-1.0-0+1"], main),
+            (["-ff", "hostvg/Image-1.0-0"], main)])
+
+
+class FakeLvmBinary(object):
+    def __init__(self):
+        self.calls = []
+
+    def lvchange(self, args):
+        self.calls.append(args)
+        return "one-shot"
+
+
+class LvmShellTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        script = os.path.join(self.tmpdir, "lvm.py")
+        with open(script, "w") as dst:
+            dst.write(FAKE_SHELL)
+        self.patches = [patch.object(LvmShell, "command",
+                                     [sys.executable, script]),
+                        patch.object(LvmShell, "timeout", 2),
+                        patch.object(LvmShell, "_session", None),
+                        patch.dict(os.environ, {"IMGBASED_LVM_SHELL": "1"})]
+        [p.start() for p in self.patches]
+        self.binary = FakeLvmBinary()
+        self.lvchange = LvmCommand("lvchange", self.binary)
+
+    def tearDown(self):
+        if LvmShell._session:
+            LvmShell._session.stop()
+        [p.stop() for p in self.patches]
+        shutil.rmtree(self.tmpdir)
+
+    def test_commands_and_reports(self):
+        shell = LvmShell.session()
+        self.assertTrue(shell.alive)
+        self.assertEqual(self.lvchange(["-an", "hostvg/root"]),
+                         "lvchange done")
+        report = json.loads(shell.call(["lvs", "--reportformat", "json",
+                                        "-o", "lv_name", "hostvg"]))
+        self.assertEqual(report, FAKE_LVS)
+        self.assertEqual(self.binary.calls, [])
+
+    def test_failed_command(self):
+        self.assertRaises(subprocess.CalledProcessError, self.lvchange,
+                          ["-an", "hostvg/missing"])
+        # A failing command is not run again, the shell is still used
+        self.assertTrue(LvmShell.session().alive)
+        self.assertEqual(self.binary.calls, [])
+
+    def test_timeout_falls_back(self):
+        self.assertEqual(self.lvchange(["-an", "hostvg/stuck"]), "one-shot")
+        self.assertIsNone(LvmShell.session())
+        self.assertEqual(self.lvchange(["-an", "hostvg/root"]), "one-shot")
+        self.assertEqual(self.binary.calls, [["-an", "hostvg/stuck"],
+                                             ["-an", "hostvg/root"]])
+
+    def test_unavailable_shell(self):
+        with patch.object(LvmShell, "command", ["false"]):
+            self.assertEqual(self.lvchange(["-an", "hostvg/root"]),
+                             "one-shot")
+        self.assertIsNone(LvmShell.session())
+
+
+class ThinUsageTestCase(unittest.TestCase):
+    def test_thin_usage(self):
+        calls = []
+
+        def dmsetup(_, args):
+            calls.append(args[-1])
+
+        thin_ls = "1 4096 1024 3072\n2 8192 8192 0\n7 512 512 0\n"
+        pool = LVM.Thinpool.from_lvm_name("hostvg/pool0")
+        with patch("imgbased.lvm.ExternalBinary.dmsetup", dmsetup), \
+                patch("imgbased.lvm.ExternalBinary.thin_ls",
+                      lambda _, args: thin_ls), \
+                patch.object(LVM.Thinpool, "thin_ids",
+                             lambda _: {1: "Image-1.0-0",
+                                        2: "Image-1.0-0+1"}):
+            usage = pool.thin_usage()
+        self.assertEqual(calls, ["reserve_metadata_snap",
+                                 "release_metadata_snap"])
+        self.assertEqual(usage, {
+            "Image-1.0-0": {"mapped": 4096, "exclusive": 1024,
+                            "shared": 3072},
+            "Image-1.0-0+1": {"mapped": 8192, "exclusive": 8192,
+                              "shared": 0}})
+
+    def test_provisioning(self):
+        pool = LVM.Thinpool.from_lvm_name("hostvg/pool0")
+        for report, expected in [("  zero$65536\n", (True, 65536)),
+                                 ("  $4194304\n", (False, 4194304))]:
+            with patch.object(LVM, "_lvs", lambda args: report):
+                self.assertEqual(pool.provisioning(), expected)
+
+
+class DeviceMapperTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sysfs = tempfile.mkdtemp()
+        self.patch = patch.object(DeviceMapper, "sysfs", self.sysfs)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        shutil.rmtree(self.sysfs)
+
+    def _add_device(self, devnum, name, uuid):
+        dmdir = os.path.join(self.sysfs, devnum, "dm")
+        os.makedirs(dmdir)
+        for key, value in [("name", name), ("uuid", uuid)]:
+            with open(os.path.join(dmdir, key), "w") as dst:
+                dst.write(value + "\n")
+
+    def test_lv_names_for_devnum(self):
+        lvm_uuid = "LVM-" + "a" * 64
+        self._add_device("253:4", "hostvg-Image--1.0--0+1", lvm_uuid)
+        self._add_device("253:2", "hostvg-pool00-tpool", lvm_uuid + "-tpool")
+        self._add_device("253:7", "luks-root", "CRYPT-LUKS2-abc")
+        self.assertEqual(DeviceMapper.lv_names_for_devnum((253, 4)),
+                         ("hostvg", "Image-1.0-0+1"))
+        self.assertIsNone(DeviceMapper.lv_names_for_devnum((253, 2)))
+        self.assertIsNone(DeviceMapper.lv_names_for_devnum((253, 7)))
+        self.assertIsNone(DeviceMapper.lv_names_for_devnum((8, 1)))
+
+# vim: sw=4 et sts=4:
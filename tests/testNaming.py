@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+
+from imgbased.naming import (NVR, Base, Layer, NvrNaming, label_compare,
+                             rpmvercmp)
+
+try:
+    import rpm
+except ImportError:
+    rpm = None
+
+
+# Taken from rpm's tests/rpmvercmp.at
+RPMVERCMP_VECTORS = """
+1.0 1.0 0
+1.0 2.0 -1
+2.0 1.0 1
+2.0.1 2.0.1 0
+2.0 2.0.1 -1
+2.0.1 2.0 1
+2.0.1a 2.0.1a 0
+2.0.1a 2.0.1 1
+2.0.1 2.0.1a -1
+5.5p1 5.5p1 0
+5.5p1 5.5p2 -1
+5.5p2 5.5p1 1
+5.5p10 5.5p10 0
+5.5p1 5.5p10 -1
+5.5p10 5.5p1 1
+10xyz 10.1xyz -1
+10.1xyz 10xyz 1
+xyz10 xyz10 0
+xyz10 xyz10.1 -1
+xyz10.1 xyz10 1
+xyz.4 xyz.4 0
+xyz.4 8 -1
+8 xyz.4 1
+xyz.4 2 -1
+2 xyz.4 1
+5.5p2 5.6p1 -1
+5.6p1 5.5p2 1
+5.6p1 6.5p1 -1
+6.5p1 5.6p1 1
+6.0.rc1 6.0 1
+6.0 6.0.rc1 -1
+10b2 10a1 1
+10a2 10b2 -1
+1.0aa 1.0aa 0
+1.0a 1.0aa -1
+1.0aa 1.0a 1
+10.0001 10.0001 0
+10.0001 10.1 0
+10.1 10.0001 0
+10.0001 10.0039 -1
+10.0039 10.0001 1
+4.999.9 5.0 -1
+5.0 4.999.9 1
+20101121 20101121 0
+20101121 20101122 -1
+20101122 20101121 1
+2_0 2_0 0
+2.0 2_0 0
+2_0 2.0 0
+a a 0
+a+ a+ 0
+a+ a_ 0
+a_ a+ 0
++a +a 0
++a _a 0
+_a +a 0
++_ +_ 0
+_+ +_ 0
+_+ _ 0
++ _ 0
+_ + 0
+1.0~rc1 1.0~rc1 0
+1.0~rc1 1.0 -1
+1.0 1.0~rc1 1
+1.0~rc1 1.0~rc2 -1
+1.0~rc2 1.0~rc1 1
+1.0~rc1~git123 1.0~rc1~git123 0
+1.0~rc1~git123 1.0~rc1 -1
+1.0~rc1 1.0~rc1~git123 1
+1.0^ 1.0^ 0
+1.0^ 1.0 1
+1.0 1.0^ -1
+1.0^git1 1.0^git1 0
+1.0^git1 1.0 1
+1.0 1.0^git1 -1
+1.0^git1 1.0^git2 -1
+1.0^git2 1.0^git1 1
+1.0^git1 1.01 -1
+1.01 1.0^git1 1
+1.0^20160101 1.0^20160101 0
+1.0^20160101 1.0.1 -1
+1.0.1 1.0^20160101 1
+1.0^20160101^git1 1.0^20160101^git1 0
+1.0^20160102 1.0^20160101^git1 1
+1.0^20160101^git1 1.0^20160102 -1
+1.0~rc1^git1 1.0~rc1^git1 0
+1.0~rc1^git1 1.0~rc1 1
+1.0~rc1 1.0~rc1^git1 -1
+1.0^git1~pre 1.0^git1~pre 0
+1.0^git1 1.0^git1~pre 1
+1.0^git1~pre 1.0^git1 -1
+"""
+
+
+def vectors():
+    for line in RPMVERCMP_VECTORS.strip().splitlines():
+        a, b, expected = line.split()
+        yield a, b, int(expected)
+
+
+class RpmvercmpTestCase(unittest.TestCase):
+    def test_rpm_vectors(self):
+        for a, b, expected in vectors():
+            self.assertEqual(rpmvercmp(a, b), expected, (a, b))
+
+    @unittest.skipIf(rpm is None, "The rpm bindings are not available")
+    def test_rpm_cross_check(self):
+        for a, b, _ in vectors():
+            rpm_version = getattr(rpm, "__version_info__", (0,))
+            if "^" in a + b and rpm_version < (4, 15):
+                # Caret versions are only known to rpm >= 4.15
+                continue
+            self.assertEqual(label_compare((None, a, "1"), (None, b, "1")),
+                             rpm.labelCompare((None, a, "1"),
+                                              (None, b, "1")), (a, b))
+
+    def test_nvr_sort(self):
+        names = ["Image-1.0-0+10", "Image-1.0-0", "Image-1.0-0+2",
+                 "Image-1.0~rc1-0", "Image-1.0-0.1"]
+        self.assertEqual([str(n) for n in sorted(map(NVR.parse, names))],
+                         ["Image-1.0~rc1-0", "Image-1.0-0", "Image-1.0-0.1",
+                          "Image-1.0-0+2", "Image-1.0-0+10"])
+
+
+class NamingSchemeTestCase(unittest.TestCase):
+    names = ["Image-1.0-0", "Image-1.0-0+1", "Image-1.0-0+10",
+             "Image-1.0-0+2", "Image-1.1-0", "Image-1.1-0+1",
+             "Image-2.0-0"]
+
+    def test_navigation(self):
+        naming = NvrNaming(self.names)
+        self.assertEqual([str(i.nvr) for i in naming.images()],
+                         ["Image-1.0-0", "Image-1.0-0+1", "Image-1.0-0+2",
+                          "Image-1.0-0+10", "Image-1.1-0", "Image-1.1-0+1",
+                          "Image-2.0-0"])
+        self.assertEqual(naming.last_base(), Base("Image-2.0-0"))
+        self.assertEqual(naming.last_layer(), Layer("Image-1.1-0+1"))
+        self.assertEqual(naming.layers(Base("Image-1.0-0")),
+                         [Layer("Image-1.0-0+1"), Layer("Image-1.0-0+2"),
+                          Layer("Image-1.0-0+10")])
+        self.assertEqual(naming.layers(Base("Image-3.0-0")), [])
+        self.assertEqual(naming.layer_before(Layer("Image-1.1-0+1")),
+                         Layer("Image-1.0-0+10"))
+        self.assertRaises(AssertionError, naming.layer_before,
+                          Layer("Image-1.0-0+3"))
+        self.assertEqual(naming.suggest_next_layer(naming.bases()[0]),
+                         Layer("Image-1.0-0+11"))
+
+    def test_queries_return_copies(self):
+        naming = NvrNaming(self.names)
+        naming.bases()[0].layers.append(Layer("Image-1.0-0+3"))
+        naming.layers()[0].index = 5
+        naming.tree()[1].layers.pop()
+        self.assertEqual([str(i) for i in naming.images()],
+                         ["Image-1.0-0", "Image-1.0-0+1", "Image-1.0-0+2",
+                          "Image-1.0-0+10", "Image-1.1-0", "Image-1.1-0+1",
+                          "Image-2.0-0"])
+        layer = naming.last_layer()
+        self.assertEqual(layer.base.layers, [layer])
+
+    def test_records_are_compact_and_reused(self):
+        naming = NvrNaming(self.names)
+        base = naming.bases()[0]
+        layer = base.derive_layer(3)
+        for record in [base, layer, base.nvr, layer.nvr]:
+            self.assertFalse(hasattr(record, "__dict__"), record)
+        self.assertIs(layer.base, base)
+        self.assertIs(NVR.parse(base.nvr), base.nvr)
+        self.assertEqual(Layer("Image-1.0-0+3").base.nvr, base.nvr)
+
+# vim: sw=4 et sts=4:
@@ -1,15 +1,20 @@
 #!/usr/bin/env python
 # vim: et ts=4 sw=4 sts=4
 
+import json
 import logging
+import os
+import shutil
 import subprocess
 import sys
+import tarfile
+import tempfile
 import unittest
 from collections import namedtuple
 from logging import debug
 from io import StringIO
 
-from mock import patch
+from mock import MagicMock, patch
 
 import imgbased
 import imgbased.lvm
@@ -124,6 +129,111 @@ class FilesystemTestCase(CliTestCase):
                                    "/_fake_mountpoint_"))
 
 
+class UuidTestCase(unittest.TestCase):
+    superblock = ("Filesystem features:      has_journal %s\n"
+                  "Filesystem state:         %s\n"
+                  "Last mount time:          Tue Mar  3 10:00:00 2020\n"
+                  "Last checked:             Mon Mar  2 10:00:00 2020\n")
+
+    def randomize_uuid(self, features, state="clean", refuse=False):
+        calls = []
+
+        def call(cmd, **kwargs):
+            calls.append(cmd[:-1])
+            if cmd[0] == "dumpe2fs":
+                return (self.superblock % (features, state)).encode()
+            if cmd[0] == "tune2fs" and refuse and len(calls) == 2:
+                raise subprocess.CalledProcessError(1, cmd)
+            return b""
+
+        with patch("imgbased.utils.command.call", call), \
+                patch.object(utils.Ext4, "kernel_features", "/nonexistent"):
+            utils.Ext4("/dev/hostvg/Image-1.0-0+1").randomize_uuid()
+        return calls
+
+    def test_ext4_clean_is_not_checked(self):
+        self.assertEqual(self.randomize_uuid("extent"),
+                         [["dumpe2fs", "-h"], ["tune2fs", "-U", "random"]])
+        self.assertEqual(self.randomize_uuid("metadata_csum "
+                                             "metadata_csum_seed"),
+                         [["dumpe2fs", "-h"], ["tune2fs", "-U", "random"]])
+
+    def test_ext4_check_when_needed(self):
+        full = [["dumpe2fs", "-h"], ["e2fsck", "-y", "-f"],
+                ["tune2fs", "-U", "random"]]
+        self.assertEqual(self.randomize_uuid("extent", "not clean"), full)
+        self.assertEqual(self.randomize_uuid("needs_recovery"), full)
+        # The checksums would need to be rewritten, and the fs was mounted
+        # after the last check
+        self.assertEqual(self.randomize_uuid("metadata_csum"), full)
+        self.assertEqual(self.randomize_uuid("extent", refuse=True),
+                         full[:1] + [["tune2fs", "-U", "random"]] + full[1:])
+
+
+class TarTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, "src")
+        self.dst = os.path.join(self.tmpdir, "dst")
+        os.makedirs(self.dst)
+        for path, size in [("usr/lib/a", 4000), ("usr/lib/b", 3000),
+                           ("usr/bin/c", 2000), ("etc/d", 1000),
+                           ("var/e", 500)]:
+            path = os.path.join(self.src, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as dst:
+                dst.write("x" * size)
+        os.link(os.path.join(self.src, "usr/lib/b"),
+                os.path.join(self.src, "etc/b"))
+        os.symlink("usr/bin", os.path.join(self.src, "bin"))
+        os.chmod(os.path.join(self.src, "usr"), 0o700)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_split(self):
+        sets, dirs = utils.Tar.split(self.src, 2)
+        # usr is split, the hard linked files are kept together
+        self.assertEqual(dirs, [".", "./usr"])
+        self.assertEqual(sorted(sets), [["./bin", "./usr/bin", "./var"],
+                                        ["./etc", "./usr/lib"]])
+
+    def test_parallel_sync(self):
+        utils.Tar(jobs=2).sync(self.src, self.dst)
+        b = os.stat(os.path.join(self.dst, "usr/lib/b"))
+        self.assertEqual(b.st_nlink, 2)
+        self.assertEqual(os.readlink(os.path.join(self.dst, "bin")),
+                         "usr/bin")
+        self.assertEqual(os.stat(os.path.join(self.dst, "usr")).st_mode &
+                         0o777, 0o700)
+        with open(os.path.join(self.dst, "usr/lib/a")) as src:
+            self.assertEqual(len(src.read()), 4000)
+
+    def test_failed_sync(self):
+        # Both tar processes fail on a missing source
+        missing = os.path.join(self.tmpdir, "missing")
+        with patch.object(utils.Tar, "split",
+                          classmethod(lambda cls, src, jobs: ([["./etc"]],
+                                                              ["."]))):
+            self.assertRaises(RuntimeError, utils.Tar(2).sync, missing,
+                              self.dst)
+        self.assertRaises(RuntimeError, utils.Tar(1).sync, missing,
+                          self.dst)
+
+    def test_stream(self):
+        archive = os.path.join(self.tmpdir, "tree.tar.gz")
+        with tarfile.open(archive, "w:gz", format=tarfile.PAX_FORMAT,
+                          pax_headers={"IMGBASED.nvr": "Image-2.0-0"}) as tar:
+            tar.add(self.src, arcname=".")
+        with open(archive, "rb") as src:
+            stream = utils.TarStream(src)
+            self.assertEqual(stream.headers, {"IMGBASED.nvr": "Image-2.0-0"})
+            utils.Tar().unpack(stream, self.dst)
+        with open(os.path.join(self.dst, "etc/d")) as src:
+            self.assertEqual(len(src.read()), 1000)
+
+
 class LayoutVerbTestCase(CliTestCase):
     def test_layout_init_from(self):
         debug("LVs: %s" % FakeLVM.lvs())
@@ -143,6 +253,72 @@ class LayoutVerbTestCase(CliTestCase):
         assert r.stdout.strip() == "Image-1.0-0+1"
 
 
+class NamingQueriesTestCase(CliTestCase):
+    def test_tree_queries_are_constant(self):
+        imgbase = imgbased.imgbase.ImageLayers()
+        with patch("imgbased.imgbase.LVM", FakeLVM):
+            for nvr in ["Image-2.0-0", "Image-3.0-0"]:
+                self.cli("base", "--add", nvr, "--size", "4096")
+                self.cli("layer", "--add", nvr)
+                self.cli("layer", "--add", nvr + "+1")
+
+            FakeLVM._queries = 0
+            tree = imgbase.naming.tree()
+
+        self.assertEqual(len(tree), 3)
+        self.assertEqual(sum(len(b.layers) for b in tree), 5)
+        self.assertEqual(FakeLVM._queries, 1)
+
+    def test_lvs_with_tags_single_call(self):
+        LVM = imgbased.lvm.LVM
+        calls = []
+
+        def lvs(args):
+            calls.append(args)
+            return ("  hostvg$Image-1.0-0$imgbased:base\n"
+                    "  hostvg$Image-1.0-0+1$imgbased:layer,keep\n")
+
+        with patch.object(LVM, "_lvs", staticmethod(lvs)), \
+                patch("imgbased.lvm.LvmState.current", lambda: None):
+            lvs = LVM.list_lvs_with_tags(["imgbased:base",
+                                          "imgbased:layer"])
+        self.assertEqual(len(calls), 1)
+        self.assertIn("lv_tags = imgbased:base || lv_tags = imgbased:layer",
+                      calls[0])
+        self.assertEqual([(lv.lvm_name, tags) for lv, tags in lvs],
+                         [("hostvg/Image-1.0-0", ["imgbased:base"]),
+                          ("hostvg/Image-1.0-0+1", ["imgbased:layer",
+                                                    "keep"])])
+
+    def test_layout_snapshot_is_reused(self):
+        imgbase = imgbased.imgbase.ImageLayers()
+        with patch("imgbased.imgbase.LVM", FakeLVM), \
+                patch("imgbased.imgbase.Hooks"), \
+                patch("imgbased.imgbase.utils.Filesystem"):
+            imgbase.add_base("4096", "Image-2.0-0", with_layer=True)
+            FakeLVM._queries = 0
+            imgbase.naming.bases()
+            imgbase.naming.layers()
+            imgbase.latest_layer()
+            self.assertEqual(FakeLVM._queries, 1)
+
+            imgbase.add_layer(imgbase.latest_layer())
+            self.assertEqual(str(imgbase.latest_layer()), "Image-2.0-0+2")
+
+
+class ReclaimableSpaceTestCase(unittest.TestCase):
+    def test_empty_arguments_are_used(self):
+        imgbase = MagicMock()
+        base = imgbased.naming.Base("Image-1.0-0")
+        # An empty usage or list of bases is not queried again
+        self.assertEqual(imgbased.imgbase.ImageLayers.reclaimable_space(
+            imgbase, bases=[base], usage={}), [(base, 0)])
+        self.assertEqual(imgbased.imgbase.ImageLayers.reclaimable_space(
+            imgbase, bases=[], usage={}), [])
+        self.assertFalse(imgbase.image_usage.called)
+        self.assertFalse(imgbase.naming.bases.called)
+
+
 class BaseVerbTestCase(CliTestCase):
     def test_base_add(self):
         self.cli("--debug", "base", "--add", "Image-42-0",
@@ -163,6 +339,28 @@ class BaseVerbTestCase(CliTestCase):
         self.cli("--debug", "base", "--remove", "Image-42-0")
         assert "Image-42-0" not in self.cli("base", "--latest").stdout
 
+    def test_base_remove_many(self):
+        for nvr in ["Image-42-0", "Image-43-0"]:
+            self.cli("--debug", "base", "--add", nvr, "--size", "4096")
+        self.cli("--debug", "layer", "--add", "Image-42-0")
+
+        with self.assertRaises(RuntimeError):
+            # Nothing is removed if one of the images is unknown
+            self.cli("--debug", "base", "--remove", "Image-42-0",
+                     "Image-44-0")
+        assert "Image-42-0+1" in self.cli("layout", "--layers").stdout
+
+        with self.assertRaises(RuntimeError):
+            # Layers are not removed with the base verb
+            self.cli("--debug", "base", "--remove", "Image-42-0+1")
+        assert "Image-42-0+1" in self.cli("layout", "--layers").stdout
+
+        self.cli("--debug", "base", "--remove", "Image-42-0", "Image-43-0")
+        bases = self.cli("layout", "--bases").stdout
+        assert "Image-42-0" not in bases
+        assert "Image-43-0" not in bases
+        assert "Image-1.0-0" in bases
+
     def test_base_of_layer(self):
         self.cli("--debug", "base", "--add", "Image-42-0",
                  "--size", "4096")
@@ -182,12 +380,30 @@ class BaseVerbTestCase(CliTestCase):
         assert "Image-42-0+2" in layers
 
 
+class QueryVerbTestCase(CliTestCase):
+    def test_query_json(self):
+        self.cli("--debug", "base", "--add", "Image-42-0",
+                 "--size", "4096")
+        with patch("imgbased.plugins.core.BootConfiguration.get_default",
+                   side_effect=RuntimeError("No default entry")):
+            answers = json.loads(self.cli("query", "--json", "latest-base",
+                                          "bases", "layers",
+                                          "boot-default").stdout)
+        self.assertEqual(answers["latest-base"], "Image-42-0")
+        self.assertEqual(answers["bases"], ["Image-1.0-0", "Image-42-0"])
+        self.assertEqual(answers["layers"], {"Image-1.0-0": ["Image-1.0-0+1"],
+                                             "Image-42-0": []})
+        self.assertIsNone(answers["boot-default"])
+        self.assertEqual(answers["errors"],
+                         {"boot-default": "No default entry"})
+
+
 class UpdateVerbTestCase(CliTestCase):
     def test_update(self):
         with patch("imgbased.plugins.update.LiveimgExtractor.extract") as mock:
             mock.return_value = ("Image-1.0-0", "Image-2.0-0")
             self.cli("--debug", "update", "/my/file")
-            mock.assert_called_with("/my/file")
+            mock.assert_called_with("/my/file", nvr=None)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,309 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# imgbase
+#
+# Copyright (C) 2016  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import MagicMock, patch
+
+from imgbased.naming import Base, Layer
+from imgbased.plugins.update import (BlockExtractor, DeferredRemoval,
+                                     GarbageCollector, GCFailedError,
+                                     LiveimgExtractor, PoolExtender,
+                                     UpdateConfigurationSection)
+from imgbased.utils import sparse_copy
+
+KB = 1024
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+
+class FakePool(object):
+    lvm_name = "hostvg/pool0"
+
+    def __init__(self, size, data_percent, vg_free):
+        self.size = size
+        self.data_percent = data_percent
+        self.metadata_percent = 10.0
+        self.vg_free = vg_free
+        self.extensions = []
+
+    def autoextend_threshold(self):
+        return 80
+
+    def usage(self, cached=True):
+        return {"lv_size": self.size, "data_percent": self.data_percent,
+                "lv_metadata_size": GB, "metadata_percent":
+                self.metadata_percent}
+
+    def extend(self, data_bytes=0, metadata_bytes=0):
+        added = min(data_bytes + metadata_bytes, self.vg_free)
+        self.vg_free -= added
+        self.extensions.append((data_bytes, metadata_bytes))
+        return added
+
+
+class PoolExtenderTestCase(unittest.TestCase):
+    def test_reserve_grows_below_threshold(self):
+        pool = FakePool(10 * GB, 50.0, 100 * GB)
+        PoolExtender(pool).reserve(4 * GB)
+        # 9G are used afterwards, 80% of 11.25G
+        self.assertEqual(pool.extensions, [(1.25 * GB, 0)])
+
+    def test_reserve_without_growth(self):
+        pool = FakePool(10 * GB, 10.0, 100 * GB)
+        PoolExtender(pool).reserve(3 * GB)
+        self.assertEqual(pool.extensions, [])
+
+    def test_reserve_fails_early(self):
+        pool = FakePool(10 * GB, 50.0, 1 * GB)
+        self.assertRaises(RuntimeError, PoolExtender(pool).reserve, 7 * GB)
+
+    def test_check_extends_early(self):
+        pool = FakePool(10 * GB, 85.0, 0)
+        pool.metadata_percent = 90.0
+        extender = PoolExtender(pool)
+        extender.check()
+        extender.check()
+        # The VG is full, so it's tried once
+        self.assertEqual(pool.extensions, [(2 * GB, 0.2 * GB)])
+
+
+class RebaseTestCase(unittest.TestCase):
+    def test_rebase_applies_the_changes_only(self):
+        imgbase = MagicMock()
+        imgbase.naming.last_base.return_value = Base("Image-1.1-0")
+        imgbase.current_layer.return_value = Layer("Image-1.0-0+1")
+        imgbase._thinpool.return_value = FakePool(10 * GB, 50.0, 0)
+        imgbase.add_base_from_snapshot.return_value = Base("Image-2.0-0")
+        calls = []
+        new_base_lv = imgbase._lvm_from_layer.return_value
+        new_base_lv.addtag.side_effect = lambda tag: calls.append(tag)
+        extractor = LiveimgExtractor(imgbase, rebase=True)
+        with patch("imgbased.plugins.update.LVM"), \
+                patch("imgbased.plugins.update.Filesystem") as fs, \
+                patch("imgbased.plugins.update.mounted") as mounted, \
+                patch("imgbased.plugins.update.command.call",
+                      lambda cmd: calls.append(cmd[0])), \
+                patch.dict(os.environ, {"IMGBASED_DISABLE_THREADS": "1"}):
+            mounted.return_value.__enter__.return_value.target = "/mnt"
+            extractor.add_base_with_tree("/", "10G", "Image-2.0-0")
+        imgbase.add_base_from_snapshot.assert_called_with(
+            Base("Image-1.0-0"), "10G", "Image-2.0-0", tagged=False)
+        self.assertFalse(imgbase.add_base.called)
+        fs = fs.from_device.return_value
+        self.assertTrue(fs.randomize_uuid.called)
+        self.assertFalse(fs.mkfs.called)
+        fs.grow.assert_called_with("/mnt")
+        # The base is only tagged after the tree was synced
+        self.assertEqual(calls, ["rsync", "fstrim", imgbase.lv_base_tag])
+        self.assertTrue(imgbase.naming.invalidate.called)
+        imgbase.add_layer.assert_called_with(Base("Image-2.0-0"))
+        # The usage is sampled once the base was written
+        imgbase.record_pool_usage.assert_called_with("add_base")
+
+    @unittest.skipIf(not os.path.exists("/usr/bin/rsync"),
+                     "rsync is not available")
+    def test_sync_detects_same_size_and_mtime(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            src, dst = [os.path.join(tmpdir, d) for d in ["src", "dst"]]
+            for path, data in [(src, b"new"), (dst, b"old")]:
+                os.makedirs(os.path.join(path, "etc"))
+                with open(os.path.join(path, "etc", "conf"), "wb") as f:
+                    f.write(data)
+                os.utime(os.path.join(path, "etc", "conf"), (1000, 1000))
+            LiveimgExtractor._sync_tree(src, dst)
+            with open(os.path.join(dst, "etc", "conf"), "rb") as f:
+                self.assertEqual(f.read(), b"new")
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class SparseCopyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.src = tempfile.mktemp()
+        self.dst = tempfile.mktemp()
+
+    def tearDown(self):
+        for path in [self.src, self.dst]:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def test_zero_blocks_are_skipped(self):
+        data = b"a" * 100 + b"\0" * 4000 + b"b" * 50 + b"\0" * 2048
+        with open(self.src, "wb") as dst:
+            dst.write(data)
+        open(self.dst, "wb").close()
+
+        written, skipped = sparse_copy(self.src, self.dst, blocksize=1024)
+        with open(self.dst, "rb") as src:
+            self.assertEqual(src.read(), data)
+        # Only the blocks with a or b are written
+        self.assertEqual((written, skipped), (2048, len(data) - 2048))
+
+    def test_blocksize_covers_chunks(self):
+        pool = MagicMock()
+        for zero, chunk_size, blocksize in [(True, 4 * MB, MB),
+                                            (False, 64 * KB, MB),
+                                            (False, 192 * KB, 1152 * KB),
+                                            (False, 4 * MB, 4 * MB)]:
+            pool.provisioning.return_value = (zero, chunk_size)
+            self.assertEqual(BlockExtractor._blocksize(pool), blocksize)
+
+
+class SpaceGarbageCollectorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bases = [Base("Image-%d.0-0" % n) for n in range(1, 5)]
+        self.config = UpdateConfigurationSection()
+        self.config.gc_policy = "space"
+        self.config.gc_data_target = 70
+
+        # Removing a base frees 10% of the pool
+        self.pool = FakePool(10 * GB, 85.0, 0)
+        self.removed = []
+
+        def remove_images(nvrs, force=False):
+            for nvr in nvrs:
+                self.removed.append(str(nvr))
+                self.pool.data_percent -= 10
+
+        imgbase = MagicMock()
+        imgbase.config.section.return_value = self.config
+        imgbase.naming.bases.return_value = self.bases
+        imgbase.current_layer.return_value = Layer("Image-2.0-0+1")
+        imgbase._thinpool.return_value = self.pool
+        imgbase.remove_images.side_effect = remove_images
+        imgbase.reclaimable_space.side_effect = lambda bases: [
+            (self.bases[2], 3 * GB), (self.bases[0], 1 * GB)]
+        self.gc = GarbageCollector(imgbase)
+
+    def test_frees_until_below_targets(self):
+        new_base_lv = MagicMock(lv_name="Image-4.0-0")
+        with patch("imgbased.plugins.update.LVM"):
+            self.gc.run(new_base_lv)
+        # Ranked by the reclaimable space, current and new base are kept
+        self.assertEqual(self.removed, ["Image-3.0-0", "Image-1.0-0"])
+        self.assertEqual(self.pool.data_percent, 65.0)
+
+    def test_images_to_keep_is_a_lower_bound(self):
+        self.config.images_to_keep = 3
+        with patch("imgbased.plugins.update.LVM"):
+            self.gc.run(MagicMock(lv_name="Image-4.0-0"))
+        self.assertEqual(self.removed, ["Image-3.0-0"])
+
+    def test_count_policy_does_not_query_the_pool(self):
+        self.config.gc_policy = "count"
+        with patch("imgbased.plugins.update.LVM"), \
+                patch("imgbased.plugins.update.log.isEnabledFor",
+                      lambda level: False):
+            self.gc.run(MagicMock(lv_name="Image-4.0-0"))
+        self.assertEqual(self.removed, ["Image-1.0-0", "Image-3.0-0"])
+        self.assertFalse(self.gc.imgbase.reclaimable_space.called)
+
+    def test_below_targets(self):
+        self.pool.data_percent = 50.0
+        with patch("imgbased.plugins.update.LVM"):
+            self.gc.run(MagicMock(lv_name="Image-4.0-0"))
+        self.assertEqual(self.removed, [])
+
+    def test_unknown_mode_fails_gc_only(self):
+        self.config.gc_mode = "defered"
+        gc = GarbageCollector(self.gc.imgbase)
+        self.assertRaises(GCFailedError, gc.run,
+                          MagicMock(lv_name="Image-4.0-0"))
+        self.assertEqual(self.removed, [])
+
+    def test_deferred_marks_only(self):
+        self.config.gc_mode = "deferred"
+        self.gc = GarbageCollector(self.gc.imgbase)
+        marked = []
+        with patch("imgbased.plugins.update.LVM"), \
+                patch.object(DeferredRemoval, "pending", lambda s: []), \
+                patch.object(DeferredRemoval, "mark",
+                             lambda s, base: marked.append(str(base))), \
+                patch.object(DeferredRemoval, "trigger") as trigger:
+            self.gc.run(MagicMock(lv_name="Image-4.0-0"))
+        # Usage is estimated from the reclaimable space: 85% - 30%
+        self.assertEqual(marked, ["Image-3.0-0"])
+        self.assertEqual(self.removed, [])
+        self.assertTrue(trigger.called)
+
+
+class DeferredRemovalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mktemp()
+        self.bases = [Base("Image-%d.0-0" % n) for n in range(1, 4)]
+        self.tagged = set()
+        self.removed = []
+        self.interrupt = True
+
+        lvs = dict((str(b), MagicMock(lv_name=str(b))) for b in self.bases)
+        for name, lv in lvs.items():
+            lv.addtag.side_effect = lambda tag, n=name: self.tagged.add(n)
+            lv.deltag.side_effect = lambda tag, n=name: self.tagged.discard(n)
+
+        def remove_images(nvrs, force=False):
+            if self.interrupt:
+                raise RuntimeError("Interrupted")
+            for nvr in nvrs:
+                self.removed.append(str(nvr))
+                self.bases.remove(Base(nvr))
+                self.tagged.discard(str(nvr))
+
+        imgbase = MagicMock()
+        imgbase._lvm_from_layer.side_effect = lambda b: lvs[str(b)]
+        imgbase.naming.bases.side_effect = lambda: list(self.bases)
+        imgbase.current_layer.return_value = Layer("Image-3.0-0+1")
+        imgbase._thinpool.return_value = FakePool(10 * GB, 50.0, 0)
+        imgbase.remove_images.side_effect = remove_images
+        self.removal = DeferredRemoval(imgbase, self.path)
+        self.patch = patch("imgbased.plugins.update.LVM.list_lvs_with_tags",
+                           lambda any_tag: [(lvs[n], [self.removal.tag])
+                                            for n in sorted(self.tagged)])
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def test_run_is_resumable(self):
+        for name in ["Image-2.0-0", "Image-1.0-0", "Image-3.0-0"]:
+            self.removal.mark(Base(name))
+        self.assertEqual([str(b) for b in self.removal.pending()],
+                         ["Image-2.0-0", "Image-1.0-0", "Image-3.0-0"])
+
+        self.assertRaises(RuntimeError, self.removal.run)
+        self.assertEqual(len(self.removal.pending()), 3)
+
+        # The state file was lost, the tags are enough
+        os.unlink(self.path)
+        self.interrupt = False
+        self.removal.run()
+        # The current base is never removed
+        self.assertEqual(self.removed, ["Image-1.0-0", "Image-2.0-0"])
+        self.assertEqual(self.removal.pending(), [])
+        self.assertFalse(os.path.exists(self.path))
+
+# vim: sw=4 et sts=4: